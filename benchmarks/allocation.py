@@ -0,0 +1,537 @@
+"""Packing-efficiency and allocation-latency benchmark.
+
+Replays a trace of jobs (either synthetic or loaded from a file) through one or
+more layers of the allocation stack:
+
+``allocator``
+    A bare :py:class:`~spalloc_server.allocator.Allocator`. Jobs which
+    cannot be allocated immediately are retried, in arrival order, whenever
+    another job is freed.
+``job_queue``
+    A :py:class:`~spalloc_server.job_queue.JobQueue` managing a single
+    machine.
+``controller``
+    A :py:class:`~spalloc_server.controller.Controller` managing a single
+    machine whose BMPs are replaced by stubs which complete every request
+    immediately.
+
+Jobs arrive and depart according to a virtual clock (so the benchmark runs as
+fast as the allocation code allows) while the wall-clock time spent in the
+allocation code is measured. For each layer and packing algorithm the
+following are reported:
+
+* Allocations per second of wall-clock time spent allocating and freeing.
+* The p50/p99 latency of job creation calls.
+* Machine utilisation (fraction of working boards allocated) over time.
+* Fragmentation (1 - largest free rectangle / total free area, measured in
+  triads) over time.
+* Queue wait (virtual time between a job arriving and being allocated).
+
+Traces are JSON files containing a list of jobs, each an object with the
+following fields:
+
+``arrival``
+    Virtual time at which the job is created.
+``duration``
+    Virtual time the job holds its allocation for once allocated.
+``args``, ``kwargs``
+    Arguments for :py:meth:`~spalloc_server.allocator.Allocator.alloc` (e.g.
+    ``[]`` for a single board, ``[n]`` for n boards, ``[w, h]`` for a block
+    of triads).
+
+Example usage::
+
+    $ python benchmarks/allocation.py --width 8 --height 8 --jobs 2000 \\
+        --packer pack_tree max_rects
+"""
+
+import argparse
+import heapq
+import json
+import random
+import sys
+
+from timeit import default_timer
+
+from spalloc_server.allocator import Allocator, PACKERS
+from spalloc_server.configuration import Machine
+from spalloc_server.controller import Controller, JobState
+from spalloc_server.job_queue import JobQueue
+
+MACHINE_NAME = "benchmark"
+"""The name given to the machine being benchmarked."""
+
+LAYERS = ("allocator", "job_queue", "controller")
+"""The layers of the allocation stack which may be benchmarked."""
+
+
+def synthetic_trace(width, height, num_jobs, arrival_rate=1.0,
+                    mean_duration=30.0, seed=None):
+    """Generate a synthetic trace of jobs.
+
+    A mix of single-board, n-board and triad-block jobs arrive as a Poisson
+    process with exponentially distributed durations.
+
+    Parameters
+    ----------
+    width, height : int
+        Dimensions of the machine in triads (used to size jobs sensibly).
+    num_jobs : int
+        Number of jobs in the trace.
+    arrival_rate : float
+        Mean number of jobs arriving per unit of virtual time.
+    mean_duration : float
+        Mean job duration in units of virtual time.
+    seed : int or None
+        Random seed.
+
+    Returns
+    -------
+    [{"arrival": float, "duration": float, "args": [...], "kwargs": {}}, ...]
+    """
+    rng = random.Random(seed)
+    max_boards = width * height * 3
+    board_counts = [n for n in (2, 3, 6, 12, 24, 48, 96, 192)
+                    if n <= max_boards // 2] or [max_boards]
+
+    trace = []
+    now = 0.0
+    for _ in range(num_jobs):
+        now += rng.expovariate(arrival_rate)
+        kind = rng.random()
+        if kind < 0.4:
+            args = []
+        elif kind < 0.7:
+            args = [rng.choice(board_counts)]
+        else:
+            args = [rng.randint(1, max(1, width // 2)),
+                    rng.randint(1, max(1, height // 2))]
+        trace.append({"arrival": now,
+                      "duration": rng.expovariate(1.0 / mean_duration),
+                      "args": args,
+                      "kwargs": {}})
+    return trace
+
+
+def make_machine(width, height, dead_boards, packer):
+    """Construct a :py:class:`~spalloc_server.configuration.Machine` with
+    one frame per triad and made-up IP addresses.
+    """
+    return Machine(name=MACHINE_NAME, width=width, height=height,
+                   dead_boards=dead_boards, dead_links=set(),
+                   board_locations={(x, y, z): (x, y, z)
+                                    for x in range(width)
+                                    for y in range(height)
+                                    for z in range(3)
+                                    if (x, y, z) not in dead_boards},
+                   bmp_ips={(x, y): "10.{}.{}.0".format(x, y)
+                            for x in range(width)
+                            for y in range(height)},
+                   spinnaker_ips={(x, y, z): "10.{}.{}.{}".format(x, y, z + 1)
+                                  for x in range(width)
+                                  for y in range(height)
+                                  for z in range(3)
+                                  if (x, y, z) not in dead_boards},
+                   packer=packer)
+
+
+class StubBMPController(object):
+    """A stand-in for
+    :py:class:`~spalloc_server.async_bmp_controller.AsyncBMPController`
+    which completes all requests immediately and successfully.
+    """
+
+    def __init__(self, hostname, on_thread_start=None):
+        self.hostname = hostname
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        pass
+
+    def set_power(self, board, state, on_done):
+        on_done(True)
+
+    def set_link_enable(self, board, link, enable, on_done):
+        on_done(True)
+
+    def stop(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class AllocatorTarget(object):
+    """Drives a bare :py:class:`~spalloc_server.allocator.Allocator`, queueing
+    jobs which cannot be allocated immediately in arrival order.
+    """
+
+    def __init__(self, machine, on_allocate, on_cancel):
+        self._allocator = Allocator(machine.width, machine.height,
+                                    machine.dead_boards, machine.dead_links,
+                                    packer=machine.packer)
+        self._on_allocate = on_allocate
+        self._on_cancel = on_cancel
+
+        # {job_id: (args, kwargs), ...}
+        self._queue = {}
+        # {job_id: allocation_id, ...}
+        self._allocations = {}
+
+    def _try(self, job_id, args, kwargs):
+        allocation = self._allocator.alloc(*args, **kwargs)
+        if allocation is None:
+            return False
+        allocation_id, boards, _, _ = allocation
+        self._allocations[job_id] = allocation_id
+        self._on_allocate(job_id, boards)
+        return True
+
+    def create(self, job_id, args, kwargs):
+        if not self._allocator.alloc_possible(*args, **kwargs):
+            self._on_cancel(job_id)
+        elif not self._try(job_id, args, kwargs):
+            self._queue[job_id] = (args, kwargs)
+
+    def destroy(self, job_id):
+        if job_id in self._queue:
+            del self._queue[job_id]
+            return
+
+        self._allocator.free(self._allocations.pop(job_id))
+        for queued_id in sorted(self._queue):
+            args, kwargs = self._queue[queued_id]
+            if self._try(queued_id, args, kwargs):
+                del self._queue[queued_id]
+
+    def stop(self):
+        pass
+
+
+class JobQueueTarget(object):
+    """Drives a :py:class:`~spalloc_server.job_queue.JobQueue` managing a
+    single machine.
+    """
+
+    def __init__(self, machine, on_allocate, on_cancel):
+        self._job_queue = JobQueue(
+            (lambda job_id, machine_name, boards, periphery, torus:
+             on_allocate(job_id, boards)),
+            (lambda job_id, reason: None),
+            (lambda job_id, reason: on_cancel(job_id)))
+        self._job_queue.add_machine(MACHINE_NAME, machine.width,
+                                    machine.height, machine.tags,
+                                    machine.dead_boards, machine.dead_links,
+                                    packer=machine.packer)
+
+    def create(self, job_id, args, kwargs):
+        self._job_queue.create_job(*args, job_id=job_id, **kwargs)
+
+    def destroy(self, job_id):
+        self._job_queue.destroy_job(job_id)
+
+    def stop(self):
+        pass
+
+
+class ControllerTarget(object):
+    """Drives a :py:class:`~spalloc_server.controller.Controller` managing a
+    single machine with stubbed-out BMPs.
+    """
+
+    def __init__(self, machine, on_allocate, on_cancel):
+        self._on_allocate = on_allocate
+        self._on_cancel = on_cancel
+
+        self._controller = Controller(
+            bmp_controller_factory=StubBMPController)
+        self._controller.machines = {MACHINE_NAME: machine}
+
+        # Mapping between benchmark and controller job IDs
+        self._controller_ids = {}
+        self._job_ids = {}
+
+    def _check_changes(self):
+        for controller_id in self._controller.changed_jobs:
+            job_id = self._job_ids.get(controller_id)
+            if job_id is None:
+                continue
+            info = self._controller.get_job_machine_info(controller_id)
+            if info.boards is not None:
+                del self._job_ids[controller_id]
+                self._on_allocate(job_id, info.boards)
+            elif (self._controller.get_job_state(controller_id).state ==
+                    JobState.destroyed):
+                del self._job_ids[controller_id]
+                self._on_cancel(job_id)
+
+    def create(self, job_id, args, kwargs):
+        controller_id = self._controller.create_job(
+            *args, owner="benchmark", keepalive=None, **kwargs)
+        self._controller_ids[job_id] = controller_id
+        self._job_ids[controller_id] = job_id
+        self._check_changes()
+
+    def destroy(self, job_id):
+        controller_id = self._controller_ids.pop(job_id)
+        self._job_ids.pop(controller_id, None)
+        self._controller.destroy_job(controller_id)
+        self._check_changes()
+
+    def stop(self):
+        self._controller.stop()
+        self._controller.join()
+
+
+TARGETS = {
+    "allocator": AllocatorTarget,
+    "job_queue": JobQueueTarget,
+    "controller": ControllerTarget,
+}
+
+
+def largest_free_rectangle(width, height, used):
+    """Find the area of the largest rectangle of triads not in used.
+
+    Uses the standard 'largest rectangle in a histogram' method row by row.
+    """
+    best = 0
+    heights = [0] * width
+    for y in range(height):
+        for x in range(width):
+            heights[x] = 0 if (x, y) in used else heights[x] + 1
+
+        stack = []
+        for x, h in enumerate(heights + [0]):
+            start = x
+            while stack and stack[-1][1] >= h:
+                start, sh = stack.pop()
+                best = max(best, sh * (x - start))
+            stack.append((start, h))
+    return best
+
+
+def percentile(values, p):
+    """Get the p-th percentile (0-100) of a list of values."""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, int(round((p / 100.0) * (len(values) - 1))))
+    return values[index]
+
+
+def run(trace, machine, layer, samples=10):
+    """Replay a trace through a layer of the allocation stack.
+
+    Returns
+    -------
+    {metric: value, ...}
+    """
+    working_boards = (machine.width * machine.height * 3 -
+                      len(machine.dead_boards))
+
+    now = [0.0]
+    # {job_id: arrival_time, ...}
+    pending = {}
+    # {job_id: boards, ...}
+    allocated = {}
+    waits = []
+    cancelled = [0]
+    # Departure events [(time, job_id), ...]
+    departures = []
+
+    def on_allocate(job_id, boards):
+        waits.append(now[0] - pending.pop(job_id))
+        allocated[job_id] = boards
+        heapq.heappush(departures,
+                       (now[0] + trace[job_id]["duration"], job_id))
+
+    def on_cancel(job_id):
+        pending.pop(job_id)
+        cancelled[0] += 1
+
+    target = TARGETS[layer](machine, on_allocate, on_cancel)
+
+    create_latencies = []
+    busy_time = 0.0
+    num_allocations = 0
+
+    # Time-weighted statistics
+    last_time = 0.0
+    utilisation_area = 0.0
+    fragmentation_area = 0.0
+    utilisation = 0.0
+    fragmentation = 0.0
+    timeline = []
+
+    arrivals = sorted(range(len(trace)), key=(lambda i: trace[i]["arrival"]))
+    arrivals.reverse()
+    while arrivals or departures:
+        # Process the next event
+        if departures and (not arrivals or
+                           departures[0][0] <= trace[arrivals[-1]]["arrival"]):
+            event_time, job_id = heapq.heappop(departures)
+            now[0] = event_time
+            del allocated[job_id]
+
+            num_before = len(allocated)
+            before = default_timer()
+            target.destroy(job_id)
+            busy_time += default_timer() - before
+            num_allocations += len(allocated) - num_before
+        else:
+            job_id = arrivals.pop()
+            now[0] = trace[job_id]["arrival"]
+            pending[job_id] = now[0]
+
+            num_before = len(allocated)
+            before = default_timer()
+            target.create(job_id, trace[job_id]["args"],
+                          trace[job_id]["kwargs"])
+            latency = default_timer() - before
+            busy_time += latency
+            create_latencies.append(latency)
+            num_allocations += len(allocated) - num_before
+
+        # Accumulate time-weighted statistics for the state since the last
+        # event
+        utilisation_area += utilisation * (now[0] - last_time)
+        fragmentation_area += fragmentation * (now[0] - last_time)
+        last_time = now[0]
+
+        used_boards = set()
+        for boards in allocated.values():
+            used_boards.update(boards)
+        used_triads = set((x, y) for x, y, z in used_boards)
+        free_triads = machine.width * machine.height - len(used_triads)
+        utilisation = len(used_boards) / float(working_boards)
+        if free_triads:
+            fragmentation = 1.0 - (largest_free_rectangle(
+                machine.width, machine.height, used_triads) /
+                float(free_triads))
+        else:
+            fragmentation = 0.0
+        timeline.append((now[0], utilisation))
+
+    target.stop()
+
+    # Jobs still queued at the end of the trace (e.g. because a larger job
+    # is never able to fit) are reported separately.
+    never_allocated = len(pending)
+
+    duration = last_time or 1.0
+    step = max(1, len(timeline) // samples)
+    return {
+        "jobs": len(trace),
+        "allocations": num_allocations,
+        "cancelled": cancelled[0],
+        "never_allocated": never_allocated,
+        "allocations_per_sec": (num_allocations / busy_time
+                                if busy_time else float("nan")),
+        "create_p50_ms": percentile(create_latencies, 50) * 1000.0,
+        "create_p99_ms": percentile(create_latencies, 99) * 1000.0,
+        "mean_utilisation": utilisation_area / duration,
+        "utilisation_timeline": timeline[::step],
+        "mean_fragmentation": fragmentation_area / duration,
+        "wait_mean": sum(waits) / len(waits) if waits else float("nan"),
+        "wait_p50": percentile(waits, 50),
+        "wait_p99": percentile(waits, 99),
+    }
+
+
+def format_results(layer, packer, results):
+    """Produce a human-readable report of the results of :py:func:`.run`."""
+    lines = [
+        "{} / {}:".format(layer, packer),
+        "  jobs: {jobs} ({allocations} allocated, {cancelled} cancelled, "
+        "{never_allocated} never allocated)".format(**results),
+        "  allocations/sec: {allocations_per_sec:.1f}".format(**results),
+        "  create_job latency: p50 {create_p50_ms:.3f} ms, "
+        "p99 {create_p99_ms:.3f} ms".format(**results),
+        "  utilisation: mean {mean_utilisation:.3f}".format(**results),
+        "  utilisation over time: {}".format(
+            " ".join("{:.2f}".format(u)
+                     for _, u in results["utilisation_timeline"])),
+        "  fragmentation: mean {mean_fragmentation:.3f}".format(**results),
+        "  queue wait: mean {wait_mean:.2f}, p50 {wait_p50:.2f}, "
+        "p99 {wait_p99:.2f}".format(**results),
+    ]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark allocation latency and packing efficiency.")
+    parser.add_argument("--width", type=int, default=8,
+                        help="machine width in triads (default: %(default)s)")
+    parser.add_argument("--height", type=int, default=8,
+                        help="machine height in triads "
+                             "(default: %(default)s)")
+    parser.add_argument("--dead-boards", type=int, default=0,
+                        help="number of randomly chosen dead boards "
+                             "(default: %(default)s)")
+    parser.add_argument("--packer", nargs="+", default=["pack_tree"],
+                        choices=sorted(PACKERS),
+                        help="packing algorithm(s) to benchmark")
+    parser.add_argument("--layer", nargs="+", default=list(LAYERS),
+                        choices=LAYERS,
+                        help="layer(s) of the allocation stack to benchmark")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="replay the jobs in a JSON trace file rather "
+                             "than a synthetic trace")
+    parser.add_argument("--save-trace", metavar="FILE",
+                        help="write the trace used to a JSON file")
+    parser.add_argument("--jobs", type=int, default=1000,
+                        help="number of jobs in a synthetic trace "
+                             "(default: %(default)s)")
+    parser.add_argument("--arrival-rate", type=float, default=1.0,
+                        help="jobs arriving per unit time in a synthetic "
+                             "trace (default: %(default)s)")
+    parser.add_argument("--mean-duration", type=float, default=30.0,
+                        help="mean job duration in a synthetic trace "
+                             "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed (default: %(default)s)")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        with open(args.trace, "r") as f:
+            trace = json.load(f)
+    else:
+        trace = synthetic_trace(args.width, args.height, args.jobs,
+                                args.arrival_rate, args.mean_duration,
+                                args.seed)
+    if args.save_trace:
+        with open(args.save_trace, "w") as f:
+            json.dump(trace, f)
+
+    rng = random.Random(args.seed)
+    dead_boards = set(rng.sample([(x, y, z)
+                                  for x in range(args.width)
+                                  for y in range(args.height)
+                                  for z in range(3)],
+                                 args.dead_boards))
+
+    all_results = []
+    for layer in args.layer:
+        for packer in args.packer:
+            machine = make_machine(args.width, args.height,
+                                   dead_boards, packer)
+            results = run(trace, machine, layer)
+            all_results.append(dict(results, layer=layer, packer=packer))
+            if not args.json:
+                print(format_results(layer, packer, results))
+
+    if args.json:
+        json.dump(all_results, sys.stdout, indent=2)
+        print("")
+
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,333 @@
+"""A local stand-in for the BMPs of a SpiNNaker machine.
+
+Each :py:class:`.SimulatedBMP` is a UDP server which speaks just enough SCP
+to answer the commands sent by
+:py:class:`~spalloc_server.async_bmp_controller.AsyncBMPController` (i.e.
+:py:meth:`rig.machine_control.BMPController.set_power` and
+:py:meth:`rig.machine_control.BMPController.write_fpga_reg`) so that the
+server can be exercised end-to-end without any hardware. The following
+commands are understood:
+
+``power``
+    Records the new power state of the boards. Powering a board off also
+    resets its FPGA registers.
+``link_write``, ``link_read``
+    Write and read FPGA registers. These commands fail if the board is not
+    powered on.
+
+Any other command receives a 'bad command' response.
+
+Replies may be delayed (``latency``) and power-on commands take an
+additional ``power_on_delay`` to be acknowledged, as when a real BMP waits
+for the FPGAs to be loaded. Faults may be injected by dropping a fraction of
+incoming packets (``drop_rate``, exercising the client's retransmission) or
+by replying with a fatal error code (``failure_rate``).
+
+The BMPs must be reached on the standard SCP port since
+:py:class:`~spalloc_server.async_bmp_controller.AsyncBMPController` offers no
+way to choose another. Each BMP is therefore given its own loopback address
+(on Linux, every address in 127.0.0.0/8 refers to the local host).
+
+Example usage (serving the BMPs of a machine with two frames)::
+
+    $ python benchmarks/bmp_simulator.py 127.1.0.0 127.1.1.0 \\
+        --latency 0.001 --power-on-delay 0.5
+"""
+
+import argparse
+import heapq
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+from collections import Counter
+
+from six import iteritems, itervalues
+
+from rig.machine_control.consts import \
+    SCP_PORT, SCPCommands, SCPReturnCodes
+
+_SDP_HEADER = struct.Struct("<2x8B")
+"""The SDP header (preceded by two bytes of padding) of an SCP packet."""
+
+_SCP_HEADER = struct.Struct("<2H")
+"""The command/return code and sequence number of an SCP packet."""
+
+_SCP_ARGS = struct.Struct("<3I")
+"""The (up to) three arguments of an SCP command."""
+
+_WORD = struct.Struct("<I")
+
+_FLAG_NO_REPLY = 0x07
+"""SDP flags for a packet which does not expect a reply."""
+
+MAX_PACKET_LENGTH = 512
+"""The largest SCP packet the simulator will receive."""
+
+
+class SimulatedBMP(object):
+    """A simulated BMP responsible for the boards in a single frame.
+
+    The simulator runs in a background thread from construction until
+    :py:meth:`.stop` is called.
+
+    Attributes
+    ----------
+    power : {board: bool, ...}
+        The power state of every board which has been sent a power command.
+    fpga_registers : {(board, fpga, addr): value, ...}
+        The last value written to each FPGA register of a powered-on board.
+    """
+
+    def __init__(self, hostname, port=SCP_PORT, latency=0.0,
+                 power_on_delay=0.0, failure_rate=0.0, drop_rate=0.0,
+                 seed=None):
+        """
+        Parameters
+        ----------
+        hostname : str
+            The IP address to listen on.
+        port : int
+            The UDP port to listen on.
+        latency : float
+            The number of seconds before each command is acknowledged.
+        power_on_delay : float
+            The additional number of seconds before a power-on command is
+            acknowledged.
+        failure_rate : float
+            The probability that a command fails (i.e. is acknowledged with an
+            error code).
+        drop_rate : float
+            The probability that an incoming packet is silently ignored.
+        seed : int or None
+            Seed for the random number generator used to inject faults.
+        """
+        self.hostname = hostname
+        self.latency = latency
+        self.power_on_delay = power_on_delay
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+
+        self.power = {}
+        self.fpga_registers = {}
+
+        self._random = random.Random(seed)
+
+        # A lock which must be held when accessing the simulated state and
+        # statistics.
+        self._lock = threading.Lock()
+
+        # The number of commands received, by SCPCommands name, plus counts of
+        # the packets dropped and the commands failed.
+        self._counts = Counter()
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((hostname, port))
+
+        self._stop = False
+        self._thread = threading.Thread(
+            target=self._run, name="<Simulated BMP {}>".format(hostname))
+        self._thread.start()
+
+    def stats(self):
+        """Get the number of commands handled so far.
+
+        Returns
+        -------
+        {name: count, ...}
+            The number of each type of command received (named as in
+            :py:class:`rig.machine_control.consts.SCPCommands`) along with
+            the number of packets ``dropped`` and commands ``failed``.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def stop(self):
+        """Stop the simulator and close its socket."""
+        self._stop = True
+        self._thread.join()
+        self._sock.close()
+
+    def _run(self):
+        """The background thread which receives commands and sends replies
+        once they are due.
+        """
+        # Replies waiting to be sent [(due_time, n, reply, address), ...]
+        # where n ensures replies due at the same time are sent in order.
+        replies = []
+        n = 0
+        while not self._stop:
+            timeout = 0.1
+            if replies:
+                timeout = min(timeout, max(0.0, replies[0][0] - time.time()))
+            readable, _, _ = select.select([self._sock], [], [], timeout)
+
+            if readable:
+                packet, address = self._sock.recvfrom(MAX_PACKET_LENGTH)
+                response = self._handle(packet)
+                if response is not None:
+                    delay, reply = response
+                    heapq.heappush(replies,
+                                   (time.time() + delay, n, reply, address))
+                    n += 1
+
+            now = time.time()
+            while replies and replies[0][0] <= now:
+                _, _, reply, address = heapq.heappop(replies)
+                self._sock.sendto(reply, address)
+
+    def _handle(self, packet):
+        """Carry out the command in an SCP packet.
+
+        Returns
+        -------
+        (delay, reply) or None
+            The reply to send and the number of seconds to wait before sending
+            it, or None if no reply is to be sent.
+        """
+        if len(packet) < _SDP_HEADER.size + _SCP_HEADER.size:
+            return None
+        (flags, tag, dest_port_cpu, src_port_cpu,
+         dest_y, dest_x, src_y, src_x) = _SDP_HEADER.unpack_from(packet)
+        cmd, seq = _SCP_HEADER.unpack_from(packet, _SDP_HEADER.size)
+        args = packet[_SDP_HEADER.size + _SCP_HEADER.size:]
+        arg1, arg2, arg3 = _SCP_ARGS.unpack(
+            args[:_SCP_ARGS.size].ljust(_SCP_ARGS.size, b"\0"))
+        data = args[_SCP_ARGS.size:]
+        board = dest_port_cpu & 0x1F
+
+        delay = self.latency
+        payload = b""
+        with self._lock:
+            try:
+                self._counts[SCPCommands(cmd).name] += 1
+            except ValueError:
+                self._counts["unknown"] += 1
+
+            if self._random.random() < self.drop_rate:
+                self._counts["dropped"] += 1
+                return None
+
+            if self._random.random() < self.failure_rate:
+                self._counts["failed"] += 1
+                rc = SCPReturnCodes.timeout
+            elif cmd == SCPCommands.power:
+                state = bool(arg1 & 1)
+                for b in range(32):
+                    if arg2 & (1 << b):
+                        self.power[b] = state
+                        if not state:
+                            self._reset_fpgas(b)
+                if state:
+                    delay += self.power_on_delay
+                rc = SCPReturnCodes.ok
+            elif cmd in (SCPCommands.link_write, SCPCommands.link_read):
+                key = (board, arg3, arg1 & ~0x3)
+                if not self.power.get(board, False):
+                    # The FPGAs of an unpowered board do not respond
+                    rc = SCPReturnCodes.arg
+                elif cmd == SCPCommands.link_write and len(data) >= 4:
+                    self.fpga_registers[key] = _WORD.unpack_from(data)[0]
+                    rc = SCPReturnCodes.ok
+                elif cmd == SCPCommands.link_read:
+                    payload = _WORD.pack(self.fpga_registers.get(key, 0))
+                    rc = SCPReturnCodes.ok
+                else:
+                    rc = SCPReturnCodes.len
+            else:
+                rc = SCPReturnCodes.cmd
+
+        reply = (_SDP_HEADER.pack(_FLAG_NO_REPLY, tag,
+                                  src_port_cpu, dest_port_cpu,
+                                  src_y, src_x, dest_y, dest_x) +
+                 _SCP_HEADER.pack(rc, seq) +
+                 payload)
+        return (delay, reply)
+
+    def _reset_fpgas(self, board):
+        """Forget the FPGA register values of a board which has been powered
+        down. Must be called with the lock held.
+        """
+        for key in [key for key in self.fpga_registers if key[0] == board]:
+            del self.fpga_registers[key]
+
+
+def simulate_machine(machine, seed=None, **kwargs):
+    """Start a :py:class:`.SimulatedBMP` for every frame of a machine.
+
+    Parameters
+    ----------
+    machine : :py:class:`~spalloc_server.configuration.Machine`
+        The machine whose BMPs are to be simulated. The BMP IP addresses
+        must be local addresses.
+    seed : int or None
+        If given, the BMPs' random number generators are seeded with
+        consecutive values starting from this one.
+    **kwargs
+        Passed to each :py:class:`.SimulatedBMP`.
+
+    Returns
+    -------
+    {(c, f): :py:class:`.SimulatedBMP`, ...}
+    """
+    bmps = {}
+    try:
+        for i, ((c, f), hostname) in enumerate(
+                sorted(iteritems(machine.bmp_ips))):
+            bmps[(c, f)] = SimulatedBMP(
+                hostname, seed=None if seed is None else seed + i, **kwargs)
+    except:
+        for bmp in itervalues(bmps):
+            bmp.stop()
+        raise
+    return bmps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulate SpiNNaker BMPs on local addresses.")
+    parser.add_argument("hostname", nargs="+",
+                        help="the address of each BMP to simulate")
+    parser.add_argument("--port", type=int, default=SCP_PORT,
+                        help="the UDP port to listen on "
+                             "(default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds before each command is acknowledged "
+                             "(default: %(default)s)")
+    parser.add_argument("--power-on-delay", type=float, default=0.0,
+                        help="additional seconds before power-on commands "
+                             "are acknowledged (default: %(default)s)")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="probability of a command failing "
+                             "(default: %(default)s)")
+    parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="probability of a packet being dropped "
+                             "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed")
+    args = parser.parse_args(argv)
+
+    bmps = [SimulatedBMP(hostname, port=args.port, latency=args.latency,
+                         power_on_delay=args.power_on_delay,
+                         failure_rate=args.failure_rate,
+                         drop_rate=args.drop_rate, seed=args.seed)
+            for hostname in args.hostname]
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for bmp in bmps:
+            print("{}: {}".format(bmp.hostname, bmp.stats()))
+            bmp.stop()
+
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""End-to-end job start-up benchmark against simulated BMPs.
+
+A :py:class:`~spalloc_server.server.Server` is started with a machine made up
+of whole cabinets whose BMPs are simulated by
+:py:class:`bmp_simulator.SimulatedBMP` objects. A number of concurrent clients
+then each repeatedly create a job, wait for it to become ready (i.e. for its
+boards to be powered on and its links configured) and destroy it again.
+
+The following are reported:
+
+* Time-to-ready: the time between a job being created and it reaching the
+  ready state (p50, p99 and maximum).
+* Throughput: jobs made ready per second of wall-clock time.
+* The number of jobs which failed (were destroyed before becoming ready, e.g.
+  due to injected BMP faults).
+* The number of SCP commands received by the simulated BMPs.
+
+Note that boards are given
+:py:data:`~spalloc_server.async_bmp_controller.POST_POWER_ON_DELAY` seconds to
+start up after every power-on command which dominates the time-to-ready of
+individual jobs.
+
+The simulated BMPs are given their own addresses in 127.0.0.0/8 (see
+:py:mod:`bmp_simulator`) and so this benchmark only runs on operating systems
+where these all refer to the local host (e.g. Linux).
+
+Example usage::
+
+    $ python benchmarks/power_on.py --cabinets 1 --frames 5 --jobs 100 \\
+        --clients 16 --boards 1 3 24 --latency 0.001
+"""
+
+import argparse
+import json
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+from collections import Counter, deque
+from timeit import default_timer
+
+from six import itervalues
+
+from spalloc_server.configuration import Configuration, Machine
+from spalloc_server.controller import JobState
+from spalloc_server.server import Server
+
+from bmp_simulator import simulate_machine
+
+MACHINE_NAME = "benchmark"
+"""The name given to the machine being benchmarked."""
+
+BOARDS_PER_FRAME = 24
+"""The number of boards in each (fully populated) frame."""
+
+
+def make_machine(cabinets, frames, base_ip="127.1.0.0"):
+    """Construct a :py:class:`~spalloc_server.configuration.Machine` made up
+    of fully populated cabinets with conventional IP addresses starting from
+    base_ip.
+
+    Each frame provides a block of 4x2 triads with frames stacked vertically
+    and cabinets side-by-side.
+    """
+    board_locations = {}
+    for x in range(4 * cabinets):
+        for y in range(2 * frames):
+            for z in range(3):
+                b = (((y % 2) * 4) + (x % 4)) * 3 + z
+                board_locations[(x, y, z)] = (x // 4, y // 2, b)
+    return Machine.with_standard_ips(MACHINE_NAME,
+                                     board_locations=board_locations,
+                                     base_ip=base_ip)
+
+
+class Client(object):
+    """A minimal blocking client for the server's JSON protocol."""
+
+    def __init__(self, hostname, port):
+        self._sock = socket.create_connection((hostname, port))
+        self._buffer = b""
+
+        # Notifications received while waiting for a return value
+        self._notifications = deque()
+
+    def close(self):
+        self._sock.close()
+
+    def _recv(self):
+        while b"\n" not in self._buffer:
+            data = self._sock.recv(4096)
+            if not data:
+                raise IOError("Server disconnected.")
+            self._buffer += data
+        line, _, self._buffer = self._buffer.partition(b"\n")
+        return json.loads(line.decode("utf-8"))
+
+    def call(self, command, *args, **kwargs):
+        self._sock.sendall(json.dumps({"command": command,
+                                       "args": args,
+                                       "kwargs": kwargs}).encode("utf-8") +
+                           b"\n")
+        while True:
+            message = self._recv()
+            if "return" in message:
+                return message["return"]
+            self._notifications.append(message)
+
+    def wait_for_notification(self):
+        if self._notifications:
+            return self._notifications.popleft()
+        return self._recv()
+
+
+def run_client(hostname, port, jobs, times_to_ready, failures):
+    """Create, wait for and destroy jobs until none are left.
+
+    Parameters
+    ----------
+    jobs : deque([[arg, ...], ...])
+        The arguments of the jobs to create (shared between clients).
+    times_to_ready : [float, ...]
+        The time-to-ready of each job is appended to this list.
+    failures : [job_id, ...]
+        The ID of every job destroyed before becoming ready is appended to
+        this list.
+    """
+    client = Client(hostname, port)
+    try:
+        while True:
+            try:
+                args = jobs.popleft()
+            except IndexError:
+                return
+
+            before = default_timer()
+            job_id = client.call("create_job", *args,
+                                 owner="benchmark", keepalive=None)
+            client.call("notify_job", job_id)
+            while True:
+                state = client.call("get_job_state", job_id)["state"]
+                if state in (JobState.ready, JobState.destroyed):
+                    break
+                client.wait_for_notification()
+
+            if state == JobState.ready:
+                times_to_ready.append(default_timer() - before)
+            else:
+                failures.append(job_id)
+
+            client.call("destroy_job", job_id)
+    finally:
+        client.close()
+
+
+def percentile(values, p):
+    """Get the p-th percentile (0-100) of a list of values."""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, int(round((p / 100.0) * (len(values) - 1))))
+    return values[index]
+
+
+def run(machine, jobs, clients, port=22244, **simulator_kwargs):
+    """Start a server and simulated BMPs for a machine and run jobs on it.
+
+    Parameters
+    ----------
+    machine : :py:class:`~spalloc_server.configuration.Machine`
+    jobs : [[arg, ...], ...]
+        The arguments of each job to create.
+    clients : int
+        The number of concurrent clients.
+    port : int
+        The port for the server to listen on.
+    **simulator_kwargs
+        Passed to each :py:class:`bmp_simulator.SimulatedBMP`.
+
+    Returns
+    -------
+    {metric: value, ...}
+    """
+    config_dir = tempfile.mkdtemp()
+    bmps = simulate_machine(machine, **simulator_kwargs)
+    try:
+        config_file = os.path.join(config_dir, "spalloc.cfg")
+        with open(config_file, "w") as f:
+            f.write("configuration = {!r}\n".format(Configuration(
+                machines=[machine], ip="127.0.0.1", port=port)))
+
+        server = Server(config_file, cold_start=True)
+        try:
+            job_queue = deque(jobs)
+            times_to_ready = []
+            failures = []
+            threads = [threading.Thread(target=run_client,
+                                        args=("127.0.0.1", port, job_queue,
+                                              times_to_ready, failures))
+                       for _ in range(clients)]
+
+            before = default_timer()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = default_timer() - before
+        finally:
+            # Also waits for the final power-off commands to be sent
+            server.stop_and_join()
+    finally:
+        commands = Counter()
+        for bmp in itervalues(bmps):
+            commands.update(bmp.stats())
+            bmp.stop()
+        shutil.rmtree(config_dir)
+
+    return {
+        "jobs": len(jobs),
+        "ready": len(times_to_ready),
+        "failed": len(failures),
+        "duration": duration,
+        "jobs_per_sec": len(times_to_ready) / duration,
+        "time_to_ready_p50": percentile(times_to_ready, 50),
+        "time_to_ready_p99": percentile(times_to_ready, 99),
+        "time_to_ready_max": max(times_to_ready or [float("nan")]),
+        "bmp_commands": dict(commands),
+    }
+
+
+def format_results(results):
+    """Produce a human-readable report of the results of :py:func:`.run`."""
+    lines = [
+        "jobs: {jobs} ({ready} ready, {failed} failed) "
+        "in {duration:.2f} s".format(**results),
+        "jobs/sec: {jobs_per_sec:.2f}".format(**results),
+        "time-to-ready: p50 {time_to_ready_p50:.3f} s, "
+        "p99 {time_to_ready_p99:.3f} s, "
+        "max {time_to_ready_max:.3f} s".format(**results),
+        "BMP commands: {}".format(", ".join(
+            "{} {}".format(name, count)
+            for name, count in sorted(results["bmp_commands"].items()))),
+    ]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark job start-up against simulated BMPs.")
+    parser.add_argument("--cabinets", type=int, default=1,
+                        help="number of cabinets (default: %(default)s)")
+    parser.add_argument("--frames", type=int, default=5,
+                        help="number of frames per cabinet "
+                             "(default: %(default)s)")
+    parser.add_argument("--base-ip", default="127.1.0.0",
+                        help="the first (loopback) address to assign to the "
+                             "simulated BMPs (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=22244,
+                        help="the port for the server to listen on "
+                             "(default: %(default)s)")
+    parser.add_argument("--jobs", type=int, default=50,
+                        help="number of jobs to run (default: %(default)s)")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="number of concurrent clients "
+                             "(default: %(default)s)")
+    parser.add_argument("--boards", type=int, nargs="+", default=[1],
+                        help="the number of boards requested by each job, "
+                             "used in turn (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds before each BMP command is "
+                             "acknowledged (default: %(default)s)")
+    parser.add_argument("--power-on-delay", type=float, default=0.0,
+                        help="additional seconds before power-on commands "
+                             "are acknowledged (default: %(default)s)")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="probability of a BMP command failing "
+                             "(default: %(default)s)")
+    parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="probability of a packet to a BMP being "
+                             "dropped (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed (default: %(default)s)")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    machine = make_machine(args.cabinets, args.frames, args.base_ip)
+    jobs = [[args.boards[i % len(args.boards)]] for i in range(args.jobs)]
+    results = run(machine, jobs, args.clients, args.port,
+                  latency=args.latency,
+                  power_on_delay=args.power_on_delay,
+                  failure_rate=args.failure_rate,
+                  drop_rate=args.drop_rate,
+                  seed=args.seed)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print("")
+    else:
+        print(format_results(results))
+
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
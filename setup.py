@@ -25,22 +25,27 @@ setup(
         "Operating System :: Microsoft :: Windows",
         "Operating System :: MacOS",
 
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
     ],
     keywords="spinnaker allocation packing management supercomputer",
 
     # Requirements
-    install_requires=["rig", "six", "enum-compat", "inotify_simple", "pytz"],
+    python_requires=">=3.7",
+    install_requires=["rig", "six", "enum-compat", "inotify_simple", "pytz",
+                      "numpy"],
+    extras_require={"msgpack": ["msgpack"]},
 
     # Scripts
     entry_points={
         "console_scripts": [
             "spalloc-server = spalloc_server.server:main",
             "spalloc_server = spalloc_server.server:main",
+            "spalloc-server-replay = spalloc_server.replay:main",
         ],
     }
 )
@@ -5,7 +5,7 @@ functionality of a machine.
 
 from enum import Enum
 
-from collections import deque
+from collections import OrderedDict
 
 from math import ceil
 
@@ -14,8 +14,18 @@ from six import next
 from rig.links import Links
 
 from spalloc_server.pack_tree import PackTree
+from spalloc_server.max_rects import MaxRectsPacker
 from spalloc_server.area_to_rect import area_to_rect
 from spalloc_server.coordinates import board_down_link, WrapAround
+from spalloc_server.machine_index import ConnectivityIndex, FaultIndex
+
+
+PACKERS = {
+    "pack_tree": PackTree,
+    "max_rects": MaxRectsPacker,
+}
+"""The 2D packing algorithms which may be used by an :py:class:`.Allocator`
+to allocate triads, by name."""
 
 
 class Allocator(object):
@@ -23,7 +33,8 @@ class Allocator(object):
     larger, possibly faulty, toroidal machine.
 
     Internally this object uses a
-    :py:class:`spalloc_server.pack_tree.PackTree` to allocate
+    :py:class:`spalloc_server.pack_tree.PackTree` (or another packer from
+    :py:data:`.PACKERS`) to allocate
     rectangular blocks of triads in a machine. A :py:class:`._CandidateFilter`
     to restrict the allocations made by
     :py:class:`~spalloc_server.pack_tree.PackTree` to those which match
@@ -39,7 +50,7 @@ class Allocator(object):
     """
 
     def __init__(self, width, height, dead_boards=None, dead_links=None,
-                 next_id=1):
+                 next_id=1, candidate_cache_size=1024, packer="pack_tree"):
         """
         Parameters
         ----------
@@ -55,18 +66,40 @@ class Allocator(object):
             down).
         next_id : int
             The ID of the next allocation to be made.
+        candidate_cache_size : int
+            The maximum number of candidate rectangles whose suitability (as
+            determined by :py:class:`._CandidateFilter`) will be remembered.
+        packer : str
+            The name of the 2D packing algorithm (from :py:data:`.PACKERS`)
+            to use to allocate triads.
         """
         self.width = width
         self.height = height
         self.dead_boards = dead_boards if dead_boards is not None else set()
         self.dead_links = dead_links if dead_links is not None else set()
 
+        # A :py:class:`~spalloc_server.machine_index.ConnectivityIndex` and
+        # :py:class:`~spalloc_server.machine_index.FaultIndex` of the boards
+        # and links in the machine along with a copy of the (dead_boards,
+        # dead_links) they were built from. Built on demand and rebuilt
+        # whenever the set of dead boards or links is changed.
+        self._connectivity = None
+        self._fault_index = None
+        self._index_faults = None
+
+        # Since the suitability of a particular rectangle of the machine
+        # depends only on the faults in the machine (and not on what has been
+        # allocated), the results of candidate filters are cached between
+        # allocations. Emptied whenever the machine indices are rebuilt.
+        self._candidate_cache = _LRUCache(candidate_cache_size)
+
         # Unique IDs are assigned to every new allocation. The next ID to be
         # allocated.
         self.next_id = next_id
 
-        # A 2D tree at the granularity of triads used for board allocation.
-        self.pack_tree = PackTree(0, 0, width, height)
+        # A 2D packer at the granularity of triads used for board allocation
+        # (by default a PackTree).
+        self.pack_tree = PACKERS[packer](0, 0, width, height)
 
         # Provides a lookup from (live) allocation IDs to the type of
         # allocation.
@@ -91,6 +124,49 @@ class Allocator(object):
         # triad is removed from that dictionary and placed into the set below.
         self.full_single_board_triads = set()
 
+    def __getstate__(self):
+        """Called when pickling this object.
+
+        The machine indices and candidate cache are not pickled since they can
+        be rebuilt from the sets of dead boards and links on demand.
+        """
+        state = self.__dict__.copy()
+        state["_connectivity"] = None
+        state["_fault_index"] = None
+        state["_index_faults"] = None
+        state["_candidate_cache"] = _LRUCache(self._candidate_cache.max_size)
+        return state
+
+    def _update_indices(self):
+        """(Re)build the machine indices if the set of dead boards or links
+        has changed since they were last built.
+        """
+        faults = (self.dead_boards, self.dead_links)
+        if self._index_faults is None or self._index_faults != faults:
+            self._connectivity = ConnectivityIndex(
+                self.width, self.height, self.dead_boards, self.dead_links)
+            self._fault_index = FaultIndex(
+                self.width, self.height, self.dead_boards, self.dead_links)
+            self._index_faults = (frozenset(self.dead_boards),
+                                  frozenset(self.dead_links))
+            self._candidate_cache.clear()
+
+    @property
+    def connectivity(self):
+        """A :py:class:`~spalloc_server.machine_index.ConnectivityIndex`
+        describing the working boards and links of the machine.
+        """
+        self._update_indices()
+        return self._connectivity
+
+    @property
+    def fault_index(self):
+        """A :py:class:`~spalloc_server.machine_index.FaultIndex` counting
+        the dead boards and links of the machine.
+        """
+        self._update_indices()
+        return self._fault_index
+
     def _alloc_triads_possible(self, width, height, max_dead_boards=None,
                                max_dead_links=None, require_torus=False,
                                min_ratio=0.0):
@@ -150,7 +226,10 @@ class Allocator(object):
         # Test to see whether the allocation could succeed in the idle machine
         cf = _CandidateFilter(self.width, self.height,
                               self.dead_boards, self.dead_links,
-                              max_dead_boards, max_dead_links, require_torus)
+                              max_dead_boards, max_dead_links, require_torus,
+                              connectivity=self.connectivity,
+                              fault_index=self.fault_index,
+                              cache=self._candidate_cache)
         for x, y in set([(0, 0),
                          (self.width - width, 0),
                          (0, self.height - height),
@@ -216,7 +295,10 @@ class Allocator(object):
 
         cf = _CandidateFilter(self.width, self.height,
                               self.dead_boards, self.dead_links,
-                              max_dead_boards, max_dead_links, require_torus)
+                              max_dead_boards, max_dead_links, require_torus,
+                              connectivity=self.connectivity,
+                              fault_index=self.fault_index,
+                              cache=self._candidate_cache)
 
         xy = self.pack_tree.alloc(width, height,
                                   candidate_filter=cf)
@@ -303,7 +385,9 @@ class Allocator(object):
         cf = _CandidateFilter(self.width, self.height,
                               self.dead_boards, self.dead_links,
                               max_dead_boards, max_dead_links, require_torus,
-                              boards)
+                              boards, connectivity=self.connectivity,
+                              fault_index=self.fault_index,
+                              cache=self._candidate_cache)
         for x, y in set([(0, 0),
                          (self.width - width, 0),
                          (0, self.height - height),
@@ -379,7 +463,9 @@ class Allocator(object):
         cf = _CandidateFilter(self.width, self.height,
                               self.dead_boards, self.dead_links,
                               max_dead_boards, max_dead_links, require_torus,
-                              boards)
+                              boards, connectivity=self.connectivity,
+                              fault_index=self.fault_index,
+                              cache=self._candidate_cache)
 
         xywh = self.pack_tree.alloc_area(triads, min_ratio,
                                          candidate_filter=cf)
@@ -825,7 +911,8 @@ class _CandidateFilter(object):
 
     def __init__(self, width, height, dead_boards, dead_links,
                  max_dead_boards, max_dead_links, require_torus,
-                 expected_boards=None):
+                 expected_boards=None, connectivity=None, fault_index=None,
+                 cache=None):
         """Create a new candidate filter.
 
         Parameters
@@ -861,6 +948,18 @@ class _CandidateFilter(object):
             the max_dead_boards figure is offset by any over-allocation.
 
             If None, assumes the candidate width * candidate height * 3.
+        connectivity : :py:class:`.ConnectivityIndex` or None
+            *Optional.* A connectivity index for the system built from the
+            supplied dead_boards and dead_links. If None, a new index will be
+            built.
+        fault_index : :py:class:`.FaultIndex` or None
+            *Optional.* A fault index for the system built from the supplied
+            dead_boards and dead_links. If None, a new index will be built.
+        cache : :py:class:`._LRUCache` or None
+            *Optional.* A cache in which the outcome of checking each
+            candidate will be stored and looked up. The cache must only be
+            shared between filters for the same system (i.e. with identical
+            dead_boards and dead_links). If None, no caching is performed.
         """
         self.width = width
         self.height = height
@@ -871,6 +970,17 @@ class _CandidateFilter(object):
         self.require_torus = require_torus
         self.expected_boards = expected_boards
 
+        if connectivity is None:
+            connectivity = ConnectivityIndex(width, height,
+                                             dead_boards, dead_links)
+        self.connectivity = connectivity
+
+        if fault_index is None:
+            fault_index = FaultIndex(width, height, dead_boards, dead_links)
+        self.fault_index = fault_index
+
+        self.cache = cache
+
         self.boards = None
         self.periphery = None
         self.torus = None
@@ -883,38 +993,8 @@ class _CandidateFilter(object):
         -------
         set([(x, y, z), ...])
         """
-        # The set of visited (and working) boards
-        boards = set()
-
-        to_visit = deque([(x, y, 0)])
-        while to_visit:
-            x1, y1, z1 = to_visit.popleft()
-
-            # Skip dead boards and boards we've seen before
-            if ((x1, y1, z1) in self.dead_boards or
-                    (x1, y1, z1) in boards):
-                continue
-
-            boards.add((x1, y1, z1))
-
-            # Visit neighbours which are within the range
-            for link in Links:
-                # Skip dead links
-                if (x1, y1, z1, link) in self.dead_links:
-                    continue
-
-                x2, y2, z2, _ = board_down_link(x1, y1, z1, link,
-                                                self.width, self.height)
-
-                # Skip links to boards outside the specified range
-                if not (x <= x2 < x + width and
-                        y <= y2 < y + height):
-                    continue
-
-                to_visit.append((x2, y2, z2))
-
-        # Return the set of boards we could reach
-        return boards
+        return self.connectivity.boards(
+            self.connectivity.reachable(x, y, width, height))
 
     def _classify_links(self, boards):
         """Get a list of links of various classes connected to the supplied set
@@ -979,6 +1059,55 @@ class _CandidateFilter(object):
         return (alive, wrap, dead, dead_wrap, periphery,
                 WrapAround(wrap_around_type))
 
+    def _expected_boards(self, width, height):
+        """The number of boards expected in a candidate of the given size.
+        """
+        if self.expected_boards is not None:
+            return self.expected_boards
+        else:
+            return width * height * 3
+
+    def _quick_reject(self, x, y, width, height):
+        """Cheaply check whether the region specified certainly can't meet
+        the stated requirements, using only the summed-area tables of faults.
+
+        Returns
+        -------
+        bool
+            True if the region can definitely be rejected. False if the region
+            must be checked fully.
+        """
+        # The bottom-left board must be working
+        if not self.connectivity.live & (1 << self.connectivity.bit(x, y, 0)):
+            return True
+
+        # Only meaningful limits can be checked
+        if self.max_dead_boards is None:
+            return False
+
+        # At best, every working board in the region will be reachable
+        working = (width * height * 3) - \
+            self.fault_index.dead_boards(x, y, width, height)
+        min_dead = self._expected_boards(width, height) - working
+        if min_dead > self.max_dead_boards:
+            return True
+
+        # At most, this many working boards may be unreachable without
+        # exceeding the dead board limit. Each board cut off from the
+        # rest removes at most 12 links (6 in each direction) from the count of
+        # dead links. All other dead links between working boards are counted
+        # (though dead wrap-around links are ignored here, they are only
+        # counted when a torus is required).
+        if self.max_dead_links is not None:
+            max_unreachable = self.max_dead_boards - min_dead
+            min_dead_links = \
+                self.fault_index.dead_links(x, y, width, height) - \
+                (12 * max_unreachable)
+            if min_dead_links > self.max_dead_links:
+                return True
+
+        return False
+
     def __call__(self, x, y, width, height):
         """Test whether the region specified meets the stated requirements.
 
@@ -986,22 +1115,50 @@ class _CandidateFilter(object):
         self.boards and the set of links on the periphery are stored in
         self.periphery.
         """
-        boards = self._enumerate_boards(x, y, width, height)
+        if self.cache is None:
+            return self._check(x, y, width, height)
+
+        key = (x, y, width, height,
+               self.max_dead_boards, self.max_dead_links, self.require_torus,
+               self.expected_boards)
+        result = self.cache.get(key)
+        if result is None:
+            if self._check(x, y, width, height):
+                result = (frozenset(self.boards), frozenset(self.periphery),
+                          self.torus)
+            else:
+                result = False
+            self.cache.set(key, result)
+        elif result is not False:
+            # Copy the cached sets since they are handed on to the caller
+            boards, periphery, torus = result
+            self.boards = set(boards)
+            self.periphery = set(periphery)
+            self.torus = torus
+
+        return result is not False
+
+    def _check(self, x, y, width, height):
+        """Test whether the region specified meets the stated requirements,
+        without consulting the cache.
+        """
+        if self._quick_reject(x, y, width, height):
+            return False
+
+        reachable = self.connectivity.reachable(x, y, width, height)
 
         # Make sure the maximum dead boards limit isn't exceeded
         if self.max_dead_boards is not None:
-            if self.expected_boards is not None:
-                expected_boards = self.expected_boards
-            else:
-                expected_boards = width * height * 3
-            alive = len(boards)
-            dead = expected_boards - alive
+            alive = self.connectivity.count(reachable)
+            dead = self._expected_boards(width, height) - alive
             if alive == 0 or dead > self.max_dead_boards:
                 return False
         else:
-            if len(boards) == 0:
+            if not reachable:
                 return False
 
+        boards = self.connectivity.boards(reachable)
+
         # Make sure the maximum dead links limit isn't exceeded (and that torus
         # links exist if requested)
         (alive, wrap, dead, dead_wrap, periphery, wrap_around_type) = \
@@ -1022,3 +1179,41 @@ class _CandidateFilter(object):
         self.periphery = periphery
         self.torus = wrap_around_type
         return True
+
+
+class _LRUCache(object):
+    """A simple dictionary-like cache which holds at most a fixed number of
+    entries, discarding the least-recently used entries first.
+    """
+
+    def __init__(self, max_size):
+        """
+        Parameters
+        ----------
+        max_size : int
+            The maximum number of entries to hold.
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Get the value cached for a key, or None if not present."""
+        value = self._entries.pop(key, None)
+        if value is not None:
+            # Move to the most-recently-used end
+            self._entries[key] = value
+        return value
+
+    def set(self, key, value):
+        """Add an entry to the cache, possibly evicting old entries."""
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        self._entries.clear()
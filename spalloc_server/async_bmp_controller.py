@@ -1,13 +1,33 @@
 """Provide (basic) asynchronous control over a BMP responsible for controlling
 a whole rack.
+
+Each :py:class:`.AsyncBMPController` queues the commands for a single BMP.
+The commands are carried out by the worker threads of a :py:class:`.BMPEngine`
+which may be shared by the controllers for many BMPs, so that large
+installations do not need a thread for every frame.
 """
 
 import threading
 
-from collections import namedtuple, deque
+import struct
+
+import time
+
+from heapq import heappush, heappop
+
+from collections import namedtuple, deque, OrderedDict
+
+from functools import partial
+
+from itertools import count
+
+from six import iteritems, itervalues
 
 from rig.links import Links
 from rig.machine_control import BMPController
+from rig.machine_control.consts import \
+    SCPCommands, SCP_SVER_RECEIVE_LENGTH_MAX
+from rig.machine_control.scp_connection import scpcall
 
 import logging
 
@@ -21,18 +41,30 @@ class AsyncBMPController(object):
     object uses a Rig :py:class:`~rig.machine_control.BMPController` object to
     communicate with a BMP controlling a single frame of boards.
 
-    Power and link configuration commands are queued and executed in a
-    background thread. When a command completes, a user-supplied callback is
-    called.
+    Power and link configuration commands are queued and executed in the
+    background by a :py:class:`.BMPEngine`'s worker threads. Commands for a
+    single BMP are never executed concurrently and are always carried out in
+    the order described below. When a command completes, a user-supplied
+    callback is called.
 
     Sequential power commands of the same type (on/off) are coalesced into a
     single power on command. When a power command is sent, all previous link
     configuration commands queued for that board are skipped. Additionally, all
     power commands are completed before link configuration commands are carried
     out.
+
+    Queued link configuration commands are sent in batches of up to
+    :py:data:`.LINK_BATCH_SIZE` with up to :py:data:`.LINK_WINDOW_SIZE`
+    commands awaiting a response from the BMP at once (rather than waiting
+    for each command to complete before sending the next).
+
+    Power-on commands are only reported as complete (and no further commands
+    are sent to the BMP) once :py:data:`.POST_POWER_ON_DELAY` seconds have
+    elapsed, giving the boards time to start up. No worker thread is occupied
+    during this delay.
     """
 
-    def __init__(self, hostname, on_thread_start=None):
+    def __init__(self, hostname, on_thread_start=None, engine=None):
         """Start a new asynchronous BMP Controller
 
         Parameters
@@ -40,13 +72,15 @@ class AsyncBMPController(object):
         hostname : str
             The hostname/IP of the BMP to connect to.
         on_thread_start : function() or None
-            *Optional.* A function to be called by the controller's background
-            thread before it starts. This can be used to ensure propper
-            sequencing/handing-over between two AsyncBMPControllers connected
-            to the same machine.
+            *Optional.* A function to be called (by the engine's start-up
+            thread) before any commands are sent to the BMP. This can
+            be used to ensure propper sequencing/handing-over between two
+            AsyncBMPControllers connected to the same machine.
+        engine : :py:class:`.BMPEngine` or None
+            *Optional.* The engine whose worker threads will carry out this
+            controller's commands. If None, the controller creates (and
+            stops, once joined) its own single-threaded engine.
         """
-        self._on_thread_start = on_thread_start
-
         self._bc = BMPController(hostname)
 
         self._stop = False
@@ -54,20 +88,46 @@ class AsyncBMPController(object):
         # A lock which must be held when modifying the state of this object
         self._lock = threading.RLock()
 
-        # An event fired whenever some new interaction with the BMP is
-        # required.
-        self._requests_pending = threading.Event()
+        # The engine which executes the queued requests and whether this
+        # controller owns it.
+        self._own_engine = engine is None
+        self._engine = BMPEngine(1) if engine is None else engine
+
+        # Has on_thread_start returned (i.e. may requests be carried out)?
+        self._started = on_thread_start is None
+
+        # Is this controller waiting to be (or being) run by the engine?
+        self._scheduled = False
+
+        # The power-on request whose post-power-on delay is elapsing (or None)
+        self._powering_on = None
+
+        # Set once the controller has stopped and all queued requests have
+        # been completed.
+        self._stopped = threading.Event()
 
         # A queue of power change states
         self._power_requests = deque()
 
-        # A queue of link-enabled state changes
-        self._link_requests = deque()
+        # A queue of link-enabled state changes, indexed by a sequence
+        # number allocated in the order the requests were made.
+        # {seq: _LinkRequest, ...}
+        self._link_requests = OrderedDict()
+
+        # The sequence numbers of the queued link-enabled state changes for
+        # each board (allowing them to be cancelled without searching the
+        # whole queue).
+        # {board: OrderedDict({seq: _LinkRequest, ...}), ...}
+        self._board_link_requests = {}
+
+        # Generates sequence numbers for link requests
+        self._link_request_seq = count()
 
-        self._thread = threading.Thread(
-            target=self._run,
-            name="<BMP control thread for {}>".format(hostname))
-        self._thread.start()
+        # Run on_thread_start on the engine's start-up thread. It may block
+        # (e.g. waiting for other controllers to complete their requests)
+        # without occupying any of the engine's workers.
+        if on_thread_start is not None:
+            self._engine.schedule_start(partial(self._start, on_thread_start))
 
     def __enter__(self):
         """When used as a context manager, make requests 'atomic'."""
@@ -95,16 +155,14 @@ class AsyncBMPController(object):
 
             # Enqueue the request
             self._power_requests.append(_PowerRequest(state, board, on_done))
-            self._requests_pending.set()
+            self._schedule()
 
             # Cancel any existing link enable commands for this board
-            cancelled = []
-            for request in list(self._link_requests):
-                if request.board == board:
-                    self._link_requests.remove(request)
-                    cancelled.append(request)
+            cancelled = self._board_link_requests.pop(board, {})
+            for seq in cancelled:
+                del self._link_requests[seq]
 
-        for request in cancelled:
+        for request in itervalues(cancelled):
             request.on_done(False)
 
     def set_link_enable(self, board, link, enable, on_done):
@@ -127,94 +185,146 @@ class AsyncBMPController(object):
             assert not self._stop
 
             # Enqueue the request
-            self._link_requests.append(
-                _LinkRequest(board, link, enable, on_done))
-            self._requests_pending.set()
+            seq = next(self._link_request_seq)
+            request = _LinkRequest(board, link, enable, on_done)
+            self._link_requests[seq] = request
+            self._board_link_requests.setdefault(
+                board, OrderedDict())[seq] = request
+            self._schedule()
 
     def stop(self):
-        """Stop the background thread, as soon as possible after completing all
+        """Stop the controller, as soon as possible after completing all
         queued actions.
         """
         with self._lock:
             self._stop = True
-            self._requests_pending.set()
+            self._check_stopped()
 
     def join(self):
-        """Wait for the thread to actually stop."""
-        self._thread.join()
+        """Wait for the controller to actually stop."""
+        self._stopped.wait()
 
-    def _run(self):
-        """The background thread for interacting with the BMP.
+        # Shut down the engine if nothing else can be using it
+        if self._own_engine:
+            self._engine.stop()
+            self._engine.join()
+
+    def _start(self, on_thread_start):
+        """Call on_thread_start and then begin carrying out requests."""
+        try:
+            on_thread_start()
+        finally:
+            with self._lock:
+                self._started = True
+                if self._power_requests or self._link_requests:
+                    self._schedule()
+                else:
+                    self._check_stopped()
+
+    def _schedule(self):
+        """Ensure the engine will run :py:meth:`._step` (unless it is already
+        due to). Must be called with the lock held.
+        """
+        if self._started and not self._scheduled:
+            self._scheduled = True
+            self._engine.schedule(self)
+
+    def _check_stopped(self):
+        """Signal that the controller has stopped if it has been asked to stop
+        and has nothing left to do. Must be called with the lock held.
+        """
+        if (self._stop and self._started and not self._scheduled and
+                not self._power_requests and not self._link_requests):
+            self._stopped.set()
+
+    def _step(self):
+        """Carry out the next queued request (or batch of requests).
+
+        Called by a worker thread of the engine. Once the request has been
+        carried out, the controller is returned to the back of the engine's
+        queue if further requests remain, allowing the engine's workers to be
+        shared fairly between BMPs.
         """
         try:
-            if self._on_thread_start is not None:
-                self._on_thread_start()
-
-            while True:
-                self._requests_pending.wait()
-
-                # Priority 0: Power commands
-                power_request = self._get_atomic_power_request()
-                if power_request:
-                    # Send the power command
-                    try:
-                        self._bc.set_power(state=power_request.state,
-                                           board=power_request.board)
-                        success = True
-                    except IOError:
-                        # Communication issue with the machine, log it but not
-                        # much we can do for the end-user.
-                        logging.exception("Failed to set board power.")
-                        success = False
-
-                    # Alert all waiting threads
-                    for on_done in power_request.on_done:
-                        on_done(success)
-
-                    continue
-
-                # Priority 1: Link enable/disable commands
-                link_request = self._get_atomic_link_request()
-                if link_request:
-                    # Set the link state, as required
-                    try:
-                        fpga, addr \
-                            = FPGA_LINK_STOP_REGISTERS[link_request.link]
-                        self._bc.write_fpga_reg(fpga, addr,
-                                                not link_request.enable,
-                                                board=link_request.board)
-                        success = True
-                    except IOError:
-                        # Communication issue with the machine, log it but not
-                        # much we can do for the end-user.
-                        logging.exception("Failed to set link state.")
-                        success = False
-
-                    # Alert waiting thread
-                    link_request.on_done(success)
-
-                    continue
-
-                # If nothing left in the queues, clear the request flag and
-                # break out of queue-processing loop.
-                with self._lock:
-                    if (not self._power_requests and  # pragma: no branch
-                            not self._link_requests):
-                        self._requests_pending.clear()
-
-                        # If we've been told to stop, actually stop the thread
-                        # now
-                        if self._stop:  # pragma: no branch
-                            return
+            if self._powering_on is not None:
+                # The boards have had time to start up following a power-on
+                # command so it is now complete.
+                power_request = self._powering_on
+                self._powering_on = None
+                for on_done in power_request.on_done:
+                    on_done(True)
+            elif not self._step_power():
+                self._step_links()
         except:  # pragma: no cover
-            # If the thread crashes something has gone wrong with this program
+            # If a request crashes something has gone wrong with this program
             # (not the machine), setting _stop will cause set_power and
             # set_link_enable to fail, hopefully propogating news of this
             # crash..
             with self._lock:
                 self._stop = True
+                self._scheduled = False
+                self._stopped.set()
             raise
 
+        with self._lock:
+            self._scheduled = False
+            if self._powering_on is not None:
+                # Wait for the boards to start up without occupying a worker
+                self._scheduled = True
+                self._engine.schedule(self, POST_POWER_ON_DELAY)
+            elif self._power_requests or self._link_requests:
+                self._schedule()
+            else:
+                self._check_stopped()
+
+    def _step_power(self):
+        """Send the next queued power command, if any.
+
+        Successful power-on commands are completed by a later call to
+        :py:meth:`._step`, once :py:data:`.POST_POWER_ON_DELAY` has elapsed.
+
+        Returns
+        -------
+        bool
+            True if a power command was sent.
+        """
+        power_request = self._get_atomic_power_request()
+        if not power_request:
+            return False
+
+        # Send the power command
+        try:
+            self._bc.set_power(state=power_request.state,
+                               board=power_request.board,
+                               post_power_on_delay=0.0)
+            success = True
+        except IOError:
+            # Communication issue with the machine, log it but not much we can
+            # do for the end-user.
+            logging.exception("Failed to set board power.")
+            success = False
+
+        if success and power_request.state:
+            self._powering_on = power_request
+        else:
+            # Alert all waiting threads
+            for on_done in power_request.on_done:
+                on_done(success)
+        return True
+
+    def _step_links(self):
+        """Send the next batch of queued link enable/disable commands, if
+        any.
+        """
+        link_requests = self._get_atomic_link_requests()
+        if link_requests:
+            # Set the link states, as required
+            successes = self._set_link_states(link_requests)
+
+            # Alert all waiting threads
+            for link_request, success in zip(link_requests, successes):
+                link_request.on_done(success)
+
     def _get_atomic_power_request(self):
         """If any power requests are outstanding, return a (boards, state)
         tuple which combines as many of the requests at the head of the queue
@@ -240,18 +350,320 @@ class AsyncBMPController(object):
                 on_done.append(request.on_done)
             return _PowerRequest(state, boards, on_done)
 
-    def _get_atomic_link_request(self):
-        """Pop the next link state change request, if one exists.
+    def _get_atomic_link_requests(self):
+        """Pop a batch of link state change requests from the head of the
+        queue.
+
+        At most :py:data:`.LINK_BATCH_SIZE` requests are returned and no two
+        requests in a batch change the same link (since requests sent together
+        may be carried out in any order).
 
         Returns
         -------
-        :py:class:`._LinkRequest` or None
+        [:py:class:`._LinkRequest`, ...]
+            The batch of requests (empty if no requests are outstanding).
         """
         with self._lock:
-            if not self._link_requests:
-                return None
+            requests = []
+            links = set()
+            while self._link_requests and len(requests) < LINK_BATCH_SIZE:
+                seq, request = next(iteritems(self._link_requests))
+                if (request.board, request.link) in links:
+                    break
+                links.add((request.board, request.link))
+
+                # Remove from the queue and board index
+                del self._link_requests[seq]
+                board_requests = self._board_link_requests[request.board]
+                del board_requests[seq]
+                if not board_requests:
+                    del self._board_link_requests[request.board]
+
+                requests.append(request)
+            return requests
+
+    def _set_link_states(self, link_requests):
+        """Send a batch of link state change requests to the BMP.
+
+        A single request is sent using a (blocking) FPGA register write. Larger
+        batches are sent in an SCP burst with up to
+        :py:data:`.LINK_WINDOW_SIZE` requests in flight at once. If the burst
+        fails, any requests which were not acknowledged are retried one at a
+        time so that a single failing board doesn't fail the whole batch.
+
+        Parameters
+        ----------
+        link_requests : [:py:class:`._LinkRequest`, ...]
+
+        Returns
+        -------
+        [bool, ...]
+            For each request, True if it completed successfully, False
+            otherwise.
+        """
+        successes = [False] * len(link_requests)
+
+        if len(link_requests) > 1:
+            def on_ack(i, packet):
+                successes[i] = True
+
+            calls = []
+            for i, request in enumerate(link_requests):
+                fpga, addr = FPGA_LINK_STOP_REGISTERS[request.link]
+                calls.append(scpcall(
+                    0, 0, request.board, SCPCommands.link_write,
+                    addr & (~0x3), 4, fpga,
+                    struct.pack("<I", int(not request.enable)),
+                    partial(on_ack, i), 0.0))
+            try:
+                self._bc.connections[(0, 0)].send_scp_burst(
+                    SCP_SVER_RECEIVE_LENGTH_MAX, LINK_WINDOW_SIZE, calls)
+            except IOError:
+                logging.exception("Failed to set link states, retrying "
+                                  "unacknowledged requests individually.")
+
+        for i, request in enumerate(link_requests):
+            if successes[i]:
+                continue
+            try:
+                fpga, addr = FPGA_LINK_STOP_REGISTERS[request.link]
+                self._bc.write_fpga_reg(fpga, addr, not request.enable,
+                                        board=request.board)
+                successes[i] = True
+            except IOError:
+                # Communication issue with the machine, log it but not
+                # much we can do for the end-user.
+                logging.exception("Failed to set link state.")
+
+        return successes
+
+
+class BMPEngine(object):
+    """A pool of worker threads which carry out the queued requests of many
+    :py:class:`.AsyncBMPController` objects.
+
+    At most :py:attr:`.num_workers` threads are started (and only as they are
+    needed), however many BMPs share the engine. Workers beyond the first
+    ``min_workers`` exit once they have been idle for
+    :py:data:`.WORKER_IDLE_TIMEOUT` seconds. Controllers with requests
+    waiting are served in turn, a request (or batch of requests) at a time.
+    Since a controller is only ever given to one worker at a time, the
+    requests for each BMP are still carried out one after another, in order.
+    Controllers may also be scheduled to run after a delay (e.g. while boards
+    start up) without occupying a worker in the meantime.
+
+    The controllers' ``on_thread_start`` functions are called, in order, by
+    a separate start-up thread (started only while there are functions to
+    call). Since these may block until other controllers' requests have been
+    carried out, they never occupy a worker.
+    """
+
+    def __init__(self, num_workers=4, min_workers=1):
+        """
+        Parameters
+        ----------
+        num_workers : int
+            The maximum number of worker threads, i.e. the number of BMPs which
+            may be communicated with at once. Must be at least 1.
+        min_workers : int
+            The number of worker threads which are kept running (once started)
+            while idle.
+        """
+        _check_num_workers(num_workers)
+        self._num_workers = num_workers
+        self._min_workers = min_workers
+
+        self._lock = threading.Lock()
+
+        # Notified when controllers are added to the queue or the engine is
+        # stopped
+        self._condition = threading.Condition(self._lock)
+
+        # The queue of controllers with requests to be carried out
+        self._queue = deque()
+
+        # The queue of on_thread_start functions to be called and the thread
+        # calling them (or None if the queue is empty).
+        self._start_queue = deque()
+        self._starter = None
+
+        # A min-heap of controllers to be added to the queue at a later time.
+        # The sequence number ensures controllers themselves are never
+        # compared.
+        # [(time, seq, controller), ...]
+        self._timers = []
+        self._timer_seq = count()
+
+        self._workers = []
+        self._idle_workers = 0
+
+        # The number of idle workers which have been notified of new work but
+        # have not yet woken up
+        self._wakeups = 0
+        self._stop = False
+
+    @property
+    def num_workers(self):
+        """The maximum number of worker threads.
+
+        This may be changed while the engine is running. If reduced, surplus
+        workers exit once they finish their current request.
+        """
+        with self._lock:
+            return self._num_workers
+
+    @num_workers.setter
+    def num_workers(self, num_workers):
+        _check_num_workers(num_workers)
+        with self._lock:
+            self._num_workers = num_workers
+
+    def schedule(self, controller, delay=None):
+        """Request that a worker calls the controller's ``_step`` method.
+
+        Parameters
+        ----------
+        controller : :py:class:`.AsyncBMPController`
+        delay : float or None
+            If given, the number of seconds to wait before the controller may
+            be run.
+        """
+        with self._lock:
+            if delay is None:
+                self._queue.append(controller)
             else:
-                return self._link_requests.popleft()
+                heappush(self._timers, (time.time() + delay,
+                                        next(self._timer_seq), controller))
+            self._wake_worker()
+
+    def schedule_start(self, on_start):
+        """Request that the start-up thread calls a controller's start-up
+        function.
+
+        Parameters
+        ----------
+        on_start : function()
+            The function to call. It may block, e.g. until other controllers
+            sharing the engine have carried out their requests.
+        """
+        with self._lock:
+            self._start_queue.append(on_start)
+            if self._starter is None:
+                self._starter = threading.Thread(
+                    target=self._run_starts, name="<BMP engine start-up>")
+                self._starter.start()
+
+    def _wake_worker(self):
+        """Notify an idle worker of new work, starting a new worker if none
+        are idle. Must be called with the lock held.
+        """
+        if self._idle_workers > self._wakeups:
+            self._wakeups += 1
+            self._condition.notify()
+        elif len(self._workers) < self._num_workers:
+            worker = threading.Thread(target=self._run,
+                                      name="<BMP engine worker>")
+            self._workers.append(worker)
+            worker.start()
+
+    def stop(self):
+        """Stop the worker threads once the queue is empty and no controllers
+        are waiting to be run after a delay."""
+        with self._lock:
+            self._stop = True
+            self._condition.notify_all()
+
+    def join(self):
+        """Wait for the worker threads to stop."""
+        while True:
+            with self._lock:
+                threads = list(self._workers)
+                if self._starter is not None:
+                    threads.append(self._starter)
+            if not threads:
+                break
+            for thread in threads:
+                thread.join()
+
+    def _run_starts(self):
+        """The start-up thread: calls the queued start-up functions in
+        order, exiting once the queue is empty."""
+        while True:
+            with self._lock:
+                if not self._start_queue:
+                    self._starter = None
+                    # Stopped workers may have been waiting for the
+                    # start-up functions to finish before exiting
+                    self._condition.notify_all()
+                    return
+                on_start = self._start_queue.popleft()
+
+            try:
+                on_start()
+            except Exception:  # pragma: no cover
+                logging.exception("BMP controller crashed.")
+
+    def _run(self):
+        """A worker thread."""
+        worker = threading.current_thread()
+        while True:
+            with self._lock:
+                idle_since = time.time()
+                while True:
+                    # Queue any controllers whose delay has elapsed
+                    now = time.time()
+                    while self._timers and self._timers[0][0] <= now:
+                        self._queue.append(heappop(self._timers)[2])
+
+                    if self._queue:
+                        break
+
+                    # Exit when stopped and there is nothing left to do, if
+                    # there are more workers than allowed or if this worker
+                    # has been idle for a while (leaving at least one worker
+                    # to wait for any delays to elapse).
+                    surplus = len(self._workers) > self._num_workers
+                    if (self._stop and not self._timers and
+                            self._starter is None):
+                        surplus = True
+                    elif (len(self._workers) > self._min_workers and
+                            (not self._timers or len(self._workers) > 1) and
+                            now - idle_since >= WORKER_IDLE_TIMEOUT):
+                        surplus = True
+                    if surplus:
+                        self._workers.remove(worker)
+                        # Another worker may need to take over waiting for
+                        # delays to elapse
+                        self._condition.notify()
+                        return
+
+                    # Wait for new work, the next delay to elapse or for this
+                    # worker to become surplus
+                    timeout = idle_since + WORKER_IDLE_TIMEOUT - now
+                    if self._timers:
+                        timeout = min(timeout, self._timers[0][0] - now)
+                    self._idle_workers += 1
+                    self._condition.wait(max(0.0, timeout))
+                    self._idle_workers -= 1
+                    self._wakeups = max(0, self._wakeups - 1)
+
+                controller = self._queue.popleft()
+
+                # Several controllers' delays may have elapsed at once
+                if self._queue:
+                    self._condition.notify()
+
+            try:
+                controller._step()
+            except Exception:  # pragma: no cover
+                logging.exception("BMP controller crashed.")
+
+
+def _check_num_workers(num_workers):
+    """Raise a ValueError if a :py:class:`.BMPEngine` may not have the given
+    number of workers."""
+    if num_workers < 1:
+        raise ValueError("A BMP engine needs at least one worker.")
 
 
 class _PowerRequest(namedtuple("_PowerRequest", "state board on_done")):
@@ -291,6 +703,28 @@ class _LinkRequest(namedtuple("_LinkRequest", "board link enable on_done")):
     # Python 3.4 Workaround: https://bugs.python.org/issue24931
     __slots__ = tuple()
 
+
+POST_POWER_ON_DELAY = 5.0
+"""The number of seconds the boards are given to start up (e.g. for their FPGAs
+to be loaded) after a power-on command before the command is considered
+complete.
+"""
+
+WORKER_IDLE_TIMEOUT = 30.0
+"""The number of seconds a :py:class:`.BMPEngine`'s worker threads may be idle
+before they exit (down to the engine's minimum number of workers).
+"""
+
+LINK_BATCH_SIZE = 32
+"""The maximum number of link state change requests sent to a BMP together.
+Power requests queued while a batch is being sent wait for it to complete.
+"""
+
+LINK_WINDOW_SIZE = 8
+"""The maximum number of link state change requests awaiting a response from
+a BMP at any one time.
+"""
+
 # Gives the FPGA number and register addresses for the STOP register (which
 # disables outgoing traffic on a high-speed link) for each link direction.
 # https://github.com/SpiNNakerManchester/spio/tree/master/designs/spinnaker_fpgas#spi-interface
@@ -0,0 +1,330 @@
+"""An :py:mod:`asyncio`-based implementation of the server's network layer.
+
+The :py:class:`~spalloc_server.server.Server` handles every client from a
+single :py:func:`~select.poll` loop, blocking on each client in turn while
+sending it messages. In the :py:class:`.AsyncioServer` each client connection
+is instead handled by its own coroutine with non-blocking, buffered writes
+so that a slow client only ever delays itself.
+
+This module requires Python 3.7 or later and is only imported when the
+asyncio server is selected (e.g. using the ``--asyncio`` command-line
+option).
+"""
+
+import asyncio
+import logging
+
+from six import itervalues
+
+from spalloc_server.protocol import DEFAULT_PROTOCOL, FrameTooLongError
+from spalloc_server.server import \
+    Server, OutputBufferFullError, _create_server_socket, _reply, \
+    MAX_BUFFER_SIZE
+
+
+class _Connection(object):
+    """A client connection to the :py:class:`.AsyncioServer`.
+
+    Instances of this class take the place of the client's socket object in
+    the :py:class:`~spalloc_server.server.Server`'s data structures and
+    command dispatch.
+    """
+
+    def __init__(self, reader, writer):
+        """
+        Parameters
+        ----------
+        reader : :py:class:`asyncio.StreamReader`
+        writer : :py:class:`asyncio.StreamWriter`
+        """
+        self.reader = reader
+        self.writer = writer
+
+        # Cached since these become unavailable once the connection is closed
+        self._fileno = writer.get_extra_info("socket").fileno()
+        self._peername = writer.get_extra_info("peername")
+
+    def fileno(self):
+        return self._fileno
+
+    def getpeername(self):
+        return self._peername
+
+    def is_closing(self):
+        return self.writer.is_closing()
+
+    def get_write_buffer_size(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    def send(self, data):
+        """Queue data to be sent to the client without blocking."""
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        """Close the connection, discarding any buffered data."""
+        self.writer.transport.abort()
+
+
+class AsyncioServer(Server):
+    """A :py:class:`~spalloc_server.server.Server` whose network layer is
+    implemented using :py:mod:`asyncio`.
+
+    The protocol, commands and behaviour of this server are identical to
+    :py:class:`~spalloc_server.server.Server` but rather than a single
+    :py:func:`~select.poll` loop, an asyncio event loop runs in the server
+    thread with one coroutine (:py:meth:`._handle_connection`) per connected
+    client.
+
+    Replies to clients are written without blocking. Once a client's
+    outgoing buffer exceeds the transport's high-water mark, no further
+    commands are read from that client until it has read enough of its
+    replies (i.e. backpressure is applied) while every other client continues
+    to be served as normal. Clients whose outgoing buffer exceeds
+    :py:attr:`~spalloc_server.configuration.Configuration.max_client_output_buffer`
+    are disconnected.
+
+    As in :py:class:`~spalloc_server.server.Server`, clients which send
+    commands which cannot be processed are disconnected.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Accepts the same arguments as
+        :py:class:`~spalloc_server.server.Server`.
+        """
+        # The event loop run by the server thread.
+        self._loop = asyncio.new_event_loop()
+
+        # Set (from the event loop) to wake up the main server coroutine. This
+        # is created by the main server coroutine.
+        self._wakeup = None
+
+        # The asyncio server accepting new connections (or None if not yet
+        # listening).
+        self._listener = None
+
+        super(AsyncioServer, self).__init__(*args, **kwargs)
+
+    def _notify(self):
+        """Notify the background thread that something has happened.
+
+        May be called from any thread.
+        """
+        try:
+            self._loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            # The event loop has already been shut down
+            pass
+
+    def _wake(self):
+        """Wake the main server coroutine. Must be called from the event
+        loop.
+        """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _listen(self, ip, port):
+        """Create the server socket and start listening for connections.
+
+        The socket is bound immediately (so that errors are reported to the
+        caller) but connections are only accepted once the event loop is
+        running.
+        """
+        self._server_socket = _create_server_socket(ip, port)
+        if self._loop.is_running():
+            self._loop.create_task(self._serve(self._server_socket))
+
+    async def _serve(self, server_socket):
+        """Start accepting connections on the given server socket."""
+        if server_socket is not self._server_socket:  # pragma: no cover
+            # The socket was replaced before we got chance to use it
+            return
+        self._listener = await asyncio.start_server(
+            self._handle_connection, sock=server_socket)
+
+    def _close(self):
+        """Close the server socket and disconnect all client connections."""
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if self._server_socket is not None:
+            self._server_socket.close()
+        for client in list(itervalues(self._client_sockets)):
+            self._disconnect_client(client)
+
+    def _disconnect_client(self, client):
+        """Disconnect a client.
+
+        Parameters
+        ----------
+        client : :py:class:`._Connection`
+        """
+        logging.info("Client %s disconnected.", client.getpeername())
+
+        # Remove from the client list (taking care not to remove a newer client
+        # which has since been given the same file number)
+        if self._client_sockets.get(client.fileno()) is client:
+            del self._client_sockets[client.fileno()]
+
+        # Clear any watches
+        self._client_job_watches.pop(client, None)
+        self._client_job_state_watches.pop(client, None)
+        self._client_machine_watches.pop(client, None)
+        self._client_protocols.pop(client, None)
+
+        # Disconnect the client (once any buffered data has been sent)
+        client.close()
+
+    def _msg_client(self, client, message):
+        """Queue a message to be sent to a client.
+
+        Parameters
+        ----------
+        client : :py:class:`._Connection`
+            The client that we are sending a message to.
+        message :
+            The object or array to send. Will be converted to JSON.
+        """
+        if client.is_closing():
+            self._disconnect_client(client)
+            raise IOError("Client {} has disconnected.".format(
+                client.getpeername()))
+        client.send(self._encode_message(client, message))
+
+        # Messages sent while the client is throttled (e.g. notifications)
+        # are still buffered: disconnect clients which never catch up.
+        if (client.get_write_buffer_size() >
+                self._configuration.max_client_output_buffer):
+            logging.warning("Client %s is not reading its messages, "
+                            "disconnecting.", client.getpeername())
+            client.abort()
+            self._disconnect_client(client)
+            raise OutputBufferFullError("Client output buffer full.")
+
+    async def _handle_connection(self, reader, writer):
+        """Handle commands from a newly connected client until it
+        disconnects.
+        """
+        client = _Connection(reader, writer)
+        peer = client.getpeername()
+        logging.info("New client connected from %s", peer)
+        self._client_sockets[client.fileno()] = client
+        self._client_protocols[client] = DEFAULT_PROTOCOL
+
+        buffer = bytearray()
+        start = 0
+        try:
+            while not self._stop:
+                # Find the next complete command using the client's current
+                # protocol (which any command may change)
+                try:
+                    line, end = self._client_protocols[client].read_frame(
+                        buffer, start,
+                        self._configuration.max_command_length)
+                except FrameTooLongError:
+                    logging.warning(
+                        "Client %s sent an over-long command, disconnecting",
+                        peer)
+                    break
+                if line is None:
+                    # Discard the commands already handled and read some more
+                    del buffer[:start]
+                    start = 0
+                    try:
+                        data = await reader.read(MAX_BUFFER_SIZE)
+                    except (OSError, IOError):
+                        # Connection reset
+                        break
+
+                    # Did the client disconnect? (Note that any incomplete
+                    # command is discarded.)
+                    if len(data) == 0:
+                        break
+                    buffer += data
+                    continue
+                start = end
+
+                # Note that we skip blank lines
+                if len(line) == 0:
+                    continue
+
+                try:
+                    self._msg_client(
+                        client, _reply(self._handle_command(client, line)))
+                except OutputBufferFullError:
+                    # The client has already been disconnected for not
+                    # reading its replies
+                    break
+                except Exception:
+                    # If any of the above fails for any reason (e.g. invalid
+                    # JSON, unrecognised command, command crashes, etc.), just
+                    # disconnect the client.
+                    logging.exception(
+                        "Client %s sent bad command %r, disconnecting",
+                        peer, line)
+                    break
+
+                # Send out any notifications resulting from the command
+                self._wake()
+
+                # Don't read any further commands while the client is not
+                # reading its replies.
+                try:
+                    await writer.drain()
+                except (OSError, IOError):
+                    break
+        finally:
+            if not client.is_closing():
+                self._disconnect_client(client)
+
+    async def _main(self):
+        """The main server coroutine.
+
+        This coroutine calls destroy_timed_out_jobs on the controller
+        whenever the next job timeout is reached and, when woken by
+        :py:meth:`._notify` or a client's command, sends out change
+        notifications and rereads the config file if required.
+        """
+        self._wakeup = asyncio.Event()
+        await self._serve(self._server_socket)
+
+        while not self._stop:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self._get_timeout())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            # Cull any jobs which have timed out
+            self._destroy_timed_out_jobs()
+
+            # Send any job/machine change notifications out
+            self._send_change_notifications()
+
+            # Config file changed, re-read it
+            if self._reload_config:
+                if not self._read_config_file():
+                    logging.warning("failed to reread configuration file")
+
+        # Close all connections and wait for the connection handlers to exit
+        self._close()
+        current = asyncio.current_task()
+        handlers = [task for task in asyncio.all_tasks()
+                    if task is not current]
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    def _run(self):
+        """The main server thread, runs the event loop until the server is
+        stopped.
+        """
+        logging.info("Server running.")
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._main())
+        finally:
+            self._loop.close()
@@ -102,11 +102,13 @@ from itertools import chain
 from six import iteritems, itervalues
 
 from spalloc_server.coordinates import chip_to_board
+from spalloc_server.allocator import PACKERS
 
 
 class Configuration(namedtuple("Configuration",
                                "machines,port,ip,timeout_check_interval,"
-                               "max_retired_jobs")):
+                               "max_retired_jobs,max_client_output_buffer,"
+                               "max_command_length,max_bmp_workers")):
     """Defines the configuration of a server.
 
     Parameters
@@ -119,15 +121,35 @@ class Configuration(namedtuple("Configuration",
     ip : str
         The IP the server should listen on. (Default: "", i.e. all interfaces)
     timeout_check_interval : float
-        The number of seconds between the server's checks for job timeouts.
-        (Default: 5.0)
+        The maximum number of seconds between the server's checks for job
+        timeouts. Jobs are normally destroyed as soon as their keepalive
+        expires, regardless of this value. (Default: 5.0)
     max_retired_jobs : int
         The number of retired jobs to keep records of. (Default: 1200)
+    max_client_output_buffer : int
+        The maximum number of bytes of replies and notifications which may be
+        waiting to be sent to a client. Clients which do not read from their
+        connection quickly enough to stay below this limit are disconnected.
+        (Default: 8 MiB)
+    max_command_length : int
+        The maximum length, in bytes, of a single command sent by a client
+        (i.e. a line of JSON or a frame of a binary protocol). Clients which
+        send longer commands are disconnected. (Default: 1 MiB)
+    max_bmp_workers : int
+        The maximum number of threads used to communicate with BMPs, i.e. the
+        number of BMPs which may be communicated with at once. Must be at
+        least 1. (Default: 8)
     """
 
     def __new__(cls, machines=[], port=22244, ip="",
                 timeout_check_interval=5.0,
-                max_retired_jobs=1200):
+                max_retired_jobs=1200,
+                max_client_output_buffer=8 * 1024 * 1024,
+                max_command_length=1024 * 1024,
+                max_bmp_workers=8):
+        if max_bmp_workers < 1:
+            raise ValueError("max_bmp_workers must be at least 1.")
+
         # Validate machine definitions
         used_names = set()
         used_bmp_ips = set()
@@ -159,13 +181,16 @@ class Configuration(namedtuple("Configuration",
 
         return super(Configuration, cls).__new__(cls, machines, port, ip,
                                                  timeout_check_interval,
-                                                 max_retired_jobs)
+                                                 max_retired_jobs,
+                                                 max_client_output_buffer,
+                                                 max_command_length,
+                                                 max_bmp_workers)
 
 
 class Machine(namedtuple("Machine", "name,tags,width,height,"
                                     "dead_boards,dead_links,"
                                     "board_locations,"
-                                    "bmp_ips,spinnaker_ips")):
+                                    "bmp_ips,spinnaker_ips,packer")):
     """Defines a SpiNNaker machine.
 
     Parameters
@@ -195,6 +220,18 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
     spinnaker_ips : {(x, y, z): hostname, ...}
         For every working board gives the IP address of the SpiNNaker board's
         Ethernet connected chip.
+    packer : str
+        The 2D packing algorithm used to allocate boards in the machine. One
+        of "pack_tree" (the default, a simple guillotine-cut packer) or
+        "max_rects" (a maximal rectangles packer which is better at making
+        use of fragmented free space).
+
+    Attributes
+    ----------
+    boards_by_location : {(c, f, b): (x, y, z), ...}
+        The reverse of board_locations: the board coordinate of the board at
+        each physical location. Computed when the :py:class:`.Machine` is
+        constructed.
     """
 
     def __new__(cls, name, tags=set(["default"]),
@@ -202,7 +239,8 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
                 dead_boards=set(), dead_links=set(),
                 board_locations={},
                 bmp_ips={},
-                spinnaker_ips={}):
+                spinnaker_ips={},
+                packer="pack_tree"):
 
         # Make sure the set-type arguments are the correct type...
         if not isinstance(tags, set):
@@ -237,7 +275,7 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
                                  "outside system.".format(x, y, z))
 
         # All board locations must be sensible
-        locations = set()
+        boards_by_location = {}
         for (x, y, z), (c, f, b) in iteritems(board_locations):
             # Board should be within system
             if not (0 <= x < width and
@@ -246,10 +284,10 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
                 raise ValueError("Board location given for board "
                                  "not in system ({}, {}, {}).".format(x, y, z))
             # No two boards should be in the same location
-            if (c, f, b) in locations:
+            if (c, f, b) in boards_by_location:
                 raise ValueError("Multiple boards given location "
                                  "c:{}, f:{}, b:{}.".format(c, f, b))
-            locations.add((c, f, b))
+            boards_by_location[(c, f, b)] = (x, y, z)
 
         # All boards must have their locations specified, unless they are
         # dead (in which case this is optional)
@@ -264,7 +302,7 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
                 "Board locations missing for {}".format(missing_boards))
 
         # BMP IPs should be given for all frames which have been used
-        frames = set((c, f) for c, f, b in locations)
+        frames = set((c, f) for c, f, b in boards_by_location)
         missing_bmp_ips = frames - set(bmp_ips)
         if missing_bmp_ips:
             raise ValueError(
@@ -276,14 +314,26 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
             raise ValueError(
                 "SpiNNaker IPs not given for boards {}".format(missing_ips))
 
-        return super(Machine, cls).__new__(cls, name, tags, width, height,
+        # The packing algorithm must exist
+        if packer not in PACKERS:
+            raise ValueError("Unknown packer '{}'.".format(packer))
+
+        self = super(Machine, cls).__new__(cls, name, tags, width, height,
                                            dead_boards, dead_links,
                                            board_locations,
-                                           bmp_ips, spinnaker_ips)
+                                           bmp_ips, spinnaker_ips, packer)
+        self.boards_by_location = boards_by_location
+        return self
+
+    @classmethod
+    def _make(cls, iterable):
+        # Construct via __new__ (rather than the namedtuple default) so that
+        # boards_by_location is also computed for copies made by _replace.
+        return cls(*iterable)
 
     @classmethod
     def single_board(cls, name, tags=set(["default"]),
-                     bmp_ip=None, spinnaker_ip=None):
+                     bmp_ip=None, spinnaker_ip=None, packer="pack_tree"):
         """Convenience constructor. Construct a :py:class:`.Machine`
         representing a single SpiNNaker board.
 
@@ -297,6 +347,8 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
             The hostname of the BMP controlling the board.
         spinnaker_ip : str
             The hostname of the SpiNNaker board.
+        packer : str
+            The 2D packing algorithm to use (see :py:class:`.Machine`).
         """
         if bmp_ip is None:
             raise TypeError("bmp_ip must be given.")
@@ -307,7 +359,8 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
                    dead_boards=set([(0, 0, 1), (0, 0, 2)]), dead_links=set(),
                    board_locations={(0, 0, 0): (0, 0, 0)},
                    bmp_ips={(0, 0): bmp_ip},
-                   spinnaker_ips={(0, 0, 0): spinnaker_ip})
+                   spinnaker_ips={(0, 0, 0): spinnaker_ip},
+                   packer=packer)
 
     @classmethod
     def with_standard_ips(cls, name, tags=set(["default"]),
@@ -319,7 +372,8 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
                           frame_stride="0.0.1.0",
                           board_stride="0.0.0.8",
                           bmp_offset="0.0.0.0",
-                          spinnaker_offset="0.0.0.1"):
+                          spinnaker_offset="0.0.0.1",
+                          packer="pack_tree"):
         """Convenience constructor. Construct a :py:class:`.Machine` which
         infers IP addresses of the form conventionally used by SpiNNaker
         installations.
@@ -402,6 +456,8 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
             The offset of a board's Ethernet-connected SpiNNaker chip IP from
             the start of a board's IP address range, expressed as an IPv4
             address.
+        packer : str
+            The 2D packing algorithm to use (see :py:class:`.Machine`).
         """
 
         def ip_to_int(ip):
@@ -452,7 +508,8 @@ class Machine(namedtuple("Machine", "name,tags,width,height,"
         return cls(name, tags, width, height,
                    dead_boards=dead_boards, dead_links=dead_links,
                    board_locations=board_locations,
-                   bmp_ips=bmp_ips, spinnaker_ips=spinnaker_ips)
+                   bmp_ips=bmp_ips, spinnaker_ips=spinnaker_ips,
+                   packer=packer)
 
 
 def board_locations_from_spinner(filename):
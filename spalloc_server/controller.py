@@ -4,12 +4,16 @@ managing hardware in a collection of SpiNNaker machines.
 
 import threading
 
+import heapq
+
 from enum import IntEnum
 
 from collections import namedtuple, OrderedDict, defaultdict
 
 from functools import partial
 
+from operator import attrgetter
+
 from six import itervalues, iteritems
 
 import time
@@ -20,10 +24,14 @@ from pytz import utc
 
 from rig.geometry import spinn5_chip_coord
 
+import numpy as np
+
 from spalloc_server.coordinates import \
-    board_to_chip, chip_to_board, triad_dimensions_to_chips, WrapAround
+    board_to_chip, chip_to_board, boards_to_chips, chips_to_boards, \
+    triad_dimensions_to_chips, WrapAround
 from spalloc_server.job_queue import JobQueue
-from spalloc_server.async_bmp_controller import AsyncBMPController
+from spalloc_server.async_bmp_controller import \
+    AsyncBMPController, BMPEngine
 
 
 class Controller(object):
@@ -67,14 +75,30 @@ class Controller(object):
 
     Users should, at a regular interval call :py:meth:`.destroy_timed_out_jobs`
     in order to destroy any queued or running jobs which have not been kept
-    alive recently enough.
-
-    Unless otherwise indicated, all methods are thread safe.
+    alive recently enough. The :py:attr:`.next_timeout` property gives the
+    earliest time at which this call may have any effect.
+
+    Unless otherwise indicated, all methods are thread safe. When used as a
+    context manager, the controller's lock is held for the duration of the
+    block so that a sequence of method calls is executed atomically (e.g.
+    without background state changes occurring in between).
+
+    Methods which only query the state of jobs and machines (e.g.
+    :py:meth:`.get_job_state`, :py:meth:`.list_jobs` and
+    :py:meth:`.where_is`) do not take the lock. Instead, they read immutable
+    snapshots of the jobs and machines which are replaced (while the lock is
+    held) whenever a job or machine changes. As a result, these queries never
+    wait for job scheduling, allocation or BMP completion handling in other
+    threads.
 
     Attributes
     ----------
     max_retired_jobs : int
         Maximum number of retired jobs to retain the state of.
+    max_bmp_workers : int
+        The maximum number of threads used to communicate with BMPs (i.e. the
+        number of BMPs which may be communicated with at once), however many
+        BMPs the machines have. Must be at least 1.
     machines : {name: \
             :py:class:`~spalloc_server.configuration.Machine`, ...} \
             or similar OrderedDict
@@ -95,12 +119,38 @@ class Controller(object):
         The callback function *must not* call any methods of the controller
         object.
 
+        Note that this attribute is not pickled and unpicking a controller sets
+        this attribute to None.
+    on_bmp_request_complete : function(job_id, seq, success) or None
+        A function which is called (from any thread) whenever a BMP request
+        issued on behalf of a job completes, before the completion is
+        processed. This may be used, for example, to record BMP activity for
+        later replay (see :py:mod:`spalloc_server.trace`). Each request is
+        identified by a sequence number, allocated in the order the requests
+        were issued (starting from zero for a new controller), since requests
+        to different BMPs may complete in any order.
+
+        The callback function *must not* call any methods of the controller
+        object.
+
+        Note that this attribute is not pickled and unpicking a controller sets
+        this attribute to None.
+    on_jobs_timed_out : function([job_id, ...]) or None
+        A function which is called by :py:meth:`.destroy_timed_out_jobs` with
+        the IDs of the jobs which have timed out, before they are destroyed
+        (and so before any BMP requests are issued to power them down). The
+        controller's lock is held during the call.
+
+        The callback function *must not* call any methods of the controller
+        object.
+
         Note that this attribute is not pickled and unpicking a controller sets
         this attribute to None.
     """
 
     def __init__(self, next_id=1, max_retired_jobs=1200,
-                 on_background_state_change=None):
+                 on_background_state_change=None,
+                 bmp_controller_factory=None, max_bmp_workers=8):
         """
         Parameters
         ----------
@@ -110,11 +160,22 @@ class Controller(object):
             See attribute of same name.
         on_background_state_change : function, optional
             See attribute of same name.
+        bmp_controller_factory : function(hostname, on_thread_start) or None
+            If not None, a function which will be used in place of
+            :py:class:`~spalloc_server.async_bmp_controller.AsyncBMPController`
+            to create the controllers for each BMP, e.g. to replay a trace
+            without communicating with real hardware. This argument is not
+            pickled.
+        max_bmp_workers : int, optional
+            See attribute of same name.
         """
         # The next job ID to assign
         self._next_id = next_id
 
         self._on_background_state_change = on_background_state_change
+        self._on_bmp_request_complete = None
+        self._on_jobs_timed_out = None
+        self._bmp_controller_factory = bmp_controller_factory
 
         # The job queue which manages the scheduling and
         # allocation of all jobs.
@@ -138,10 +199,55 @@ class Controller(object):
         self._max_retired_jobs = max_retired_jobs
         self._retired_jobs = OrderedDict()
 
+        # A min-heap of the times at which jobs with a keepalive may time out.
+        # Entries are invalidated lazily: keeping a job alive does not update
+        # its entry and entries for destroyed jobs are not removed. Instead,
+        # entries are checked against the job when they reach the top of the
+        # heap. Every live job with a keepalive has exactly one entry, which is
+        # no later than its keepalive_until time.
+        # [(keepalive_until, job_id), ...]
+        self._keepalive_heap = []
+
+        # Immutable snapshots of the jobs used to answer queries without
+        # taking the lock. Whenever a job changes, its entry is replaced (see
+        # _mark_jobs_changed). Since setting or deleting a single item is
+        # atomic, readers only ever see a complete snapshot of each job but
+        # must not iterate over the dictionary while it may be modified (copy
+        # its values first).
+        # {id: _JobSnapshot, ...}
+        self._job_snapshots = {}
+        # A snapshot of the machines, replaced whenever the machines change
+        # (see _publish_machines).
+        # {name: Machine, ...} (in the same order as _machines)
+        self._machine_snapshots = OrderedDict()
+        # Index of the job allocated to each board of each machine. Like the
+        # job snapshots, entries are set and deleted individually whenever a
+        # job's allocation changes.
+        # {machine_name: {(x, y, z): job_id, ...}, ...}
+        self._board_jobs = {}
+
+        # The power state most recently requested for each board, along with
+        # the sequence number of the request. Boards whose state is unknown
+        # (e.g. never set, or the latest request failed) are absent. Since
+        # each BMP carries out requests in order, the hardware will reach
+        # these states once all outstanding requests complete.
+        # {machine_name: {(x, y, z): (power, seq), ...}, ...}
+        self._board_power = {}
+
+        # The sequence number to give the next BMP request
+        self._next_bmp_request_seq = 0
+
         # Underlying sets containing changed jobs and machines
         self._changed_jobs = set()
         self._changed_machines = set()
 
+        # Counters incremented whenever any job or machine changes
+        self._jobs_version = 0
+        self._machines_version = 0
+
+        # Counter incremented whenever the published list of machines changes
+        self._machine_list_version = 0
+
         # All the attributes set below are "dynamic state" and cannot be
         # pickled. They are initialised by calling to _init_dynamic_state and
         # cleared by calling _del_dynamic_state.
@@ -153,6 +259,12 @@ class Controller(object):
         # {machine_name: {(c, f): AsyncBMPController, ...}, ...}
         self._bmp_controllers = None
 
+        # The maximum number of threads used to communicate with BMPs.
+        self._max_bmp_workers = max_bmp_workers
+
+        # The pool of worker threads shared by all AsyncBMPControllers.
+        self._bmp_engine = None
+
         self._init_dynamic_state()
 
     def __getstate__(self):
@@ -165,9 +277,13 @@ class Controller(object):
 
         # Do not keep the reference to any state-change callbacks
         state["_on_background_state_change"] = None
+        state["_on_bmp_request_complete"] = None
+        state["_on_jobs_timed_out"] = None
+        state["_bmp_controller_factory"] = None
 
         # Do not keep references to unpickleable dynamic state
         state["_bmp_controllers"] = None
+        state["_bmp_engine"] = None
         state["_lock"] = None
 
         return state
@@ -178,6 +294,15 @@ class Controller(object):
         Note that though the object must be pickled when stopped, the unpickled
         object will start running immediately.
         """
+        # Attributes which are never pickled may be missing from the state
+        # saved by older versions.
+        state = dict(state)
+        state.setdefault("_on_bmp_request_complete", None)
+        state.setdefault("_on_jobs_timed_out", None)
+        state.setdefault("_bmp_controller_factory", None)
+        state.setdefault("_bmp_engine", None)
+        state.setdefault("_max_bmp_workers", 8)
+
         self.__dict__.update(state)
 
         # Restore callback function pointers in JobQueue (removed by JobQueue
@@ -189,6 +314,13 @@ class Controller(object):
 
         self._init_dynamic_state()
 
+    def __enter__(self):
+        """When used as a context manager, make method calls 'atomic'."""
+        self._lock.acquire()
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        self._lock.release()
+
     def stop(self):
         """Request that all background threads stop.
 
@@ -212,11 +344,15 @@ class Controller(object):
         """Block until all background threads have halted and all queued BMP
         commands completed.
         """
-        # Wait for the BMP controller threads
+        # Wait for the BMP controllers
         for controllers in itervalues(self._bmp_controllers):
             for controller in itervalues(controllers):
                 controller.join()
 
+        # Shut down the threads which carried out their commands
+        self._bmp_engine.stop()
+        self._bmp_engine.join()
+
     @property
     def on_background_state_change(self):
         with self._lock:
@@ -227,6 +363,37 @@ class Controller(object):
         with self._lock:
             self._on_background_state_change = value
 
+    @property
+    def on_bmp_request_complete(self):
+        with self._lock:
+            return self._on_bmp_request_complete
+
+    @on_bmp_request_complete.setter
+    def on_bmp_request_complete(self, value):
+        with self._lock:
+            self._on_bmp_request_complete = value
+
+    @property
+    def on_jobs_timed_out(self):
+        with self._lock:
+            return self._on_jobs_timed_out
+
+    @on_jobs_timed_out.setter
+    def on_jobs_timed_out(self, value):
+        with self._lock:
+            self._on_jobs_timed_out = value
+
+    @property
+    def max_bmp_workers(self):
+        with self._lock:
+            return self._max_bmp_workers
+
+    @max_bmp_workers.setter
+    def max_bmp_workers(self, value):
+        with self._lock:
+            self._bmp_engine.num_workers = value
+            self._max_bmp_workers = value
+
     @property
     def max_retired_jobs(self):
         with self._lock:
@@ -241,8 +408,7 @@ class Controller(object):
 
     @property
     def machines(self):
-        with self._lock:
-            return self._machines.copy()
+        return self._machine_snapshots.copy()
 
     @machines.setter
     def machines(self, machines):
@@ -250,8 +416,8 @@ class Controller(object):
 
         Attempt to update the information about available machines without
         destroying jobs where possible. Machines are matched with existing
-        machines by name and are only recreated if dimensions or connectivity
-        information is altered.
+        machines by name and are only recreated if dimensions, connectivity
+        information or packing algorithm is altered.
 
         Note that changing the tags, set of dead boards or set of dead links
         does not destroy any already-allocated jobs but will influence new
@@ -292,7 +458,8 @@ class Controller(object):
                       old.height != new.height or
                       old.board_locations != new.board_locations or
                       old.bmp_ips != new.bmp_ips or
-                      old.spinnaker_ips != new.spinnaker_ips):
+                      old.spinnaker_ips != new.spinnaker_ips or
+                      old.packer != new.packer):
                     # Machine has changed in a major way, recreate it
                     changed.remove(name)
                     removed.add(name)
@@ -310,6 +477,7 @@ class Controller(object):
 
                     # Remove the board and its BMP connections
                     old = self._machines.pop(name)
+                    self._board_power.pop(name, None)
                     shut_down_controllers.extend(
                         itervalues(self._bmp_controllers.pop(name)))
 
@@ -344,7 +512,8 @@ class Controller(object):
                                                 height=new.height,
                                                 tags=new.tags,
                                                 dead_boards=new.dead_boards,
-                                                dead_links=new.dead_links)
+                                                dead_links=new.dead_links,
+                                                packer=new.packer)
 
                 # Re-order machines to match the specification
                 for name in machines:
@@ -355,9 +524,106 @@ class Controller(object):
                     self._job_queue.move_machine_to_end(name)
 
             # Mark all effected machines as changed
-            self._changed_machines.update(added)
-            self._changed_machines.update(changed)
-            self._changed_machines.update(removed)
+            self._publish_machines()
+            self._mark_machines_changed(added | changed | removed)
+
+    def _mark_jobs_changed(self, job_ids):
+        """Record that the specified jobs have changed and publish new
+        snapshots of them (or remove their snapshots if the jobs no longer
+        exist).
+
+        Must be called with the lock held, after the changes have been made.
+        """
+        snapshots = self._job_snapshots
+        for job_id in job_ids:
+            # Each job is published before its boards are indexed so that a
+            # job found via the index always has a snapshot describing its
+            # boards (unless it has since been destroyed).
+            old = snapshots.get(job_id)
+            job = self._jobs.get(job_id)
+            if job is not None:
+                new = snapshots[job_id] = job.snapshot()
+            else:
+                new = None
+                snapshots.pop(job_id, None)
+
+            # Update the board index when boards are allocated or freed
+            old_boards = (old.allocated_machine_name, old.boards) \
+                if old is not None else (None, None)
+            new_boards = (new.allocated_machine_name, new.boards) \
+                if new is not None else (None, None)
+            if old_boards != new_boards:
+                self._index_boards(job_id, *old_boards, allocate=False)
+                self._index_boards(job_id, *new_boards)
+
+        # NB: The version is changed only once the new snapshots are
+        # published so that anything cached against the new version reflects
+        # the change.
+        self._changed_jobs.update(job_ids)
+        self._jobs_version += 1
+
+    def _index_boards(self, job_id, machine_name, boards, allocate=True):
+        """Add (or remove, if allocate is False) a job's boards to (from)
+        :py:attr:`._board_jobs`.
+
+        Must be called with the lock held.
+        """
+        if machine_name is None or boards is None:
+            return
+        index = self._board_jobs.setdefault(machine_name, {})
+        for xyz in boards:
+            if allocate:
+                index[xyz] = job_id
+            elif index.get(xyz) == job_id:
+                del index[xyz]
+
+    def _publish_machines(self):
+        """Publish a new snapshot of the machines.
+
+        Must be called with the lock held.
+        """
+        if (list(iteritems(self._machines)) !=
+                list(iteritems(self._machine_snapshots))):
+            self._machine_snapshots = self._machines.copy()
+            self._machine_list_version += 1
+
+    def _mark_machines_changed(self, machine_names):
+        """Record that the specified machines have changed.
+
+        Must be called with the lock held.
+        """
+        if machine_names:
+            self._changed_machines.update(machine_names)
+            self._machines_version += 1
+
+    @property
+    def jobs_version(self):
+        """A counter which is incremented whenever any job changes (i.e.
+        whenever a job is added to :py:attr:`.changed_jobs`).
+
+        Unlike :py:attr:`.changed_jobs`, reading this value has no side
+        effects making it suitable for invalidating cached copies of the
+        values returned by :py:meth:`.list_jobs`.
+        """
+        return self._jobs_version
+
+    @property
+    def machines_version(self):
+        """A counter which is incremented whenever any machine changes (i.e.
+        whenever a machine is added to :py:attr:`.changed_machines`).
+        """
+        return self._machines_version
+
+    @property
+    def machine_list_version(self):
+        """A counter which is incremented whenever the machines' definitions
+        or their order change.
+
+        Unlike :py:attr:`.machines_version`, this is not changed when jobs
+        are allocated or freed, making it suitable for invalidating cached
+        copies of the values returned by :py:meth:`.list_machines`.
+        """
+        return self._machine_list_version
 
     @property
     def changed_jobs(self):
@@ -416,7 +682,13 @@ class Controller(object):
             self._jobs[job_id] = job
             self._job_queue.create_job(*args, **kwargs)
 
-            self._changed_jobs.add(job_id)
+            # Schedule the job's timeout (unless it has already been
+            # cancelled)
+            if job.keepalive is not None and job_id in self._jobs:
+                heapq.heappush(self._keepalive_heap,
+                               (job.keepalive_until, job_id))
+
+            self._mark_jobs_changed([job_id])
 
             return job_id
 
@@ -424,11 +696,14 @@ class Controller(object):
         """Reset the keepalive timer for the specified job.
 
         Note all other job-specific functions implicitly call this method.
+
+        This method does not take the lock: the keepalive time is a single
+        attribute which is only ever read by :py:meth:`.destroy_timed_out_jobs`
+        (see :py:attr:`._keepalive_heap`).
         """
-        with self._lock:
-            job = self._jobs.get(job_id, None)
-            if job is not None and job.keepalive is not None:
-                job.keepalive_until = time.time() + job.keepalive
+        job = self._jobs.get(job_id, None)
+        if job is not None and job.keepalive is not None:
+            job.keepalive_until = time.time() + job.keepalive
 
     def get_job_state(self, job_id):
         """Poll the state of a running job.
@@ -437,33 +712,33 @@ class Controller(object):
         -------
         :py:class:`.JobStateTuple`
         """
-        with self._lock:
-            self.job_keepalive(job_id)
-
-            job = self._jobs.get(job_id)
-            if job is not None:
-                # Job is live
-                state = job.state
-                power = job.power
-                keepalive = job.keepalive
-                reason = None
-                start_time = job.start_time
-            elif job_id in self._retired_jobs:
+        self.job_keepalive(job_id)
+
+        # NB: Jobs are retired before their snapshot is removed so checking
+        # for a snapshot first guarantees a destroyed job is never reported
+        # as unknown.
+        job = self._job_snapshots.get(job_id)
+        if job is not None:
+            # Job is live
+            state = job.state
+            power = job.power
+            keepalive = job.keepalive
+            reason = None
+            start_time = job.start_time
+        else:
+            reason = self._retired_jobs.get(job_id, _NOT_RETIRED)
+            if reason is not _NOT_RETIRED:
                 # Job has been destroyed at some point
                 state = JobState.destroyed
-                power = None
-                keepalive = None
-                reason = self._retired_jobs[job_id]
-                start_time = None
             else:
                 # Job ID not recognised
                 state = JobState.unknown
-                power = None
-                keepalive = None
                 reason = None
-                start_time = None
+            power = None
+            keepalive = None
+            start_time = None
 
-            return JobStateTuple(state, power, keepalive, reason, start_time)
+        return JobStateTuple(state, power, keepalive, reason, start_time)
 
     def get_job_machine_info(self, job_id):
         """Get information about the machine the job has been allocated.
@@ -472,19 +747,57 @@ class Controller(object):
         -------
         :py:class:`.JobMachineInfoTuple`
         """
-        with self._lock:
-            self.job_keepalive(job_id)
+        self.job_keepalive(job_id)
+
+        job = self._job_snapshots.get(job_id, None)
+        if job is not None and job.boards is not None:
+            return JobMachineInfoTuple(
+                job.width, job.height,
+                job.connections,
+                job.allocated_machine_name,
+                job.boards)
+        else:
+            # Job doesn't exist or no boards allocated yet
+            return JobMachineInfoTuple(None, None, None, None, None)
 
-            job = self._jobs.get(job_id, None)
-            if job is not None and job.boards is not None:
-                return JobMachineInfoTuple(
-                    job.width, job.height,
-                    job.connections,
-                    job.allocated_machine.name,
-                    job.boards)
+    def get_job_changes(self, job_ids):
+        """Describe the current state of several jobs, e.g. to report how
+        they have changed.
+
+        Unlike :py:meth:`.get_job_state`, this method does not count as a
+        query of the jobs: their keepalive timers are not reset.
+
+        Parameters
+        ----------
+        job_ids : iterable
+            The IDs of the jobs to describe.
+
+        Returns
+        -------
+        [:py:class:`.JobChangeTuple`, ...]
+            The state of each job, in the order given.
+        """
+        snapshots = self._job_snapshots
+        out = []
+        for job_id in job_ids:
+            job = snapshots.get(job_id)
+            if job is not None:
+                # Job is live
+                out.append(JobChangeTuple(job_id, job.state, job.power,
+                                          None, job.allocated_machine_name,
+                                          job.boards))
+                continue
+
+            reason = self._retired_jobs.get(job_id, _NOT_RETIRED)
+            if reason is not _NOT_RETIRED:
+                # Job has been destroyed at some point
+                out.append(JobChangeTuple(job_id, JobState.destroyed,
+                                          None, reason, None, None))
             else:
-                # Job doesn't exist or no boards allocated yet
-                return JobMachineInfoTuple(None, None, None, None, None)
+                # Job ID not recognised
+                out.append(JobChangeTuple(job_id, JobState.unknown,
+                                          None, None, None, None))
+        return out
 
     def power_on_job_boards(self, job_id):
         """Power on (or reset if already on) boards associated with a job."""
@@ -536,24 +849,17 @@ class Controller(object):
             A list of allocated/queued jobs in order of creation from oldest
             (first) to newest (last).
         """
-        with self._lock:
-            job_list = []
-            for job in itervalues(self._jobs):
-                # Strip "job_id" which is only used internally
-                kwargs = {k: v for k, v in iteritems(job.kwargs)
-                          if k != "job_id"}
-
-                # Machine may not exist
-                allocated_machine_name = None
-                if job.allocated_machine is not None:
-                    allocated_machine_name = job.allocated_machine.name
-
-                job_list.append(JobTuple(
-                    job.id, job.owner, job.start_time, job.keepalive,
-                    job.state, job.power, job.args, kwargs,
-                    allocated_machine_name, job.boards))
-
-            return job_list
+        # NB: Copying the values is atomic while iterating over the
+        # dictionary is not. Since job IDs are allocated in increasing order,
+        # sorting by ID gives the order of creation.
+        jobs = sorted(list(self._job_snapshots.values()),
+                      key=attrgetter("id"))
+        # The snapshots' kwargs are copied since the snapshots are shared
+        # with other (lock-free) readers and must not be modified.
+        return [JobTuple(job.id, job.owner, job.start_time, job.keepalive,
+                         job.state, job.power, job.args, dict(job.kwargs),
+                         job.allocated_machine_name, job.boards)
+                for job in jobs]
 
     def list_machines(self):
         """Enumerates all machines known to the system.
@@ -564,13 +870,12 @@ class Controller(object):
             The list of machines known to the system in order of priority from
             highest (first) to lowest (last).
         """
-        with self._lock:
-            return [
-                MachineTuple(machine.name, machine.tags,
-                             machine.width, machine.height,
-                             machine.dead_boards, machine.dead_links)
-                for machine in itervalues(self._machines)
-            ]
+        return [
+            MachineTuple(machine.name, machine.tags,
+                         machine.width, machine.height,
+                         machine.dead_boards, machine.dead_links)
+            for machine in itervalues(self._machine_snapshots)
+        ]
 
     def get_board_position(self, machine_name, x, y, z):
         """Get the physical location of a specified board.
@@ -588,11 +893,10 @@ class Controller(object):
             The physical location of the board at the specified location or
             None if the machine/board are not recognised.
         """
-        with self._lock:
-            machine = self._machines.get(machine_name, None)
-            if machine is None:
-                return None
-            return machine.board_locations.get((x, y, z), None)
+        machine = self._machine_snapshots.get(machine_name, None)
+        if machine is None:
+            return None
+        return machine.board_locations.get((x, y, z), None)
 
     def get_board_at_position(self, machine_name, cabinet, frame, board):
         """Get the logical location of a board at the specified physical
@@ -611,259 +915,127 @@ class Controller(object):
             The logical location of the board at the specified location or None
             if the machine/board are not recognised.
         """
-        with self._lock:
-            machine = self._machines.get(machine_name, None)
-            if machine is None:
-                return None
-            # NB: Assuming this function is only called very rarely,
-            # constructing and maintaining a reverse lookup is not worth
-            # the trouble so instead we just search.
-            for (x, y, z), (c, f, b) in iteritems(machine.board_locations):
-                if (c, f, b) == (cabinet, frame, board):
-                    return (x, y, z)
-            else:
-                # No board found
-                return None
+        machine = self._machine_snapshots.get(machine_name, None)
+        if machine is None:
+            return None
+        return machine.boards_by_location.get((cabinet, frame, board), None)
 
     def _where_is_by_logical_triple(self, machine_name, x, y, z):
         """Helper for :py:meth:`.where_is()`"""
-        with self._lock:
-            # Get the actual Machine
-            machine = self._machines.get(machine_name, None)
-            if machine is None:
-                return None
-
-            chip_x, chip_y = board_to_chip(x, y, z)
-
-            # Compensate chip coordinates for wrap-around
-            chip_w, chip_h = triad_dimensions_to_chips(
-                machine.width, machine.height, WrapAround.both)
-            chip_x %= chip_w
-            chip_y %= chip_h
-
-            # Determine the chip within the board
-            # Workaround: spinn5_chip_coord (until at least Rig 0.13.2) returns
-            # numpy integer types which are not JSON serialiseable.
-            board_chip_x, board_chip_y = map(
-                int, spinn5_chip_coord(chip_x, chip_y))
-
-            # Determine the logical board coordinates (and compensate for
-            # wrap-around)
-            x, y, z = chip_to_board(chip_x, chip_y, chip_w, chip_h)
-
-            # Determine the board's physical location (fail if board does not
-            # exist)
-            cfb = machine.board_locations.get((x, y, z), None)
-            if cfb is None:
-                return None
-            cabinet, frame, board = cfb
-
-            # Determine what job is running on that board
-            for job_id, job in iteritems(self._jobs):
-                # NB: If machine is defined, boards must also be defined.
-                if (job.allocated_machine == machine and
-                        (x, y, z) in job.boards):
-                    break
-            else:
-                # No job is allocated to the board
-                job_id = None
-                job = None
-
-            return {
-                "machine": machine_name,
-                "logical": (x, y, z),
-                "physical": (cabinet, frame, board),
-                "chip": (chip_x, chip_y),
-                "board_chip": (board_chip_x, board_chip_y),
-                "job_id": job_id,
-                "job_chip": self._get_job_chip(job, x, y, z)
-            }
+        return self._where_is_by_chip_coordinate(machine_name,
+                                                 *board_to_chip(x, y, z))
 
     def _where_is_by_physical_triple(self, machine_name, cabinet, frame, board):
         """Helper for :py:meth:`.where_is()`"""
-        with self._lock:
-            # Get the actual Machine
-            machine = self._machines.get(machine_name, None)
-            if machine is None:
-                return None
-
-            xyz = self.get_board_at_position(machine_name, cabinet, frame, board)
-            if xyz is None:
-                return None
-            chip_x, chip_y = board_to_chip(*xyz)
-
-            # Compensate chip coordinates for wrap-around
-            chip_w, chip_h = triad_dimensions_to_chips(
-                machine.width, machine.height, WrapAround.both)
-            chip_x %= chip_w
-            chip_y %= chip_h
-
-            # Determine the chip within the board
-            # Workaround: spinn5_chip_coord (until at least Rig 0.13.2) returns
-            # numpy integer types which are not JSON serialiseable.
-            board_chip_x, board_chip_y = map(
-                int, spinn5_chip_coord(chip_x, chip_y))
-
-            # Determine the logical board coordinates (and compensate for
-            # wrap-around)
-            x, y, z = chip_to_board(chip_x, chip_y, chip_w, chip_h)
-
-            # Determine the board's physical location (fail if board does not
-            # exist)
-            cfb = machine.board_locations.get((x, y, z), None)
-            if cfb is None:
-                return None
-            cabinet, frame, board = cfb
-
-            # Determine what job is running on that board
-            for job_id, job in iteritems(self._jobs):
-                # NB: If machine is defined, boards must also be defined.
-                if (job.allocated_machine == machine and
-                        (x, y, z) in job.boards):
-                    break
-            else:
-                # No job is allocated to the board
-                job_id = None
-                job = None
-
-            return {
-                "machine": machine_name,
-                "logical": (x, y, z),
-                "physical": (cabinet, frame, board),
-                "chip": (chip_x, chip_y),
-                "board_chip": (board_chip_x, board_chip_y),
-                "job_id": job_id,
-                "job_chip": self._get_job_chip(job, x, y, z)
-            }
+        xyz = self.get_board_at_position(machine_name, cabinet, frame, board)
+        if xyz is None:
+            return None
+        return self._where_is_by_logical_triple(machine_name, *xyz)
 
     def _where_is_by_chip_coordinate(self, machine_name, chip_x, chip_y):
         """Helper for :py:meth:`.where_is()`"""
-        with self._lock:
-            # Get the actual Machine
-            machine = self._machines.get(machine_name, None)
-            if machine is None:
-                return None
-
-            # Compensate chip coordinates for wrap-around
-            chip_w, chip_h = triad_dimensions_to_chips(
-                machine.width, machine.height, WrapAround.both)
-            chip_x %= chip_w
-            chip_y %= chip_h
-
-            # Determine the chip within the board
-            # Workaround: spinn5_chip_coord (until at least Rig 0.13.2) returns
-            # numpy integer types which are not JSON serialiseable.
-            board_chip_x, board_chip_y = map(
-                int, spinn5_chip_coord(chip_x, chip_y))
-
-            # Determine the logical board coordinates (and compensate for
-            # wrap-around)
-            x, y, z = chip_to_board(chip_x, chip_y, chip_w, chip_h)
-
-            # Determine the board's physical location (fail if board does not
-            # exist)
-            cfb = machine.board_locations.get((x, y, z), None)
-            if cfb is None:
-                return None
-            cabinet, frame, board = cfb
-
-            # Determine what job is running on that board
-            for job_id, job in iteritems(self._jobs):
-                # NB: If machine is defined, boards must also be defined.
-                if (job.allocated_machine == machine and
-                        (x, y, z) in job.boards):
-                    break
-            else:
-                # No job is allocated to the board
-                job_id = None
-                job = None
-
-            return {
-                "machine": machine_name,
-                "logical": (x, y, z),
-                "physical": (cabinet, frame, board),
-                "chip": (chip_x, chip_y),
-                "board_chip": (board_chip_x, board_chip_y),
-                "job_id": job_id,
-                "job_chip": self._get_job_chip(job, x, y, z)
-            }
+        # Get the actual Machine
+        machine = self._machine_snapshots.get(machine_name, None)
+        if machine is None:
+            return None
+        return self._where_is_chip(machine, chip_x, chip_y)
 
     def _where_is_by_job_chip_coordinate(self, job_id, chip_x, chip_y):
         """Helper for :py:meth:`.where_is()`"""
-        with self._lock:
-            # Covert from job-relative chip location
-            job = self._jobs.get(job_id, None)
-            if job is None or job.boards is None:
-                return None
-            machine_name = job.allocated_machine.name
-            job_x, job_y, job_z = map(min, zip(*job.boards))
-            dx, dy = board_to_chip(job_x, job_y, job_z)
-            chip_x += dx
-            chip_y += dy
-
-            # Get the actual Machine
-            machine = self._machines.get(machine_name, None)
-            if machine is None:
-                return None
+        # Covert from job-relative chip location
+        job = self._job_snapshots.get(job_id, None)
+        if job is None or job.boards is None:
+            return None
+        job_x, job_y, job_z = map(min, zip(*job.boards))
+        dx, dy = board_to_chip(job_x, job_y, job_z)
 
-            # Compensate chip coordinates for wrap-around
-            chip_w, chip_h = triad_dimensions_to_chips(
-                machine.width, machine.height, WrapAround.both)
-            chip_x %= chip_w
-            chip_y %= chip_h
+        # Get the actual Machine
+        machine = self._machine_snapshots.get(job.allocated_machine_name, None)
+        if machine is None:
+            return None
 
-            # Determine the chip within the board
-            # Workaround: spinn5_chip_coord (until at least Rig 0.13.2) returns
-            # numpy integer types which are not JSON serialiseable.
-            board_chip_x, board_chip_y = map(
-                int, spinn5_chip_coord(chip_x, chip_y))
+        location = self._where_is_chip(machine, chip_x + dx, chip_y + dy)
 
-            # Determine the logical board coordinates (and compensate for
-            # wrap-around)
-            x, y, z = chip_to_board(chip_x, chip_y, chip_w, chip_h)
+        # Make sure the board found is actually running that job (this
+        # won't be the case, e.g. if a user specifies a board within their
+        # machine which is actually dead or allocated to a neighbouring
+        # job)
+        if location is None or location["job_id"] != job_id:
+            return None
+        return location
 
-            # Determine the board's physical location (fail if board does not
-            # exist)
-            cfb = machine.board_locations.get((x, y, z), None)
-            if cfb is None:
-                return None
-            cabinet, frame, board = cfb
-
-            # Determine what job is running on that board
-            for found_job_id, job in iteritems(self._jobs):
-                # NB: If machine is defined, boards must also be defined.
-                if (job.allocated_machine == machine and
-                        (x, y, z) in job.boards):
-                    # Found the job
-                    break
-            else:
-                # No job is allocated to the board
-                found_job_id = None
-                job = None
+    def _where_is_chip(self, machine, chip_x, chip_y):
+        """Locate a chip, given its coordinates within a whole machine.
 
-            # Make sure the board found is actually running that job (this
-            # won't be the case, e.g. if a user specifies a board within their
-            # machine which is actually dead or allocated to a neighbouring
-            # job)
-            if found_job_id != job_id:
-                return None
+        Shared by the :py:meth:`.where_is()` helpers, all of which normalise
+        their input coordinates into a machine and chip coordinate.
 
-            return {
-                "machine": machine_name,
-                "logical": (x, y, z),
-                "physical": (cabinet, frame, board),
-                "chip": (chip_x, chip_y),
-                "board_chip": (board_chip_x, board_chip_y),
-                "job_id": job_id,
-                "job_chip": self._get_job_chip(job, x, y, z)
-            }
+        Parameters
+        ----------
+        machine : :py:class:`spalloc_server.configuration.Machine`
+        chip_x, chip_y : int
+            The chip coordinates (which will be wrapped-around to fit within
+            the machine).
 
-    def _get_job_chip(self, job, x, y, z):
+        Returns
+        -------
+        {"machine": ..., ...} or None
+            The location of the chip as returned by :py:meth:`.where_is()` or
+            None if the board does not exist.
+        """
+        # Compensate chip coordinates for wrap-around
+        chip_w, chip_h = triad_dimensions_to_chips(
+            machine.width, machine.height, WrapAround.both)
+        chip_x %= chip_w
+        chip_y %= chip_h
+
+        # Determine the chip within the board
+        # Workaround: spinn5_chip_coord (until at least Rig 0.13.2) returns
+        # numpy integer types which are not JSON serialiseable.
+        board_chip_x, board_chip_y = map(
+            int, spinn5_chip_coord(chip_x, chip_y))
+
+        # Determine the logical board coordinates (and compensate for
+        # wrap-around)
+        x, y, z = chip_to_board(chip_x, chip_y, chip_w, chip_h)
+
+        # Determine the board's physical location (fail if board does not
+        # exist)
+        cfb = machine.board_locations.get((x, y, z), None)
+        if cfb is None:
+            return None
+
+        # Determine what job is running on that board (the job may have been
+        # destroyed since the index was read)
+        job_id = self._board_jobs.get(machine.name, {}).get((x, y, z), None)
+        job = self._job_snapshots.get(job_id, None)
+        if job is None:
+            job_id = None
+
+        return {
+            "machine": machine.name,
+            "logical": (x, y, z),
+            "physical": cfb,
+            "chip": (chip_x, chip_y),
+            "board_chip": (board_chip_x, board_chip_y),
+            "job_id": job_id,
+            "job_chip": self._get_job_chip(job, x, y, z,
+                                           board_chip_x, board_chip_y)
+        }
+
+    def _get_job_chip(self, job, x, y, z, board_chip_x, board_chip_y,
+                      origin=None):
+        """Get the coordinates of a chip within a job (or None if no job is
+        given).
+
+        The origin (i.e. minimum) board coordinate of the job may optionally
+        be supplied if already known.
+        """
         if job is None:
             return None
 
         # Determine the board coordinate within the job
-        job_x, job_y, job_z = map(min, zip(*job.boards))
+        job_x, job_y, job_z = origin or map(min, zip(*job.boards))
         job_x = x - job_x
         job_y = y - job_y
         job_z = z - job_z
@@ -952,17 +1124,197 @@ class Controller(object):
             raise TypeError(
                 "Invalid arguments: {}".format(", ".join(keywords)))
 
+    def where_is_many(self, **kwargs):
+        """Find out where many SpiNNaker boards or chips are located, all in
+        one call.
+
+        Accepts the same styles of query as :py:meth:`.where_is` except that
+        the coordinates (but not the machine name or job ID) are given as
+        equal-length lists, for example::
+
+            >>> where_is_many(machine=..., chip_x=[...], chip_y=[...])
+
+        All locations are resolved against the same snapshot of the jobs and
+        machines and the coordinate conversions are performed on whole arrays
+        of coordinates at once.
+
+        Returns
+        -------
+        {"machine": ..., "logical": [...], "physical": [...], \
+                "chip": [...], "board_chip": [...], "job_chip": [...], \
+                "job_id": [...]} or None
+            The fields given by :py:meth:`.where_is` in columnar form: each
+            is a list with one entry per queried location, in the order given.
+            If no board exists at a location (or, when querying by job, the
+            location is not part of the job) the entries for that location are
+            all None.
+
+            ``machine`` gives the name of the machine containing the boards.
+
+            If the machine (or job) does not exist, None is returned instead.
+
+        Raises
+        ------
+        ValueError
+            If the lists of coordinates are not all the same length.
+        """
+        job_snapshots = self._job_snapshots
+        machine_snapshots = self._machine_snapshots
+
+        keywords = set(kwargs)
+        valid = None
+        job_id = None
+        if keywords == set("machine x y z".split()):
+            machine = machine_snapshots.get(kwargs["machine"], None)
+            x, y, z = self._coordinate_arrays(kwargs, "x", "y", "z")
+            chip_x, chip_y = boards_to_chips(x, y, z)
+        elif keywords == set("machine cabinet frame board".split()):
+            machine = machine_snapshots.get(kwargs["machine"], None)
+            if machine is None:
+                return None
+            cfbs = self._coordinate_arrays(kwargs, "cabinet", "frame", "board")
+            xyzs = [machine.boards_by_location.get(cfb, None)
+                    for cfb in zip(*(a.tolist() for a in cfbs))]
+            valid = [xyz is not None for xyz in xyzs]
+            x, y, z = np.array([xyz or (0, 0, 0) for xyz in xyzs],
+                               dtype=int).reshape(-1, 3).T
+            chip_x, chip_y = boards_to_chips(x, y, z)
+        elif keywords == set("machine chip_x chip_y".split()):
+            machine = machine_snapshots.get(kwargs["machine"], None)
+            chip_x, chip_y = self._coordinate_arrays(
+                kwargs, "chip_x", "chip_y")
+        elif keywords == set("job_id chip_x chip_y".split()):
+            # Covert from job-relative chip locations
+            job_id = kwargs["job_id"]
+            job = job_snapshots.get(job_id, None)
+            if job is None or job.boards is None:
+                return None
+            machine = machine_snapshots.get(job.allocated_machine_name, None)
+            dx, dy = board_to_chip(*map(min, zip(*job.boards)))
+            chip_x, chip_y = self._coordinate_arrays(
+                kwargs, "chip_x", "chip_y")
+            chip_x = chip_x + dx
+            chip_y = chip_y + dy
+        else:
+            raise TypeError(
+                "Invalid arguments: {}".format(", ".join(keywords)))
+
+        if machine is None:
+            return None
+
+        # Compensate chip coordinates for wrap-around
+        chip_w, chip_h = triad_dimensions_to_chips(
+            machine.width, machine.height, WrapAround.both)
+        chip_x = chip_x % chip_w
+        chip_y = chip_y % chip_h
+
+        # Determine the logical board coordinates and chips within the boards
+        xs, ys, zs, board_chip_xs, board_chip_ys = chips_to_boards(
+            chip_x, chip_y, chip_w, chip_h)
+
+        # The remaining lookups are per-board
+        board_jobs = self._board_jobs.get(machine.name, {})
+        origins = {}
+        out = {"machine": machine.name, "logical": [], "physical": [],
+               "chip": [], "board_chip": [], "job_id": [], "job_chip": []}
+        columns = zip(xs.tolist(), ys.tolist(), zs.tolist(),
+                      chip_x.tolist(), chip_y.tolist(),
+                      board_chip_xs.tolist(), board_chip_ys.tolist())
+        for i, (x, y, z, cx, cy, bcx, bcy) in enumerate(columns):
+            # Determine the board's physical location (skip if board does not
+            # exist) and what job is running on that board
+            cfb = machine.board_locations.get((x, y, z), None)
+            found_job_id = board_jobs.get((x, y, z), None)
+            job = job_snapshots.get(found_job_id, None)
+            if job is None:
+                found_job_id = None
+            if (cfb is None or (valid is not None and not valid[i]) or
+                    (job_id is not None and found_job_id != job_id)):
+                for column in ("logical", "physical", "chip", "board_chip",
+                               "job_id", "job_chip"):
+                    out[column].append(None)
+                continue
+
+            if job is not None and found_job_id not in origins:
+                origins[found_job_id] = tuple(map(min, zip(*job.boards)))
+
+            out["logical"].append((x, y, z))
+            out["physical"].append(cfb)
+            out["chip"].append((cx, cy))
+            out["board_chip"].append((bcx, bcy))
+            out["job_id"].append(found_job_id)
+            out["job_chip"].append(self._get_job_chip(
+                job, x, y, z, bcx, bcy, origins.get(found_job_id)))
+
+        return out
+
+    @staticmethod
+    def _coordinate_arrays(kwargs, *names):
+        """Helper for :py:meth:`.where_is_many()`: get the named equal-length
+        lists of coordinates from kwargs as arrays.
+        """
+        arrays = [np.asarray(kwargs[name], dtype=int).reshape(-1)
+                  for name in names]
+        if len(set(len(array) for array in arrays)) != 1:
+            raise ValueError("Lists {} must all be the same length.".format(
+                ", ".join(names)))
+        return arrays
+
     def destroy_timed_out_jobs(self):
-        """Destroy any jobs which have timed out."""
+        """Destroy any jobs which have timed out.
+
+        Returns
+        -------
+        [job_id, ...]
+            The IDs of the jobs which were destroyed.
+        """
         with self._lock:
             now = time.time()
-            for job in list(itervalues(self._jobs)):
-                if (job.keepalive is not None and
-                        job.keepalive_until < now):
-                    # Job timed out, destroy it
-                    self.destroy_job(job.id, "Job timed out.")
+            timed_out = []
+            heap = self._keepalive_heap
+            while heap and heap[0][0] < now:
+                _, job_id = heapq.heappop(heap)
+                job = self._jobs.get(job_id)
+                if job is None or job_id in timed_out:
+                    # Job has already been destroyed
+                    continue
+                elif job.keepalive_until < now:
+                    # Job timed out
+                    timed_out.append(job.id)
+                else:
+                    # Job has been kept alive since the entry was added
+                    heapq.heappush(heap, (job.keepalive_until, job_id))
+
+            # Report the timed out jobs before any BMP requests are issued to
+            # power them down
+            if timed_out and self._on_jobs_timed_out is not None:
+                self._on_jobs_timed_out(timed_out)
+
+            for job_id in timed_out:
+                self.destroy_job(job_id, "Job timed out.")
+            return timed_out
 
-    def _bmp_on_request_complete(self, job, success):
+    @property
+    def next_timeout(self):
+        """The earliest time (as given by :py:func:`time.time`) at which a
+        job may time out, or None if no jobs have a keepalive.
+
+        Calling :py:meth:`.destroy_timed_out_jobs` before this time will not
+        destroy any jobs. Note that jobs may have been kept alive since this
+        time was computed in which case no jobs will be destroyed at this time
+        either.
+
+        This property may be read without taking the controller's lock (e.g.
+        after every event a server handles).
+        """
+        # NB: Reading the top of the heap is atomic but the heap may be
+        # emptied between checking and reading it.
+        try:
+            return self._keepalive_heap[0][0]
+        except IndexError:
+            return None
+
+    def _bmp_on_request_complete(self, job, seq, success):
         """Callback function called by an AsyncBMPController when it completes
         a previously issued request.
 
@@ -977,10 +1329,16 @@ class Controller(object):
         job : :py:class:`._Job`
             The job whose state should be set. (To be defined by wrapping this
             method in a partial).
+        seq : int
+            The sequence number of the request. (To be defined by wrapping
+            this method in a partial).
         success : bool
             Command success indicator provided by the AsyncBMPController.
         """
         with self._lock:
+            if self._on_bmp_request_complete is not None:
+                self._on_bmp_request_complete(job.id, seq, success)
+
             # If a BMP command failed, cancel the job
             if not success:
                 self.destroy_job(job.id,
@@ -995,14 +1353,46 @@ class Controller(object):
 
                 # Report state changes for jobs which are still running
                 if job.id in self._jobs:
-                    self._changed_jobs.add(job.id)
+                    self._mark_jobs_changed([job.id])
                     if self._on_background_state_change is not None:
                         self._on_background_state_change()
 
+    def _bmp_on_power_request_complete(self, job, seq, board_power, xyz,
+                                       success):
+        """Callback function called by an AsyncBMPController when it completes
+        a power request which was recorded in _board_power.
+
+        If the request failed and no later request has been made for the same
+        board, its power state is forgotten. The job is then informed as in
+        :py:meth:`._bmp_on_request_complete`.
+
+        Parameters
+        ----------
+        job : :py:class:`._Job`
+            The job which made the request.
+        seq : int
+            The sequence number of the request.
+        board_power : dict
+            The _board_power dictionary for the machine.
+        xyz : (x, y, z)
+            The board the request was for.
+        success : bool
+            Command success indicator provided by the AsyncBMPController.
+        """
+        with self._lock:
+            if not success and board_power.get(xyz, (None, None))[1] == seq:
+                del board_power[xyz]
+
+            self._bmp_on_request_complete(job, seq, success)
+
     def _set_job_power_and_links(self, job, power, link_enable=None):
         """Power on/off and configure links for the boards associated with a
         specific job.
 
+        Boards which are already off are not sent power-off commands. Boards
+        being powered on are always sent the command since this resets them
+        (and so their links must always be configured again).
+
         Parameters
         ----------
         job : :py:class:`._Job`
@@ -1016,7 +1406,7 @@ class Controller(object):
         with self._lock:
             machine = job.allocated_machine
 
-            on_done = partial(self._bmp_on_request_complete, job)
+            board_power = self._board_power.setdefault(machine.name, {})
 
             # Group commands by the frame they interact with to allow all
             # commands within a frame to be sent atomically
@@ -1025,22 +1415,35 @@ class Controller(object):
             controllers = self._bmp_controllers[machine.name]
 
             # Power commands
-            job.bmp_requests_until_ready += len(job.boards)
             for xyz in job.boards:
+                if not power and board_power.get(xyz, (None, ))[0] is False:
+                    continue
+                seq = self._next_bmp_request_seq
+                self._next_bmp_request_seq += 1
+                board_power[xyz] = (power, seq)
+
+                job.bmp_requests_until_ready += 1
                 c, f, b = machine.board_locations[xyz]
                 controller = controllers[(c, f)]
                 frame_commands[controller].append(
-                    partial(controller.set_power, b, power, on_done))
+                    partial(controller.set_power, b, power,
+                            partial(self._bmp_on_power_request_complete,
+                                    job, seq, board_power, xyz)))
 
             # Link state commands
             if link_enable is not None:
                 job.bmp_requests_until_ready += len(job.periphery)
                 for x, y, z, link in job.periphery:
+                    seq = self._next_bmp_request_seq
+                    self._next_bmp_request_seq += 1
+
                     c, f, b = machine.board_locations[(x, y, z)]
                     controller = controllers[(c, f)]
                     frame_commands[controller].append(
                         partial(controller.set_link_enable,
-                                b, link, link_enable, on_done))
+                                b, link, link_enable,
+                                partial(self._bmp_on_request_complete,
+                                        job, seq)))
 
             # Send power/link commands atomically for each frame
             for controller, commands in iteritems(frame_commands):
@@ -1048,10 +1451,14 @@ class Controller(object):
                     for command in commands:
                         command()
 
-            # Update job state
-            job.state = JobState.power
+            # Update job state (the job is ready immediately if no commands
+            # were required)
+            if job.bmp_requests_until_ready:
+                job.state = JobState.power
+            else:
+                job.state = JobState.ready
             job.power = power
-            self._changed_jobs.add(job.id)
+            self._mark_jobs_changed([job.id])
 
     def _job_queue_on_allocate(self, job_id, machine_name, boards,
                                periphery, torus):
@@ -1063,8 +1470,6 @@ class Controller(object):
             job.boards = boards
             job.periphery = periphery
             job.torus = torus
-            self._changed_jobs.add(job.id)
-            self._changed_machines.add(machine_name)
 
             # Compute dimensions of machine the job will run on. Note that the
             # formulae used below for converting from board to chip coordinates
@@ -1091,12 +1496,17 @@ class Controller(object):
                 for (x, y, z) in job.boards
             }
 
+            # Publish the allocation
+            self._mark_jobs_changed([job.id])
+            self._mark_machines_changed([machine_name])
+
             # Initialise the boards
             self.power_on_job_boards(job_id)
 
     def _job_queue_on_free(self, job_id, reason):
         """Called when a job is freed."""
-        self._changed_machines.add(self._jobs[job_id].allocated_machine.name)
+        self._mark_machines_changed(
+            [self._jobs[job_id].allocated_machine.name])
         self._teardown_job(job_id, reason)
 
     def _job_queue_on_cancel(self, job_id, reason):
@@ -1111,7 +1521,7 @@ class Controller(object):
         with self._lock:
             job = self._jobs.pop(job_id)
             self._retired_jobs[job_id] = reason
-            self._changed_jobs.add(job.id)
+            self._mark_jobs_changed([job.id])
 
             # Keep the number of retired jobs limited to prevent
             # accumulating memory consumption forever.
@@ -1127,8 +1537,12 @@ class Controller(object):
         with self._lock:
             controllers = {}
             for (c, f), hostname in iteritems(machine.bmp_ips):
-                controllers[(c, f)] = AsyncBMPController(
-                    hostname, on_thread_start)
+                if self._bmp_controller_factory is not None:
+                    controllers[(c, f)] = self._bmp_controller_factory(
+                        hostname, on_thread_start)
+                else:
+                    controllers[(c, f)] = AsyncBMPController(
+                        hostname, on_thread_start, engine=self._bmp_engine)
             self._bmp_controllers[machine.name] = controllers
 
     def _init_dynamic_state(self):
@@ -1137,6 +1551,7 @@ class Controller(object):
         Specifically:
 
         * Creates the global controller lock
+        * Creates the pool of threads which communicate with BMPs.
         * Creates connections to BMPs.
         * Reset keepalive_until on all existing jobs (e.g. allowing remote
           devices a chance to reconnect before terminating their jobs).
@@ -1145,6 +1560,9 @@ class Controller(object):
         assert self._lock is None
         self._lock = threading.RLock()
 
+        assert self._bmp_engine is None
+        self._bmp_engine = BMPEngine(self._max_bmp_workers)
+
         with self._lock:
             # Create connections to BMPs
             assert self._bmp_controllers is None
@@ -1233,6 +1651,36 @@ class JobMachineInfoTuple(namedtuple("JobMachineInfoTuple",
     __slots__ = tuple()
 
 
+class JobChangeTuple(namedtuple("JobChangeTuple",
+                                "job_id,state,power,reason,"
+                                "allocated_machine_name,boards")):
+    """Tuple describing the current state of a job which has changed,
+    returned by :py:meth:`.Controller.get_job_changes`.
+
+    Parameters
+    ----------
+    job_id : int
+        The ID of the job.
+    state : :py:class:`.JobState`
+        The current state of the job.
+    power : bool or None
+        If job is in the ready or power states, indicates whether the boards
+        are power{ed,ing} on (True), or power{ed,ing} off (False). In other
+        states, this value is None.
+    reason : str or None
+        If the job has been destroyed, this may be a string describing the
+        reason the job was terminated.
+    allocated_machine_name : str or None
+        The name of the machine the job has been allocated to run on (or None
+        if not allocated yet).
+    boards : set([(x, y, z), ...]) or None
+        The boards allocated to the job (or None if not allocated yet).
+    """
+
+    # Python 3.4 Workaround: https://bugs.python.org/issue24931
+    __slots__ = tuple()
+
+
 class JobTuple(namedtuple("JobTuple",
                           "job_id,owner,start_time,keepalive,state,power,"
                           "args,kwargs,allocated_machine_name,boards")):
@@ -1300,6 +1748,26 @@ class MachineTuple(namedtuple("MachineTuple",
     __slots__ = tuple()
 
 
+_NOT_RETIRED = object()
+"""Sentinel used when looking up jobs which have not been retired."""
+
+
+class _JobSnapshot(namedtuple("_JobSnapshot",
+                              "id,owner,start_time,keepalive,state,power,"
+                              "args,kwargs,allocated_machine_name,boards,"
+                              "width,height,connections")):
+    """An immutable copy of the publicly visible state of a :py:class:`._Job`
+    used to answer queries without holding the :py:class:`.Controller`'s lock.
+
+    The fields have the same meaning as the :py:class:`._Job` attributes of
+    the same name except that "job_id" is stripped from kwargs and the
+    allocated machine is given by name.
+    """
+
+    # Python 3.4 Workaround: https://bugs.python.org/issue24931
+    __slots__ = tuple()
+
+
 class _Job(object):
     """The metadata, used internally, associated with a non-destroyed job.
 
@@ -1411,3 +1879,21 @@ class _Job(object):
         # The number of BMP requests which must complete before this job may
         # return to the ready state.
         self.bmp_requests_until_ready = bmp_requests_until_ready
+
+    def snapshot(self):
+        """Get an immutable :py:class:`._JobSnapshot` of this job's current
+        state.
+        """
+        # Strip "job_id" which is only used internally
+        kwargs = {k: v for k, v in iteritems(self.kwargs) if k != "job_id"}
+
+        # Machine may not exist
+        allocated_machine_name = None
+        if self.allocated_machine is not None:
+            allocated_machine_name = self.allocated_machine.name
+
+        return _JobSnapshot(self.id, self.owner, self.start_time,
+                            self.keepalive, self.state, self.power,
+                            self.args, kwargs, allocated_machine_name,
+                            self.boards, self.width, self.height,
+                            self.connections)
@@ -121,8 +121,10 @@ from enum import IntEnum
 
 from six import iteritems
 
+import numpy as np
+
 from rig.links import Links
-from rig.geometry import spinn5_local_eth_coord
+from rig.geometry import spinn5_local_eth_coord, SPINN5_ETH_OFFSET
 
 
 link_to_vector = {
@@ -251,6 +253,69 @@ def chip_to_board(x, y, w, h):
     return (x, y, z)
 
 
+def boards_to_chips(x, y, z):
+    """Convert arrays of board coordinates into chip coordinates.
+
+    A vectorised equivalent of :py:func:`.board_to_chip`.
+
+    Parameters
+    ----------
+    x, y, z : array-like of int
+        Board coordinates.
+
+    Returns
+    -------
+    x, y : :py:class:`numpy.ndarray`
+        Chip coordinates.
+    """
+    x = np.asarray(x, dtype=int) * 12
+    y = np.asarray(y, dtype=int) * 12
+    z = np.asarray(z, dtype=int)
+
+    x += np.where(z == 1, 8, np.where(z == 2, 4, 0))
+    y += np.where(z == 1, 4, np.where(z == 2, 8, 0))
+
+    return (x, y)
+
+
+def chips_to_boards(x, y, w, h):
+    """Convert arrays of chip coordinates into board coordinates and the
+    coordinates of each chip within its board.
+
+    A vectorised equivalent of :py:func:`.chip_to_board` and
+    :py:func:`rig.geometry.spinn5_chip_coord`.
+
+    Parameters
+    ----------
+    x, y : array-like of int
+        Chip coordinates.
+    w, h : int
+        Dimensions of the system, in chips.
+
+    Returns
+    -------
+    x, y, z : :py:class:`numpy.ndarray`
+        Board coordinates.
+    board_chip_x, board_chip_y : :py:class:`numpy.ndarray`
+        The coordinates of each chip within its board.
+    """
+    x = np.asarray(x, dtype=int)
+    y = np.asarray(y, dtype=int)
+
+    # Offset from each chip to the chip at the bottom-left-corner of its board
+    offsets = SPINN5_ETH_OFFSET[y % 12, x % 12]
+    dx = offsets[..., 0]
+    dy = offsets[..., 1]
+    x = (x + dx) % w
+    y = (y + dy) % h
+
+    # The coordinates of the chip within its triad
+    tx = x % 12
+    z = np.where(tx == 8, 1, np.where(tx == 4, 2, 0))
+
+    return (x // 12, y // 12, z, -dx, -dy)
+
+
 def triad_dimensions_to_chips(w, h, torus):
     """Convert the dimensions of a system from numbers of triads to numbers of
     chips in the underlying network.
@@ -257,7 +257,7 @@ class JobQueue(object):
                 self._enqueue_job(job)
 
     def add_machine(self, name, width, height, tags=None,
-                    dead_boards=set(), dead_links=set()):
+                    dead_boards=set(), dead_links=set(), packer="pack_tree"):
         """Add a new machine for processing jobs.
 
         Jobs are offered for allocation on machines in the order the machines
@@ -277,6 +277,9 @@ class JobQueue(object):
             The boards in the machine which do not work.
         dead_links : set([(x, y, z, :py:class:`rig.links.Links`), ...])
             The board-to-board links in the machine which do not work.
+        packer : str
+            The name of the 2D packing algorithm to use when allocating
+            boards (see :py:data:`spalloc_server.allocator.PACKERS`).
 
         See Also
         --------
@@ -290,7 +293,8 @@ class JobQueue(object):
         if name in self._machines:
             raise ValueError("Machine name {} already in use.".format(name))
 
-        allocator = Allocator(width, height, dead_boards, dead_links)
+        allocator = Allocator(width, height, dead_boards, dead_links,
+                              packer=packer)
         self._machines[name] = _Machine(name, tags, allocator)
 
         self._regenerate_queues()
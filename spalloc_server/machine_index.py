@@ -0,0 +1,256 @@
+"""Precomputed indices describing the working boards and links of a machine.
+
+These indices are built once for a given machine (and set of faults) and allow
+the :py:class:`~spalloc_server.allocator.Allocator` to answer questions about
+rectangular regions of the machine, e.g. "which boards can be reached from this
+corner?", without repeatedly walking the machine's boards and links as
+individual coordinate tuples.
+"""
+
+from rig.links import Links
+
+from spalloc_server.coordinates import board_down_link
+
+
+class ConnectivityIndex(object):
+    """A bit-vector representation of the working boards and links in a
+    machine.
+
+    Every board in the machine is assigned a bit index (see
+    :py:meth:`.bit`) and sets of boards are represented as (arbitrary length)
+    Python integers with one bit per board. Operations on sets of boards (e.g.
+    restricting a set to a rectangular region or following all working links
+    out of a set of boards) then become a handful of bitwise operations on
+    these integers rather than set operations on (x, y, z) tuples.
+
+    Internally, the working links of the machine are grouped by the difference
+    in bit index between the board at each end of the link. Following every
+    working link out of a set of boards is then just a case of masking and
+    shifting the set once per group. There are only a small number of such
+    groups (one per link direction, plus a few more for wrap-around links).
+
+    Attributes
+    ----------
+    width, height : int
+        Dimensions of the machine in triads.
+    live : int
+        A bit-vector with a bit set for every working board in the machine.
+    """
+
+    def __init__(self, width, height, dead_boards, dead_links):
+        """
+        Parameters
+        ----------
+        width, height : int
+            Dimensions of the machine in triads.
+        dead_boards : set([(x, y, z), ...])
+            The set of boards which are dead.
+        dead_links : set([(x, y, z, :py:class:`rig.links.Links`), ...])
+            The set of links leaving boards which are known not to be working.
+        """
+        self.width = width
+        self.height = height
+
+        self.live = 0
+
+        # Group the working links leaving all working boards according to
+        # the change in bit index when the link is followed.
+        # {shift: mask, ...}
+        moves = {}
+        for x1 in range(width):
+            for y1 in range(height):
+                for z1 in range(3):
+                    if (x1, y1, z1) in dead_boards:
+                        continue
+                    bit1 = self.bit(x1, y1, z1)
+                    self.live |= 1 << bit1
+
+                    for link in Links:
+                        if (x1, y1, z1, link) in dead_links:
+                            continue
+                        x2, y2, z2, _ = board_down_link(x1, y1, z1, link,
+                                                        width, height)
+                        shift = self.bit(x2, y2, z2) - bit1
+                        moves[shift] = moves.get(shift, 0) | (1 << bit1)
+
+        # A list [(mask, shift), ...]
+        self._moves = [(mask, shift) for shift, mask in sorted(moves.items())]
+
+    def bit(self, x, y, z):
+        """Get the bit index of a given board."""
+        return (((y * self.width) + x) * 3) + z
+
+    def region(self, x, y, width, height):
+        """Get a bit-vector with a bit set for every board (dead or alive) in
+        a rectangular region of triads.
+
+        Parameters
+        ----------
+        x, y : int
+            The bottom-left triad of the region.
+        width, height : int
+            The dimensions of the region in triads.
+
+        Returns
+        -------
+        int
+        """
+        row = ((1 << (width * 3)) - 1) << (x * 3)
+        row_stride = self.width * 3
+        mask = 0
+        for y_ in range(y, y + height):
+            mask |= row << (y_ * row_stride)
+        return mask
+
+    def reachable(self, x, y, width, height):
+        """Starting from board (x, y, 0), find all working boards which can be
+        reached via working links without leaving the specified rectangle of
+        triads.
+
+        Returns
+        -------
+        int
+            A bit-vector of the reachable boards. This will be zero if board
+            (x, y, 0) is dead.
+        """
+        region = self.region(x, y, width, height) & self.live
+        reached = (1 << self.bit(x, y, 0)) & region
+
+        # Flood-fill outward from the starting board, one hop at a time
+        frontier = reached
+        while frontier:
+            neighbours = 0
+            for mask, shift in self._moves:
+                boards = frontier & mask
+                if boards:
+                    if shift > 0:
+                        neighbours |= boards << shift
+                    else:
+                        neighbours |= boards >> -shift
+            frontier = neighbours & region & ~reached
+            reached |= frontier
+
+        return reached
+
+    def count(self, boards):
+        """Count the boards in a bit-vector of boards."""
+        return bin(boards).count("1")
+
+    def boards(self, boards):
+        """Convert a bit-vector of boards into a set of board coordinates.
+
+        Returns
+        -------
+        set([(x, y, z), ...])
+        """
+        out = set()
+        while boards:
+            lowest = boards & -boards
+            bit = lowest.bit_length() - 1
+            boards ^= lowest
+
+            xy, z = divmod(bit, 3)
+            y, x = divmod(xy, self.width)
+            out.add((x, y, z))
+        return out
+
+
+class FaultIndex(object):
+    """Summed-area tables which count the dead boards and dead links within
+    arbitrary rectangular regions of triads in constant time.
+
+    Only regions which do not wrap-around the edges of the machine are
+    supported.
+    """
+
+    def __init__(self, width, height, dead_boards, dead_links):
+        """
+        Parameters
+        ----------
+        width, height : int
+            Dimensions of the machine in triads.
+        dead_boards : set([(x, y, z), ...])
+            The set of boards which are dead.
+        dead_links : set([(x, y, z, :py:class:`rig.links.Links`), ...])
+            The set of links leaving boards which are known not to be working.
+        """
+        self.width = width
+        self.height = height
+
+        # Number of dead boards in each triad
+        board_counts = [[0] * width for _ in range(height)]
+
+        # Number of dead links between two working boards, neither of which
+        # wrap-around the machine. Links are counted at the triad in the
+        # bottom-left corner of the (1x1, 2x1, 1x2 or 2x2) block of triads
+        # they span and grouped by the dimensions of that block.
+        # {(dx, dy): [[count, ...], ...], ...}
+        link_counts = {(dx, dy): [[0] * width for _ in range(height)]
+                       for dx in range(2) for dy in range(2)}
+
+        for x1 in range(width):
+            for y1 in range(height):
+                for z1 in range(3):
+                    if (x1, y1, z1) in dead_boards:
+                        board_counts[y1][x1] += 1
+                        continue
+
+                    for link in Links:
+                        if (x1, y1, z1, link) not in dead_links:
+                            continue
+                        x2, y2, z2, wrapped = board_down_link(
+                            x1, y1, z1, link, width, height)
+                        if wrapped or (x2, y2, z2) in dead_boards:
+                            continue
+                        counts = link_counts[(abs(x2 - x1), abs(y2 - y1))]
+                        counts[min(y1, y2)][min(x1, x2)] += 1
+
+        self._dead_boards = _summed_area_table(board_counts)
+        self._dead_links = {dxdy: _summed_area_table(counts)
+                            for dxdy, counts in link_counts.items()}
+
+    def dead_boards(self, x, y, width, height):
+        """Count the dead boards in a rectangular region of triads."""
+        return _summed_area(self._dead_boards, x, y, width, height)
+
+    def dead_links(self, x, y, width, height):
+        """Count the dead links which connect two working boards within a
+        rectangular region of triads, excluding any wrap-around links.
+        """
+        total = 0
+        for (dx, dy), table in self._dead_links.items():
+            if width > dx and height > dy:
+                total += _summed_area(table, x, y, width - dx, height - dy)
+        return total
+
+
+def _summed_area_table(counts):
+    """Produce a summed-area table from a 2D list of counts.
+
+    Parameters
+    ----------
+    counts : [[count, ...], ...]
+        A list of rows of counts.
+
+    Returns
+    -------
+    [[total, ...], ...]
+        A table with one more row and column than counts where each entry
+        [y][x] gives the sum of all counts below and to the left of (x, y).
+    """
+    width = len(counts[0]) if counts else 0
+    table = [[0] * (width + 1)]
+    for row in counts:
+        row_total = 0
+        table_row = [0]
+        for x, count in enumerate(row):
+            row_total += count
+            table_row.append(table[-1][x + 1] + row_total)
+        table.append(table_row)
+    return table
+
+
+def _summed_area(table, x, y, width, height):
+    """Sum the counts in a rectangular region of a summed-area table."""
+    return (table[y + height][x + width] - table[y][x + width] -
+            table[y + height][x] + table[y][x])
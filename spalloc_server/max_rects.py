@@ -0,0 +1,237 @@
+"""A 'maximal rectangles' algorithm for allocating/packing rectangles into a
+fixed 2D space.
+
+This module provides an alternative to
+:py:class:`~spalloc_server.pack_tree.PackTree` which exposes the same
+interface and so may be used interchangeably by the
+:py:class:`~spalloc_server.allocator.Allocator`.
+"""
+
+from spalloc_server.area_to_rect import area_to_rect
+from spalloc_server.pack_tree import FreeError
+
+
+class MaxRectsPacker(object):
+    """A 'maximal rectangles' packer for allocating/packing rectangles into a
+    fixed 2D space.
+
+    Unlike :py:class:`~spalloc_server.pack_tree.PackTree`, which divides up
+    the space using a tree of guillotine cuts, this packer maintains the list
+    of all *maximal* free rectangles: free rectangles which cannot be extended
+    in any direction without overlapping an allocation or leaving the space.
+    Free rectangles may overlap one another and so free space which spans
+    several previous cuts remains available for allocation.
+
+    When an allocation is made, the four corners of every free rectangle large
+    enough to fit the allocation are considered, best-fitting free rectangle
+    first, using the "best short side fit" heuristic. This tends to keep large
+    free areas intact for later allocations.
+    """
+
+    def __init__(self, x, y, width, height):
+        """Defines a region which may be allocated.
+
+        Parameters
+        ----------
+        x, y : int
+            The (absolute) location of the bottom left corner of the region.
+        width, height : int
+            The dimensions of the region.
+        """
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+        # The current set of allocations.
+        # {(x, y): (width, height), ...}
+        self.allocations = {}
+
+        # The list of maximal free rectangles.
+        # [(x, y, width, height), ...]
+        self.free_rects = [(x, y, width, height)]
+
+    def __contains__(self, xy):
+        """Test whether a coordinate is inside this region."""
+        x, y = xy
+        return (self.x <= x < (self.x + self.width) and
+                self.y <= y < (self.y + self.height))
+
+    def _place(self, x, y, width, height):
+        """Mark a rectangle (which must be free) as allocated and update the
+        list of maximal free rectangles accordingly.
+        """
+        self.allocations[(x, y)] = (width, height)
+
+        # Split every free rectangle which overlaps the allocation into the
+        # (up to four) maximal pieces which don't.
+        free_rects = []
+        for fx, fy, fw, fh in self.free_rects:
+            if (x >= fx + fw or x + width <= fx or
+                    y >= fy + fh or y + height <= fy):
+                # No overlap
+                free_rects.append((fx, fy, fw, fh))
+                continue
+
+            if x > fx:  # Left
+                free_rects.append((fx, fy, x - fx, fh))
+            if x + width < fx + fw:  # Right
+                free_rects.append((x + width, fy,
+                                   (fx + fw) - (x + width), fh))
+            if y > fy:  # Below
+                free_rects.append((fx, fy, fw, y - fy))
+            if y + height < fy + fh:  # Above
+                free_rects.append((fx, y + height,
+                                   fw, (fy + fh) - (y + height)))
+
+        # Discard rectangles which are not maximal (i.e. are contained within
+        # another free rectangle).
+        free_rects = list(set(free_rects))
+        self.free_rects = [
+            r for r in free_rects
+            if not any(o != r and _contains(o, r) for o in free_rects)]
+
+    def alloc(self, width, height, candidate_filter=None):
+        """Attempt to allocate a rectangular region of a specified size.
+
+        Parameters
+        ----------
+        width, height : int
+            The dimensions of the region to attempt to allocate. Must be
+            strictly 1x1 or greater.
+        candidate_filter : None or function(x, y, w, h) -> bool
+            A function which will be called with candidate allocations. If the
+            function returns False, the allocation is rejected and the
+            allocator will attempt to find another. If the function returns
+            True, the allocator will then create the allocation.
+
+            If this argument is None (the default) the first candidate
+            allocation found will be returned.
+
+        Returns
+        -------
+        allocation : (x, y) or None
+            If the allocation request was met, a tuple giving the position of
+            the bottom-left corner of the allocation.
+
+            If the request could not be met, None is returned and no allocation
+            is made.
+        """
+        # Consider the free rectangles which fit, best short-side fit first
+        # (breaking ties by position for determinism).
+        candidates = sorted(
+            (min(fw - width, fh - height), fy, fx, fw, fh)
+            for fx, fy, fw, fh in self.free_rects
+            if fw >= width and fh >= height)
+
+        tried = set()
+        for _, fy, fx, fw, fh in candidates:
+            for x, y in ((fx + dx, fy + dy)
+                         for dx in (0, fw - width)
+                         for dy in (0, fh - height)):
+                if (x, y) in tried:
+                    continue
+                tried.add((x, y))
+                if (candidate_filter is None or
+                        candidate_filter(x, y, width, height)):
+                    self._place(x, y, width, height)
+                    return (x, y)
+
+        # No acceptable region could be found, give up.
+        return None
+
+    def alloc_area(self, area, min_ratio=0.0, candidate_filter=None):
+        """Attempt to allocate a rectangular region with at least the specified
+        area which is 'at least as square' as the specified aspect ratio.
+
+        Parameters
+        ----------
+        area : int
+            The *minimum* area to allocate, must be at least 1.
+        min_ratio : float
+            The aspect ratio which the allocated region must be 'at least as
+            square as'. Set to 0.0 for any allowable shape.
+        candidate_filter : None or function(x, y, w, h) -> bool
+            See :py:meth:`.alloc`.
+
+        Returns
+        -------
+        allocation : (x, y, w, h) or None
+            If the allocation request was met, a tuple giving the position of
+            the bottom-left corner, width and height of the allocation is
+            returned.
+
+            If the request could not be met, None is returned and no allocation
+            is made.
+        """
+        # Try the shape best suited to each free rectangle, smallest free
+        # rectangle first.
+        tried = set()
+        for fw, fh in sorted(((fw, fh) for _, _, fw, fh in self.free_rects),
+                             key=(lambda wh: (wh[0] * wh[1], wh))):
+            if fw * fh < area:
+                continue
+
+            rect = area_to_rect(area, fw, fh, min_ratio)
+            if not rect or rect in tried:
+                continue
+            tried.add(rect)
+
+            width, height = rect
+            allocation = self.alloc(width, height, candidate_filter)
+            if allocation:
+                x, y = allocation
+                return (x, y, width, height)
+
+        return None
+
+    def request(self, x, y):
+        """Request the allocation of a specific 1x1 block.
+
+        Returns
+        -------
+        allocation : (x, y) or None
+            If the request request was met, the coordinates passed in are
+            returned.
+
+            If the request could not be met, None is returned and no allocation
+            is made.
+        """
+        if any(_contains(r, (x, y, 1, 1)) for r in self.free_rects):
+            self._place(x, y, 1, 1)
+            return (x, y)
+        else:
+            return None
+
+    def free(self, x, y):
+        """Free a previous allocation, allowing the space to be reused.
+
+        Parameters
+        ----------
+        x, y : int
+            The bottom-left corner of the allocation.
+        """
+        if (x, y) not in self:
+            raise FreeError(
+                "Cannot free {}, {} which is outside the region.".format(x, y))
+        if (x, y) not in self.allocations:
+            raise FreeError(
+                "Cannot free non-allocated region {}, {}.".format(x, y))
+
+        # Since freed space may merge with several neighbouring free
+        # rectangles, the maximal free rectangles are simply recomputed from
+        # the remaining allocations.
+        del self.allocations[(x, y)]
+        allocations = self.allocations
+        self.allocations = {}
+        self.free_rects = [(self.x, self.y, self.width, self.height)]
+        for (ax, ay), (aw, ah) in sorted(allocations.items()):
+            self._place(ax, ay, aw, ah)
+
+
+def _contains(outer, inner):
+    """Test whether the rectangle (x, y, w, h) inner lies within outer."""
+    ox, oy, ow, oh = outer
+    ix, iy, iw, ih = inner
+    return (ox <= ix and ix + iw <= ox + ow and
+            oy <= iy and iy + ih <= oy + oh)
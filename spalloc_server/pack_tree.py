@@ -18,6 +18,10 @@ class PackTree(object):
     <http://www.blackpawn.com/texts/lightmaps/default.html>`_. It is certainly
     not the most efficient or flexible packing algorithm available but due to
     time constraints it is ideal due to its simplicity.
+
+    To avoid searching subtrees which cannot possibly satisfy a request, each
+    non-leaf node keeps track of the largest width, height and area of any free
+    leaf beneath it. These are updated incrementally as the tree is changed.
     """
 
     def __init__(self, x, y, width, height):
@@ -43,12 +47,51 @@ class PackTree(object):
         # children of this node.
         self.children = None
 
+        # For non-leaf nodes, a tuple (width, height, area) giving the largest
+        # width, height and area of any free leaf in this subtree. (Note that
+        # these need not all come from the same leaf.) See _free_space.
+        self._max_free = None
+
     def __contains__(self, xy):
         """Test whether a coordinate is inside this region."""
         x, y = xy
         return (self.x <= x < (self.x + self.width) and
                 self.y <= y < (self.y + self.height))
 
+    def _free_space(self):
+        """Get the largest width, height and area of any free leaf in this
+        subtree.
+
+        Returns
+        -------
+        (width, height, area)
+        """
+        if self.children is not None:
+            return self._max_free
+        elif self.allocated:
+            return (0, 0, 0)
+        else:
+            return (self.width, self.height, self.width * self.height)
+
+    def _update_free_space(self):
+        """Recompute the free space summary of this node from its children.
+
+        Must be called whenever the children of this node (or their free space
+        summaries) change.
+        """
+        if self.children is not None:
+            a, b = (child._free_space() for child in self.children)
+            self._max_free = (max(a[0], b[0]), max(a[1], b[1]),
+                              max(a[2], b[2]))
+
+    def _children_smallest_first(self):
+        """Get the children of this node, smallest area first."""
+        a, b = self.children
+        if b.width * b.height < a.width * a.height:
+            return (b, a)
+        else:
+            return (a, b)
+
     def hsplit(self, y):
         """Split this node along the X axis.
 
@@ -69,6 +112,7 @@ class PackTree(object):
                                   self.width, (y - self.y)),
                          PackTree(self.x, y,
                                   self.width, self.height - (y - self.y)))
+        self._update_free_space()
 
     def vsplit(self, x):
         """Split this node along the Y axis.
@@ -92,6 +136,7 @@ class PackTree(object):
                                   (x - self.x), self.height),
                          PackTree(x, self.y,
                                   self.width - (x - self.x), self.height))
+        self._update_free_space()
 
     def alloc(self, width, height, candidate_filter=None):
         """Attempt to allocate a rectangular region of a specified size.
@@ -121,22 +166,20 @@ class PackTree(object):
             If the request could not be met, None is returned and no allocation
             is made.
         """
-        # If this node is already populated, give up
-        if self.allocated:
-            return None
-
-        # Allocation simply can't fit fail fast
-        if width > self.width or height > self.height:
+        # If no free leaf in this node is large enough (or this node is
+        # already populated), fail fast
+        free_width, free_height, _ = self._free_space()
+        if width > free_width or height > free_height:
             return None
 
         # If this node is split (i.e. has children), try inserting into the
         # children.
         if self.children is not None:
             # Try the smallest child first
-            for child in sorted(self.children,
-                                key=(lambda c: c.width * c.height)):
+            for child in self._children_smallest_first():
                 allocation = child.alloc(width, height, candidate_filter)
                 if allocation:
+                    self._update_free_space()
                     return allocation
             else:
                 # No child could fit the allocation, fail
@@ -185,21 +228,22 @@ class PackTree(object):
         # save additional calls to the candidate filter.
         if child.width != width:
             child.vsplit(x if x != child.x else child.x + width)
-            grandchild = (child.children[0]
-                          if x == child.x else
-                          child.children[1])
-            grandchild.allocated = True
-            return (grandchild.x, grandchild.y)
+            allocated = (child.children[0]
+                         if x == child.x else
+                         child.children[1])
         elif child.height != height:
             child.hsplit(y if y != child.y else child.y + height)
-            grandchild = (child.children[0]
-                          if y == child.y else
-                          child.children[1])
-            grandchild.allocated = True
-            return (grandchild.x, grandchild.y)
+            allocated = (child.children[0]
+                         if y == child.y else
+                         child.children[1])
         else:
-            child.allocated = True
-            return (child.x, child.y)
+            allocated = child
+        allocated.allocated = True
+
+        child._update_free_space()
+        self._update_free_space()
+
+        return (allocated.x, allocated.y)
 
     def alloc_area(self, area, min_ratio=0.0, candidate_filter=None):
         """Attempt to allocate a rectangular region with at least the specified
@@ -233,23 +277,21 @@ class PackTree(object):
             If the request could not be met, None is returned and no allocation
             is made.
         """
-        # If this node is already populated, give up
-        if self.allocated:
-            return None
-
-        # Allocation simply can't fit fail fast
-        if area > self.width * self.height:
+        # If no free leaf in this node is large enough (or this node is
+        # already populated), fail fast
+        _, _, free_area = self._free_space()
+        if area > free_area:
             return None
 
         # If this node is split (i.e. has children), try inserting into the
         # children.
         if self.children is not None:
             # Try the smallest child first
-            for child in sorted(self.children,
-                                key=(lambda c: c.width * c.height)):
+            for child in self._children_smallest_first():
                 allocation = child.alloc_area(area, min_ratio,
                                               candidate_filter)
                 if allocation:
+                    self._update_free_space()
                     return allocation
             else:
                 # No child could fit the allocation, fail
@@ -293,8 +335,11 @@ class PackTree(object):
         # If this node is not a leaf not we can't allocate anything. Find the
         # child which contains the requested location.
         if self.children:
-            return (self.children[0].request(x, y) or
-                    self.children[1].request(x, y))
+            allocation = (self.children[0].request(x, y) or
+                          self.children[1].request(x, y))
+            if allocation:
+                self._update_free_space()
+            return allocation
 
         # We are a leaf containing the requested point. If we're already
         # allocated there's nothing we can do.
@@ -368,6 +413,9 @@ class PackTree(object):
                 if all(not c.allocated and c.children is None
                        for c in self.children):
                     self.children = None
+                    self._max_free = None
+                else:
+                    self._update_free_space()
 
                 return
         else:
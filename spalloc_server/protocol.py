@@ -0,0 +1,126 @@
+"""Encodings of the messages exchanged between the server and its clients.
+
+By default, clients and the server exchange JSON objects, one per line (see
+:py:class:`.JSONLinesProtocol`). Clients may instead opt into a more compact
+binary encoding using the :py:meth:`~spalloc_server.server.Server.set_protocol`
+command, for example :py:class:`.MsgpackProtocol` (which requires the optional
+:py:mod:`msgpack` package to be installed).
+
+Every protocol object provides the following methods:
+
+``encode(message)``
+    Encode a message (a JSON-compatible object) as the bytes of a complete
+    frame.
+``decode(frame)``
+    Decode the bytes of a frame back into a message.
+``read_frame(buffer, start=0, max_length=None)``
+    Find the complete frame starting at offset ``start`` of a buffer (e.g. a
+    :py:class:`bytearray`) of received bytes. Returns a tuple ``(frame, end)``
+    where ``end`` is the offset of the byte following the frame or ``(None,
+    start)`` if the buffer does not yet contain a complete frame. The buffer
+    itself is not modified, allowing several frames to be read from a buffer
+    before the consumed bytes are discarded in one go. If ``max_length`` is
+    given, :py:exc:`.FrameTooLongError` is raised as soon as it is known that
+    the frame's contents are longer than ``max_length`` bytes.
+"""
+
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class FrameTooLongError(ValueError):
+    """Indicates that a client sent a frame longer than the maximum
+    permitted length.
+    """
+
+
+class JSONLinesProtocol(object):
+    """The default protocol: each message is a JSON object terminated by a
+    newline (``\\n``).
+    """
+
+    name = "json"
+
+    def encode(self, message):
+        return json.dumps(message).encode("utf-8") + b"\n"
+
+    def decode(self, frame):
+        return json.loads(frame.decode("utf-8"))
+
+    def read_frame(self, buffer, start=0, max_length=None):
+        newline = buffer.find(b"\n", start)
+        length = (len(buffer) if newline < 0 else newline) - start
+        if max_length is not None and length > max_length:
+            raise FrameTooLongError(
+                "Line longer than {} bytes.".format(max_length))
+        if newline < 0:
+            return (None, start)
+        return (bytes(buffer[start:newline]), newline + 1)
+
+
+class MsgpackProtocol(object):
+    """A binary protocol: each message is encoded using `MessagePack
+    <http://msgpack.org/>`_ and preceded by its length in bytes as a 32-bit
+    big-endian unsigned integer.
+
+    Since the length of every frame is known up-front, received data never
+    needs to be scanned for delimiters and messages containing large lists
+    (e.g. of boards or links) are considerably smaller than their JSON
+    equivalents.
+    """
+
+    name = "msgpack"
+
+    _LENGTH = struct.Struct(">I")
+
+    def encode(self, message):
+        payload = msgpack.packb(message, use_bin_type=True)
+        return self._LENGTH.pack(len(payload)) + payload
+
+    def decode(self, frame):
+        return msgpack.unpackb(frame, raw=False)
+
+    def read_frame(self, buffer, start=0, max_length=None):
+        if len(buffer) - start < self._LENGTH.size:
+            return (None, start)
+        length, = self._LENGTH.unpack_from(buffer, start)
+        if max_length is not None and length > max_length:
+            raise FrameTooLongError(
+                "Frame longer than {} bytes.".format(max_length))
+        end = start + self._LENGTH.size + length
+        if len(buffer) < end:
+            return (None, start)
+        return (bytes(buffer[start + self._LENGTH.size:end]), end)
+
+
+PROTOCOLS = {
+    "json": JSONLinesProtocol(),
+    "msgpack": MsgpackProtocol(),
+}
+"""The protocols supported by the server, by name."""
+
+DEFAULT_PROTOCOL = PROTOCOLS["json"]
+"""The protocol used by clients when they first connect."""
+
+
+def get_protocol(name):
+    """Get the protocol with the given name.
+
+    Raises
+    ------
+    ValueError
+        If the protocol does not exist or the packages it depends on are not
+        installed.
+    """
+    if name not in PROTOCOLS:
+        raise ValueError("Unknown protocol {!r}. Supported protocols: "
+                         "{}".format(name, ", ".join(sorted(PROTOCOLS))))
+    if name == "msgpack" and msgpack is None:
+        raise ValueError("The msgpack protocol requires the msgpack package "
+                         "to be installed.")
+    return PROTOCOLS[name]
@@ -0,0 +1,227 @@
+"""Replay a trace recorded by a server against a fresh controller.
+
+Commands are dispatched exactly as they would be by the
+:py:class:`~spalloc_server.server.Server` which recorded the trace while BMP
+requests are held until the trace records their completion. No communication
+with clients or hardware takes place and records are replayed as quickly as
+possible rather than according to their timestamps, making replays
+deterministic and suitable for profiling the scheduler, for example::
+
+    $ spalloc-server-replay server.trace --profile replay.prof
+
+This module contains the :py:func:`function <.main>` which is mapped to the
+``spalloc-server-replay`` command-line tool.
+"""
+
+import argparse
+import cProfile
+import json
+import logging
+
+from collections import OrderedDict
+
+from timeit import default_timer
+
+from spalloc_server import coordinates, configuration
+from spalloc_server.configuration import Configuration
+from spalloc_server.controller import Controller
+from spalloc_server.protocol import DEFAULT_PROTOCOL
+from spalloc_server.server import Server
+from spalloc_server.trace import RecordType, read_trace
+
+
+class _ReplayBMPController(object):
+    """A stand-in for
+    :py:class:`~spalloc_server.async_bmp_controller.AsyncBMPController` which
+    passes all requests to the :py:class:`.Replayer` to be completed when the
+    trace says they should be.
+    """
+
+    def __init__(self, on_request):
+        self._on_request = on_request
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        pass
+
+    def set_power(self, board, state, on_done):
+        self._on_request(on_done)
+
+    def set_link_enable(self, board, link, enable, on_done):
+        self._on_request(on_done)
+
+    def stop(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class Replayer(object):
+    """Drives a fresh :py:class:`~spalloc_server.controller.Controller` using
+    the records of a trace.
+
+    Attributes
+    ----------
+    controller : :py:class:`~spalloc_server.controller.Controller`
+        The controller being driven.
+    num_records : int
+        The number of records replayed.
+    num_commands : int
+        The number of commands dispatched.
+    failed_commands : int
+        The number of commands which failed (and which would have caused the
+        server to disconnect the client).
+    unexpected_completions : int
+        The number of BMP request completions in the trace for which no
+        outstanding request with the same job ID and sequence number existed.
+        This should be zero for traces recorded from a cold-started server.
+    """
+
+    def __init__(self):
+        # BMP requests which have not yet been completed, indexed by the
+        # sequence number the controller gave each request.
+        # {seq: on_done, ...}
+        self._outstanding = {}
+
+        self.controller = Controller(
+            bmp_controller_factory=(
+                lambda hostname, on_thread_start=None:
+                _ReplayBMPController(self._on_bmp_request)))
+
+        # Commands are dispatched via the server's own dispatch logic using a
+        # server object which has no sockets or threads of its own.
+        self._server = Server.command_dispatcher(self.controller)
+
+        self.num_records = 0
+        self.num_commands = 0
+        self.failed_commands = 0
+        self.unexpected_completions = 0
+
+    def _on_bmp_request(self, on_done):
+        """Called when the controller issues a BMP request."""
+        # The controller's completion callbacks are partially applied to the
+        # job the request was issued for and the request's sequence number.
+        # Since a replayed controller issues the same requests in the same
+        # order, these sequence numbers match those in the trace.
+        seq = on_done.args[1]
+        self._outstanding[seq] = on_done
+
+    def replay(self, record):
+        """Replay a single :py:class:`~spalloc_server.trace.TraceRecord`."""
+        self.num_records += 1
+
+        if record.type == RecordType.config:
+            g = {}
+            g.update(configuration.__dict__)
+            g.update(coordinates.__dict__)
+            exec(record.payload, g)
+            config = g.get("configuration", None)
+            if not isinstance(config, Configuration):  # pragma: no cover
+                raise ValueError(
+                    "'configuration' must be a Configuration object")
+            self.controller.max_retired_jobs = config.max_retired_jobs
+            self.controller.max_bmp_workers = config.max_bmp_workers
+            self.controller.machines = OrderedDict(
+                (m.name, m) for m in config.machines)
+        elif record.type == RecordType.command:
+            self.num_commands += 1
+            try:
+                # Commands are always traced as JSON, regardless of the
+                # protocol the client was using
+                self._server._dispatch_command(
+                    record.client, DEFAULT_PROTOCOL.decode(record.payload))
+            except Exception:
+                self.failed_commands += 1
+                logging.debug("Command %r failed.", record.payload,
+                              exc_info=True)
+        elif record.type == RecordType.bmp_request_complete:
+            job_id, seq, success = record.payload
+            on_done = self._outstanding.get(seq)
+            if on_done is not None and on_done.args[0].id == job_id:
+                del self._outstanding[seq]
+                on_done(success)
+            else:
+                self.unexpected_completions += 1
+        elif record.type == RecordType.jobs_timed_out:
+            for job_id in record.payload:
+                self.controller.destroy_job(job_id, "Job timed out.")
+
+    def replay_file(self, f):
+        """Replay every record in a trace file.
+
+        Parameters
+        ----------
+        f : file
+            A trace file opened for reading in binary mode.
+        """
+        for record in read_trace(f):
+            self.replay(record)
+
+    def stop(self):
+        """Shut down the controller."""
+        self.controller.stop()
+        self.controller.join()
+
+
+def main(args=None):
+    """Command-line tool which replays a trace and reports how long it took.
+
+    Parameters
+    ----------
+    args : [arg, ...], optional
+        The command-line arguments passed to the program.
+    """
+    parser = argparse.ArgumentParser(
+        description="Replay a trace recorded by a SpiNNaker machine "
+                    "partitioning server.")
+    parser.add_argument("trace", type=str,
+                        help="trace filename to replay")
+    parser.add_argument("--profile", metavar="FILE", default=None,
+                        help="profile the replay, writing the statistics to "
+                             "the named file")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args(args)
+
+    replayer = Replayer()
+    profile = cProfile.Profile() if args.profile else None
+
+    with open(args.trace, "rb") as f:
+        before = default_timer()
+        if profile is not None:
+            profile.enable()
+        replayer.replay_file(f)
+        if profile is not None:
+            profile.disable()
+        duration = default_timer() - before
+    replayer.stop()
+
+    if profile is not None:
+        profile.dump_stats(args.profile)
+
+    results = {
+        "records": replayer.num_records,
+        "commands": replayer.num_commands,
+        "failed_commands": replayer.failed_commands,
+        "unexpected_completions": replayer.unexpected_completions,
+        "duration": duration,
+        "commands_per_sec": (replayer.num_commands / duration
+                             if duration else float("nan")),
+    }
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print("Replayed {records} records ({commands} commands, "
+              "{failed_commands} failed, {unexpected_completions} "
+              "unexpected BMP completions) in {duration:.3f} s "
+              "({commands_per_sec:.1f} commands/sec).".format(**results))
+
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import sys
+    sys.exit(main())
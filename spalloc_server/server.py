@@ -7,14 +7,16 @@ is mapped to the ``spalloc-server`` command-line tool.
 
 import os
 import os.path
+import errno
 import logging
 import pickle
 import socket
 import select
 import signal
+import sys
 import threading
-import json
 import argparse
+import math
 import time
 
 from collections import OrderedDict
@@ -24,8 +26,26 @@ from six import itervalues, iteritems
 from spalloc_server import __version__, coordinates, configuration
 from spalloc_server.configuration import Configuration
 from spalloc_server.controller import Controller
+from spalloc_server.protocol import \
+    DEFAULT_PROTOCOL, FrameTooLongError, get_protocol
+from spalloc_server.trace import TraceWriter
 
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 4096
+"""The initial (and minimum) number of bytes requested from a client socket
+by each recv call.
+"""
+
+MAX_BUFFER_SIZE = 256 * 1024
+"""The largest number of bytes requested from a client socket by a single recv
+call. The number of bytes requested from each client is doubled (up to this
+limit) whenever a recv call fills the request completely and halved whenever
+a recv call returns less than a quarter of the request.
+"""
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+"""Error numbers indicating a non-blocking socket operation could not be
+completed immediately.
+"""
 
 _COMMANDS = OrderedDict()
 """A dictionary from command names to (unbound) methods of the
@@ -40,6 +60,152 @@ def spalloc_command(f):
     return f
 
 
+class OutputBufferFullError(IOError):
+    """Indicates that a client has been disconnected because it did not read
+    its messages quickly enough to keep its output buffer below the configured
+    ``max_client_output_buffer``.
+    """
+
+
+class _CachedReply(object):
+    """A value returned by a command whose encoded reply is cached.
+
+    Commands may return an instance of this class in place of their return
+    value. The reply message is then encoded at most once for each protocol,
+    no matter how many times the instance is returned.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+        # The encoded reply message for each protocol used so far.
+        # {protocol: bytes, ...}
+        self._encoded = {}
+
+    def encode(self, protocol):
+        """Get the reply message encoded using the given protocol."""
+        encoded = self._encoded.get(protocol)
+        if encoded is None:
+            encoded = protocol.encode({"return": self.value})
+            self._encoded[protocol] = encoded
+        return encoded
+
+
+class _Watches(dict):
+    """The set of IDs (e.g. job IDs or machine names) each client has asked to
+    be notified about.
+
+    This is a dictionary ``{client: set([id, ...]) or None, ...}`` where None
+    indicates that a client is watching all IDs. Alongside it, a reverse index
+    from each ID to the clients watching it and a set of clients watching
+    all IDs are maintained. This means the clients to notify about a set of
+    changes (see :py:meth:`.recipients`) are found in time proportional to
+    the number of changes and recipients rather than the number of clients.
+
+    To keep the index up-to-date, watches must only be changed using
+    :py:meth:`.register`, :py:meth:`.unregister`, ``watches[client] = ...``,
+    ``del watches[client]`` or ``watches.pop(client)``.
+    """
+
+    def __init__(self):
+        super(_Watches, self).__init__()
+
+        # The clients watching all IDs.
+        self._wildcard = set()
+
+        # The clients watching each individual ID.
+        # {id: set([client, ...]), ...}
+        self._by_id = {}
+
+    def __setitem__(self, client, ids):
+        self.pop(client, None)
+        super(_Watches, self).__setitem__(client, ids)
+        if ids is None:
+            self._wildcard.add(client)
+        else:
+            for id in ids:
+                self._by_id.setdefault(id, set()).add(client)
+
+    def __delitem__(self, client):
+        self.pop(client)
+
+    def pop(self, client, *default):
+        if client not in self:
+            return super(_Watches, self).pop(client, *default)
+
+        ids = super(_Watches, self).pop(client)
+        if ids is None:
+            self._wildcard.discard(client)
+        else:
+            for id in ids:
+                self._remove_from_index(client, id)
+        return ids
+
+    def _remove_from_index(self, client, id):
+        clients = self._by_id[id]
+        clients.discard(client)
+        if not clients:
+            del self._by_id[id]
+
+    def register(self, client, id):
+        """Start watching an ID (or all IDs if id is None)."""
+        if id is None:
+            self[client] = None
+        elif client not in self:
+            self[client] = set([id])
+        elif self[client] is not None:
+            self[client].add(id)
+            self._by_id.setdefault(id, set()).add(client)
+        else:
+            # Client is already notified about all changes, do nothing!
+            pass
+
+    def unregister(self, client, id):
+        """Stop watching an ID (or all IDs if id is None)."""
+        if client not in self:
+            return
+        if id is None:
+            del self[client]
+        else:
+            ids = self[client]
+            if ids is not None and id in ids:
+                ids.discard(id)
+                self._remove_from_index(client, id)
+                if len(ids) == 0:
+                    del self[client]
+
+    def recipients(self, changes):
+        """Determine which clients are watching a set of changed IDs.
+
+        Parameters
+        ----------
+        changes : set
+            The IDs which have changed.
+
+        Returns
+        -------
+        {client: set([id, ...]), ...}
+            The clients watching any of the changed IDs, along with the subset
+            of the changes each client is watching.
+        """
+        out = {}
+        for id in changes:
+            for client in self._by_id.get(id, ()):
+                out.setdefault(client, set()).add(id)
+        if changes:
+            for client in self._wildcard:
+                out[client] = changes
+        return out
+
+
+def _reply(value):
+    """Get the reply message to send for a value returned by a command."""
+    if isinstance(value, _CachedReply):
+        return value
+    else:
+        return {"return": value}
+
+
 class Server(object):
     """A TCP server which manages, power, partitioning and scheduling of jobs
     on SpiNNaker machines.
@@ -68,10 +234,18 @@ class Server(object):
     :py:func:`.spalloc_command` decorator. These may be called by a client by sending
     a line ``{"command": "...", "args": [...], "kwargs": {...}}``. If the
     function throws an exception, the client is disconnected. If the function
-    returns, it is packed as a JSON line ``{"return": ...}``.
+    returns, it is packed as a JSON line ``{"return": ...}``. Clients may
+    switch to another encoding for these messages (see
+    :py:mod:`spalloc_server.protocol`) using the :py:meth:`.set_protocol`
+    command.
+
+    Optionally, every command dispatched, along with BMP request completions
+    and job timeouts, may be recorded in a :py:mod:`trace
+    <spalloc_server.trace>` which may later be replayed using
+    :py:mod:`spalloc_server.replay`.
     """
 
-    def __init__(self, config_filename, cold_start=False):
+    def __init__(self, config_filename, cold_start=False, trace_filename=None):
         """
         Parameters
         ----------
@@ -81,6 +255,11 @@ class Server(object):
         cold_start : bool, optional
             If False (the default), the server will attempt to restore its
             previous state, if True, the server will start from scratch.
+        trace_filename : str or None, optional
+            If not None, the filename of a trace file to record the server's
+            activity in. Any existing file is overwritten. Since jobs which
+            existed before the trace was started are not recorded, traces
+            intended for replay should be recorded from a cold start.
         """
         self._config_filename = config_filename
         self._cold_start = cold_start
@@ -110,12 +289,20 @@ class Server(object):
         # {fd: buf, ...}
         self._client_buffers = {}
 
-        # For each client, contains a set() of job IDs and machine names that
-        # the client is watching for changes or None if all changes are to be
-        # monitored.
-        # {socket: set or None, ...}
-        self._client_job_watches = {}
-        self._client_machine_watches = {}
+        # The number of bytes to request from each client's socket.
+        # {socket: int, ...}
+        self._client_recv_sizes = {}
+
+        # Data waiting to be sent to each socket. Client sockets are
+        # non-blocking and any data which cannot be sent immediately is sent
+        # when the socket next becomes writable.
+        # {socket: bytearray, ...}
+        self._client_output_buffers = {}
+
+        # The set of clients with data waiting to be sent. These clients are
+        # polled for POLLOUT and no further commands are read from them until
+        # they have received all their outstanding data.
+        self._throttled_clients = set()
 
         # The current server configuration options. Once server started, should
         # only be accessed from the server thread.
@@ -128,11 +315,11 @@ class Server(object):
                                   __version__))
 
         # Attempt to restore saved state if required
-        self._controller = None
+        controller = None
         if not self._cold_start and os.path.isfile(self._state_filename):
             try:
                 with open(self._state_filename, "rb") as f:
-                    self._controller = pickle.load(f)
+                    controller = pickle.load(f)
                 logging.info("Server warm-starting from %s.",
                             self._state_filename)
             except:
@@ -142,14 +329,26 @@ class Server(object):
                     self._state_filename)
 
         # Perform cold-start if no saved state was loaded
-        if self._controller is None:
+        if controller is None:
             logging.info("Server cold-starting.")
-            self._controller = Controller()
+            controller = Controller()
+
+        trace = None
+        if trace_filename is not None:
+            trace = TraceWriter(open(trace_filename, "wb"))
+
+        self._init_command_state(controller, trace)
 
         # Notify the background thread when something changes in the background
         # of the controller (e.g. power state changes).
         self._controller.on_background_state_change = self._notify
 
+        # Record BMP activity and job timeouts in the trace
+        if self._trace is not None:
+            self._controller.on_bmp_request_complete = \
+                self._trace.bmp_request_complete
+            self._controller.on_jobs_timed_out = self._trace.jobs_timed_out
+
         # Read configuration file. This must succeed when the server is first
         # being started.
         if not self._read_config_file():
@@ -164,6 +363,63 @@ class Server(object):
         # Flag for checking if the server is still alive
         self._running = True
 
+    @classmethod
+    def command_dispatcher(cls, controller):
+        """Create a server object which only executes commands.
+
+        The object has no sockets, background thread or config file and
+        commands are executed by calling :py:meth:`._dispatch_command`
+        directly with any (hashable) object identifying the client. This is
+        used, for example, to replay traces (see
+        :py:mod:`spalloc_server.replay`).
+
+        Parameters
+        ----------
+        controller : :py:class:`~spalloc_server.controller.Controller`
+            The controller the commands act upon.
+        """
+        server = cls.__new__(cls)
+        server._init_command_state(controller)
+        return server
+
+    def _init_command_state(self, controller, trace=None):
+        """Initialise the state used when dispatching commands.
+
+        All state read or modified by :py:meth:`._dispatch_command` (and the
+        commands it calls) must be initialised here so that it is also
+        available to objects created by :py:meth:`.command_dispatcher`.
+
+        Parameters
+        ----------
+        controller : :py:class:`~spalloc_server.controller.Controller`
+        trace : :py:class:`~spalloc_server.trace.TraceWriter` or None
+            The trace to record the server's activity in, if any.
+        """
+        self._controller = controller
+        self._trace = trace
+
+        # The protocol used to encode messages to and from each socket.
+        # {socket: protocol, ...}
+        self._client_protocols = {}
+
+        # For each client, contains a set() of job IDs and machine names that
+        # the client is watching for changes or None if all changes are to be
+        # monitored.
+        # {socket: set or None, ...}
+        self._client_job_watches = _Watches()
+        self._client_machine_watches = _Watches()
+
+        # As _client_job_watches but for clients which are sent the new state
+        # of each changed job (see notify_job's "states" argument).
+        # {socket: set or None, ...}
+        self._client_job_state_watches = _Watches()
+
+        # Cached replies to the list_jobs and list_machines commands along
+        # with the controller's jobs_version/machine_list_version when they
+        # were generated. (version, :py:class:`._CachedReply`) or None.
+        self._list_jobs_reply = None
+        self._list_machines_reply = None
+
     def _notify(self):
         """Notify the background thread that something has happened.
 
@@ -237,21 +493,34 @@ class Server(object):
             self._close()
 
             # Create a new server socket
-            self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self._server_socket.bind((new.ip, new.port))
-            self._server_socket.listen(5)
-            self._poll.register(self._server_socket, select.POLLIN)
-
-        # Update the controller
-        self._controller.max_retired_jobs = new.max_retired_jobs
-        self._controller.machines = OrderedDict((m.name, m)
-                                                for m in new.machines)
+            self._listen(new.ip, new.port)
+
+        # Update the controller. The new config is traced while the
+        # controller is locked so that it is recorded before the BMP requests
+        # it causes complete and after those already traced by other threads.
+        with self._controller:
+            if self._trace is not None:
+                self._trace.config(config_script)
+            self._controller.max_retired_jobs = new.max_retired_jobs
+            self._controller.max_bmp_workers = new.max_bmp_workers
+            self._controller.machines = OrderedDict((m.name, m)
+                                                    for m in new.machines)
 
         logging.info("Config file %s read successfully.",
                      self._config_filename)
         return True
 
+    def _listen(self, ip, port):
+        """Create the server socket and start listening for connections.
+
+        Parameters
+        ----------
+        ip : str
+        port : int
+        """
+        self._server_socket = _create_server_socket(ip, port)
+        self._poll.register(self._server_socket, select.POLLIN)
+
     def _close(self):
         """Close all server sockets and disconnect all client connections."""
         if self._server_socket is not None:
@@ -275,11 +544,16 @@ class Server(object):
         # Remove from the client list
         del self._client_sockets[client.fileno()]
 
-        # Clear input buffer
+        # Clear input and output buffers
         del self._client_buffers[client]
+        self._client_recv_sizes.pop(client, None)
+        self._client_output_buffers.pop(client, None)
+        self._client_protocols.pop(client, None)
+        self._throttled_clients.discard(client)
 
         # Clear any watches
         self._client_job_watches.pop(client, None)
+        self._client_job_state_watches.pop(client, None)
         self._client_machine_watches.pop(client, None)
 
         # Stop watching the client's socket for data
@@ -293,30 +567,105 @@ class Server(object):
         client, addr = self._server_socket.accept()
         logging.info("New client connected from %s", addr)
 
+        # Messages to the client are buffered, never block
+        client.setblocking(False)
+
         # Watch the client's socket for data
         self._poll.register(client, select.POLLIN)
 
         # Keep a reference to the socket
         self._client_sockets[client.fileno()] = client
 
-        # Create a buffer for data sent by the client
-        self._client_buffers[client] = b""
+        # Create buffers for data sent by and to the client
+        self._client_buffers[client] = bytearray()
+        self._client_recv_sizes[client] = BUFFER_SIZE
+        self._client_output_buffers[client] = bytearray()
+
+        # All clients start off speaking the default protocol
+        self._client_protocols[client] = DEFAULT_PROTOCOL
+
+    def _encode_message(self, client, message):
+        """Encode a message using the client's protocol.
 
-    def _msg_client(self, client, message):
+        Parameters
+        ----------
+        client : :py:class:`socket.Socket`
+            The client the message is destined for.
+        message :
+            The object or array to encode or a :py:class:`._CachedReply`.
+
+        Returns
+        -------
+        bytes
+        """
+        if isinstance(message, _CachedReply):
+            return message.encode(self._client_protocols[client])
+        return self._client_protocols[client].encode(message)
+
+    def _msg_client(self, client, message, flush=True):
         """Low-level way to send a message to a client.
-        
+
+        The message is sent immediately if possible, otherwise it is buffered
+        and sent once the client is ready to receive it. If the client's
+        buffer grows beyond the configured
+        :py:attr:`~spalloc_server.configuration.Configuration.max_client_output_buffer`
+        the client is disconnected and :py:exc:`.OutputBufferFullError` is
+        raised.
+
         Parameters
         ----------
         client : :py:class:`socket.Socket`
             The client that we are sending a message to.
         message :
             The object or array to send. Will be converted to JSON.
+        flush : bool
+            If False, the message is only buffered and will not be sent until
+            :py:meth:`._flush_client` is called, allowing several messages to
+            be sent together.
         """
-        try:
-            client.send(json.dumps(message).encode("utf-8") + b"\n")
-        except:
+        output_buffer = self._client_output_buffers[client]
+        output_buffer += self._encode_message(client, message)
+        if (len(output_buffer) >
+                self._configuration.max_client_output_buffer):
+            logging.warning("Client %s is not reading its messages, "
+                            "disconnecting.", client.getpeername())
             self._disconnect_client(client)
-            raise
+            raise OutputBufferFullError("Client output buffer full.")
+
+        if flush:
+            self._flush_client(client)
+
+    def _flush_client(self, client):
+        """Send as much of a client's buffered output as possible without
+        blocking.
+
+        If not all of the buffered output could be sent, the client is
+        throttled: its socket is polled for POLLOUT (at which point this
+        method should be called again) and no further commands are read from
+        it until the buffer has been emptied.
+
+        Parameters
+        ----------
+        client : :py:class:`socket.Socket`
+        """
+        output_buffer = self._client_output_buffers[client]
+        try:
+            while output_buffer:
+                sent = client.send(output_buffer)
+                del output_buffer[:sent]
+        except (OSError, IOError) as e:
+            if e.errno not in _WOULD_BLOCK:
+                self._disconnect_client(client)
+                raise
+
+        # Throttle (or stop throttling) the client if required
+        throttled = client in self._throttled_clients
+        if output_buffer and not throttled:
+            self._throttled_clients.add(client)
+            self._poll.modify(client, select.POLLOUT)
+        elif not output_buffer and throttled:
+            self._throttled_clients.remove(client)
+            self._poll.modify(client, select.POLLIN)
 
     def _handle_command(self, client, line):
         """Dispatch a single command.
@@ -327,10 +676,41 @@ class Server(object):
             The client that made the request, used to provide a session
             context where relevant.
         line : string
-            The line parsed from the socket. Should be a complete JSON object
-            with at least a 'command' key.
+            The line (or frame) parsed from the socket. Should be a complete
+            JSON object (or equivalent in the client's protocol) with at least
+            a 'command' key.
+        """
+        protocol = self._client_protocols[client]
+        if self._trace is None:
+            return self._dispatch_command(client, protocol.decode(line))
+
+        # When tracing, the command is recorded and dispatched while the
+        # controller is locked so that, in the trace, it comes after any BMP
+        # completions which have already been processed and before those of
+        # any BMP requests it causes.
+        with self._controller:
+            if protocol is DEFAULT_PROTOCOL:
+                self._trace.command(client.fileno(), line)
+                cmd_obj = protocol.decode(line)
+            else:
+                # Traces always contain JSON commands
+                cmd_obj = protocol.decode(line)
+                self._trace.command(client.fileno(),
+                                    DEFAULT_PROTOCOL.encode(cmd_obj)[:-1])
+
+            return self._dispatch_command(client, cmd_obj)
+
+    def _dispatch_command(self, client, cmd_obj):
+        """Execute a single decoded command.
+
+        Parameters
+        ----------
+        client : :py:class:`socket.Socket`
+            The client that made the request.
+        cmd_obj : dict
+            The command, with at least a 'command' key and optionally 'args'
+            and 'kwargs' keys.
         """
-        cmd_obj = json.loads(line.decode("utf-8"))
         command = _COMMANDS[cmd_obj["command"]]
         if command is None:
             raise IOError("unrecognised command name")
@@ -346,9 +726,12 @@ class Server(object):
         ----------
         client : :py:class:`socket.Socket`
         """
+        recv_size = self._client_recv_sizes[client]
         try:
-            data = client.recv(BUFFER_SIZE)
-        except (OSError, IOError):
+            data = client.recv(recv_size)
+        except (OSError, IOError) as e:
+            if e.errno in _WOULD_BLOCK:
+                return
             data = b""
 
         # Did the client disconnect?
@@ -356,71 +739,175 @@ class Server(object):
             self._disconnect_client(client)
             return
 
-        peer = client.getpeername()
-        self._client_buffers[client] += data
-
-        # Process any complete commands (whole lines)
-        while b"\n" in self._client_buffers[client]:
-            line, _, self._client_buffers[client] = \
-                self._client_buffers[client].partition(b"\n")
-            try:
-                # Note that we skip blank lines
-                if len(line) > 0:
-                    self._msg_client(client, {"return": self._handle_command(client, line)})
-            except:
-                # If any of the above fails for any reason (e.g. invalid JSON,
-                # unrecognised command, command crashes, etc.), just disconnect
-                # the client.
-                logging.exception("Client %s sent bad command %r, disconnecting",
-                                  peer, line)
-                return
+        # Adapt the amount requested to the rate the client is sending at
+        if len(data) == recv_size:
+            self._client_recv_sizes[client] = min(recv_size * 2,
+                                                  MAX_BUFFER_SIZE)
+        elif len(data) < recv_size // 4:
+            self._client_recv_sizes[client] = max(recv_size // 2,
+                                                  BUFFER_SIZE)
 
-    def _send_notifications(self, label, changes, watches):
-        """How to actually send requested notifications."""
+        peer = client.getpeername()
+        buffer = self._client_buffers[client]
+        buffer += data
+
+        # Process any complete commands (whole lines or frames, according to
+        # the client's protocol, which may be changed by any command). The
+        # replies to all commands received together are sent together.
+        # Commands are read in-place from the buffer and the consumed bytes
+        # discarded once at the end.
+        start = 0
+        try:
+            while True:
+                try:
+                    line, end = self._client_protocols[client].read_frame(
+                        buffer, start,
+                        self._configuration.max_command_length)
+                except FrameTooLongError:
+                    logging.warning(
+                        "Client %s sent an over-long command, disconnecting",
+                        peer)
+                    self._disconnect_client(client)
+                    return
+                if line is None:
+                    break
+                start = end
+                try:
+                    # Note that we skip blank lines
+                    if len(line) > 0:
+                        self._msg_client(
+                            client,
+                            _reply(self._handle_command(client, line)),
+                            flush=False)
+                except OutputBufferFullError:
+                    # The client has already been disconnected for not
+                    # reading its replies
+                    return
+                except:
+                    # If any of the above fails for any reason (e.g. invalid
+                    # JSON, unrecognised command, command crashes, etc.), just
+                    # disconnect the client.
+                    logging.exception(
+                        "Client %s sent bad command %r, disconnecting",
+                        peer, line)
+                    if client in self._client_buffers:
+                        self._disconnect_client(client)
+                    return
+        finally:
+            del buffer[:start]
+            if client in self._client_output_buffers:
+                try:
+                    self._flush_client(client)
+                except (OSError, IOError):
+                    logging.exception("Could not send to client.")
+
+    def _send_notifications(self, label, changes, watches, describe=list):
+        """How to actually send requested notifications.
+
+        Each watching client is sent ``{label: describe(changes)}`` where
+        ``changes`` is the subset of the changes the client is watching.
+        """
         if changes:
-            for client, items in list(iteritems(watches)):
-                if items is None or not items.isdisjoint(changes):
-                    try:
-                        self._msg_client(client, {label:
-                            list(changes) if items is None else
-                            list(changes.intersection(items))})
-                    except (OSError, IOError):
-                        logging.exception("Could not send notification.")
+            for client, items in iteritems(watches.recipients(changes)):
+                try:
+                    self._msg_client(client, {label: describe(items)})
+                except OutputBufferFullError:
+                    # The client has already been disconnected
+                    pass
+                except (OSError, IOError):
+                    logging.exception("Could not send notification.")
+
+    def _describe_job_changes(self, job_ids):
+        """Get the new state of a set of changed jobs.
+
+        Returns
+        -------
+        {job_id: {...}, ...}
+            The dictionaries sent in "job_states" notifications for each job.
+        """
+        out = {}
+        for job in self._controller.get_job_changes(job_ids):
+            job = job._asdict()
+            job["state"] = int(job["state"])
+            if job["boards"] is not None:
+                job["boards"] = list(job["boards"])
+            out[job["job_id"]] = job
+        return out
 
     def _send_change_notifications(self):
         """Send any registered change notifications to clients.
 
-        Sends notifications of the forms ``{"jobs_changed": [job_id, ...]}``
-        and ``{"machines_changed": [machine_name, ...]}`` to clients who have
-        subscribed to be notified of changes to jobs or machines.
+        Sends notifications of the forms ``{"jobs_changed": [job_id, ...]}``,
+        ``{"job_states": [{...}, ...]}`` and ``{"machines_changed":
+        [machine_name, ...]}`` to clients who have subscribed to be notified
+        of changes to jobs or machines.
         """
+        changed_jobs = self._controller.changed_jobs
+
         # Notify clients about jobs which have changed
         self._send_notifications("jobs_changed",
-                                self._controller.changed_jobs,
-                                self._client_job_watches)
+                                 changed_jobs,
+                                 self._client_job_watches)
+
+        # Send the new state of changed jobs to clients who asked for it. The
+        # state of each job is fetched just once for all clients.
+        if changed_jobs and self._client_job_state_watches:
+            job_states = self._describe_job_changes(changed_jobs)
+            self._send_notifications(
+                "job_states", changed_jobs, self._client_job_state_watches,
+                lambda job_ids: [job_states[job_id]
+                                 for job_id in sorted(job_ids)])
+
         # Notify clients about machines which have changed
         self._send_notifications("machines_changed",
                                  self._controller.changed_machines,
                                  self._client_machine_watches)
 
+    def _get_timeout(self):
+        """Get the number of seconds the server may wait for events before it
+        must next check for timed out jobs.
+
+        This is the time until the controller's next job timeout, limited to
+        the configured timeout_check_interval.
+        """
+        timeout = self._configuration.timeout_check_interval
+        next_timeout = self._controller.next_timeout
+        if next_timeout is not None:
+            timeout = min(timeout, max(0.0, next_timeout - time.time()))
+        return timeout
+
+    def _destroy_timed_out_jobs(self):
+        """Destroy any jobs which have timed out, if the controller's next job
+        timeout has been reached.
+
+        The controller's lock is only taken once a job may have timed out.
+        """
+        next_timeout = self._controller.next_timeout
+        if next_timeout is None or next_timeout >= time.time():
+            return
+
+        # Timed out jobs are traced by the controller
+        self._controller.destroy_timed_out_jobs()
+
     def _run(self):
         """The main server thread.
 
         This 'infinite' loop runs in a background thread and waits for and
         processes events such as the :py:meth:`._notify` method being called,
         the config file changing, clients sending commands or new clients
-        connecting. It also periodically calls destroy_timed_out_jobs on the
-        controller.
+        connecting. It also calls destroy_timed_out_jobs on the controller
+        whenever the next job timeout is reached.
         """
         logging.info("Server running.")
         while not self._stop:
             # Wait for a connection to get opened/closed, a command to arrive,
-            # the config file to change or the timeout to ellapse.
+            # the config file to change or the next job timeout. (Note: poll
+            # takes a timeout in milliseconds.)
             events = self._poll.poll(
-                self._configuration.timeout_check_interval)
+                int(math.ceil(self._get_timeout() * 1000.0)))
 
             # Cull any jobs which have timed out
-            self._controller.destroy_timed_out_jobs()
+            self._destroy_timed_out_jobs()
 
             for fd, event in events:
                 if fd == self._notify_recv.fileno():
@@ -430,8 +917,17 @@ class Server(object):
                     # New client connected
                     self._accept_client()
                 elif fd in self._client_sockets:
-                    # Incoming data from client
-                    self._handle_commands(self._client_sockets[fd])
+                    client = self._client_sockets[fd]
+                    if event & select.POLLOUT:
+                        # Client ready to receive buffered messages
+                        try:
+                            self._flush_client(client)
+                        except (OSError, IOError):
+                            logging.exception("Could not send to client.")
+                            continue
+                    if event & ~select.POLLOUT:
+                        # Incoming data from client (or disconnection)
+                        self._handle_commands(client)
                 else:  # pragma: no cover
                     # Should not get here...
                     assert False
@@ -475,6 +971,9 @@ class Server(object):
         with open(self._state_filename, "wb") as f:
             pickle.dump(self._controller, f)
 
+        if self._trace is not None:
+            self._trace.close()
+
         logging.info("Server shut down.")
 
         self._running = False
@@ -488,6 +987,67 @@ class Server(object):
             The server's version number."""
         return __version__
 
+    @spalloc_command
+    def batch(self, client, commands):
+        """Execute several commands at once.
+
+        The commands are executed in order while holding the controller's
+        lock, so no other client's commands or background state changes (e.g.
+        boards finishing powering on) are interleaved with them. This is
+        useful, for example, to query the state of many jobs in a single round
+        trip.
+
+        If any command fails, the client is disconnected (as for any other
+        failed command) though commands earlier in the batch will already have
+        been executed.
+
+        Parameters
+        ----------
+        commands : [{"command": name, "args": [...], "kwargs": {...}}, ...]
+            The commands to execute, in the same form as commands sent
+            individually.
+
+        Returns
+        -------
+        [value, ...]
+            The value returned by each command, in order.
+        """
+        results = []
+        with self._controller:
+            for cmd_obj in commands:
+                value = self._dispatch_command(client, cmd_obj)
+                if isinstance(value, _CachedReply):
+                    value = value.value
+                results.append(value)
+        return results
+
+    @spalloc_command
+    def set_protocol(self, client, name):
+        """Change the encoding used for messages to and from this client.
+
+        Clients initially exchange JSON objects, one per line, with the server
+        (the "json" protocol). This command may be used to switch to a more
+        compact encoding. The reply to this command and all subsequent
+        messages in either direction (including notifications) use the new
+        protocol. If the protocol is not supported the client is disconnected.
+
+        The following protocols are available:
+
+        ``"json"``
+            JSON objects terminated by a newline (the default).
+        ``"msgpack"``
+            `MessagePack <http://msgpack.org/>`_-encoded objects, each
+            preceded by its length in bytes as a 32-bit big-endian unsigned
+            integer. Only available when the server has the msgpack package
+            installed.
+
+        Parameters
+        ----------
+        name : str
+            The name of the protocol to use.
+        """
+        self._client_protocols[client] = get_protocol(name)
+
     @spalloc_command
     def create_job(self, client, *args, **kwargs):
         """Create a new job (i.e. allocation of boards).
@@ -725,32 +1285,8 @@ class Server(object):
         """
         self._controller.destroy_job(job_id, reason)
 
-    def _register_for_notifications(self, client, watchset, id):
-        """Helper method that handles the protocol for registration for notifications."""
-        if id is None:
-            watchset[client] = None
-        elif client not in watchset:
-            watchset[client] = set([id])
-        elif watchset[client] is not None:
-            watchset[client].add(id)
-        else:
-            # Client is already notified about all changes, do nothing!
-            pass
-    def _unregister_for_notifications(self, client, watchset, id):
-        """Helper method that handles the protocol for unregistration for notifications."""
-        if client not in watchset:
-            return
-        if id is None:
-            del watchset[client]
-        else:
-            watches = watchset[client]
-            if watches is not None:
-                watches.discard(id)
-                if len(watches) == 0:
-                    del watchset[client]
-
     @spalloc_command
-    def notify_job(self, client, job_id=None):
+    def notify_job(self, client, job_id=None, states=False):
         r"""Register to be notified about changes to a specific job ID.
 
         Once registered, a client will be asynchronously be sent notifications
@@ -760,18 +1296,52 @@ class Server(object):
         destroyed. The specific nature of the change is not reflected in the
         notification.
 
+        Alternatively, if the states argument is True, notifications instead
+        take the form ``{"job_states": [{...}, ...]}\n`` giving the new state
+        of each job which has changed, in order of job ID. This allows clients
+        to keep track of jobs without making further queries. Each job is
+        described by a dictionary with the following keys:
+
+        "job_id" is the ID of the job.
+
+        "state" is the current
+        :py:class:`~spalloc_server.controller.JobState` of the job.
+
+        "power" indicates whether the boards are power{ed,ing} on (True) or
+        off (False) when the job is in the ready or power states and is None
+        otherwise.
+
+        "reason" is the reason the job was destroyed, if given (or None).
+
+        "allocated_machine_name" is the name of the machine the job has been
+        allocated to run on (or None if not allocated yet).
+
+        "boards" is a list [(x, y, z), ...] of boards allocated to the job (or
+        None if not allocated yet).
+
+        Note that these notifications do not count as queries of the job: a
+        client must still periodically call ``job_keepalive`` (or
+        query the job) to prevent it timing out.
+
         Parameters
         ----------
         job_id : int or None, optional
             A job ID to be notified of or None if all job state changes should
             be reported.
+        states : bool, optional
+            If True, notifications will include the new state of changed
+            jobs. A client registered both with and without this option will
+            receive both forms of notification.
 
         See Also
         --------
         no_notify_job : Stop being notified about a job.
         notify_machine : Register to be notified about changes to machines.
         """
-        self._register_for_notifications(client, self._client_job_watches, job_id)
+        if states:
+            self._client_job_state_watches.register(client, job_id)
+        else:
+            self._client_job_watches.register(client, job_id)
 
     @spalloc_command
     def no_notify_job(self, client, job_id=None):
@@ -792,7 +1362,8 @@ class Server(object):
         --------
         notify_job : Register to be notified about changes to a specific job.
         """
-        self._unregister_for_notifications(client, self._client_job_watches, job_id)
+        self._client_job_watches.unregister(client, job_id)
+        self._client_job_state_watches.unregister(client, job_id)
 
     @spalloc_command
     def notify_machine(self, client, machine_name=None):
@@ -815,7 +1386,7 @@ class Server(object):
         no_notify_machine : Stop being notified about a machine.
         notify_job : Register to be notified about changes to jobs.
         """
-        self._register_for_notifications(client, self._client_machine_watches, machine_name)
+        self._client_machine_watches.register(client, machine_name)
 
     @spalloc_command
     def no_notify_machine(self, client, machine_name=None):
@@ -836,7 +1407,7 @@ class Server(object):
         --------
         notify_machine : Register to be notified about changes to a machine.
         """
-        self._unregister_for_notifications(client, self._client_machine_watches, machine_name)
+        self._client_machine_watches.unregister(client, machine_name)
 
     @spalloc_command
     def list_jobs(self, client):
@@ -876,16 +1447,24 @@ class Server(object):
 
             "boards" is a list [(x, y, z), ...] of boards allocated to the job.
         """
-        out = []
-        for job in self._controller.list_jobs():
-            job = job._asdict()
-            job["state"] = int(job["state"])
-            if job["boards"] is not None:
-                job["boards"] = list(job["boards"])
-            if job["kwargs"].get("tags", None) is not None:
-                job["kwargs"]["tags"] = list(job["kwargs"]["tags"])
-            out.append(job)
-        return out
+        # The reply is cached until a job changes. Note that the version is
+        # read before the job list: if a job changes in between, the cache
+        # will simply be refreshed by the next call.
+        version = self._controller.jobs_version
+        if (self._list_jobs_reply is None or
+                self._list_jobs_reply[0] != version):
+            out = []
+            for job in self._controller.list_jobs():
+                job = job._asdict()
+                job["state"] = int(job["state"])
+                if job["boards"] is not None:
+                    job["boards"] = list(job["boards"])
+                if job["kwargs"].get("tags", None) is not None:
+                    job["kwargs"] = dict(job["kwargs"],
+                                         tags=list(job["kwargs"]["tags"]))
+                out.append(job)
+            self._list_jobs_reply = (version, _CachedReply(out))
+        return self._list_jobs_reply[1]
 
     @spalloc_command
     def list_machines(self, client):
@@ -912,16 +1491,22 @@ class Server(object):
             locations of known-dead links from the perspective of the sender.
             Links to dead boards may or may not be included in this list.
         """
-        out = []
-        for machine in self._controller.list_machines():
-            machine = machine._asdict()
-            machine["tags"] = list(machine["tags"])
-            machine["dead_boards"] = list(machine["dead_boards"])
-            machine["dead_links"] = [(x, y, z, int(link))
-                                     for x, y, z, link
-                                     in machine["dead_links"]]
-            out.append(machine)
-        return out
+        # The reply is cached until the machines are reconfigured (see
+        # list_jobs)
+        version = self._controller.machine_list_version
+        if (self._list_machines_reply is None or
+                self._list_machines_reply[0] != version):
+            out = []
+            for machine in self._controller.list_machines():
+                machine = machine._asdict()
+                machine["tags"] = list(machine["tags"])
+                machine["dead_boards"] = list(machine["dead_boards"])
+                machine["dead_links"] = [(x, y, z, int(link))
+                                         for x, y, z, link
+                                         in machine["dead_links"]]
+                out.append(machine)
+            self._list_machines_reply = (version, _CachedReply(out))
+        return self._list_machines_reply[1]
 
     @spalloc_command
     def get_board_position(self, client, machine_name, x, y, z):
@@ -1018,6 +1603,45 @@ class Server(object):
         """
         return self._controller.where_is(**kwargs)
 
+    @spalloc_command
+    def where_is_many(self, client, **kwargs):
+        """Find out where many SpiNNaker boards or chips are located in a
+        single command.
+
+        Accepts the same styles of query as :py:meth:`.where_is` except that
+        the coordinates (but not the machine name or job ID) are given as
+        lists of equal length, for example::
+
+            >>> # Locate several chips in a machine.
+            >>> where_is_many(machine=..., chip_x=[...], chip_y=[...])
+
+            >>> # Locate several chips within a job.
+            >>> where_is_many(job_id=..., chip_x=[...], chip_y=[...])
+
+        Returns
+        -------
+        {"machine": ..., "logical": [...], "physical": [...], \
+                "chip": [...], "board_chip": [...], "job_chip": [...], \
+                "job_id": [...]} or None
+            The fields returned by :py:meth:`.where_is` in columnar form: each
+            (except ``machine``) is a list with one entry for each location
+            queried, in the order given. The entries for locations where no
+            board exists (or, when querying by job, which are not part of the
+            job) are all None.
+
+            If the machine or job does not exist, None is returned instead.
+        """
+        return self._controller.where_is_many(**kwargs)
+
+
+def _create_server_socket(ip, port):
+    """Create a TCP socket listening on the specified IP and port."""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((ip, port))
+    server_socket.listen(5)
+    return server_socket
+
 
 def main(args=None):
     """Command-line launcher for the server.
@@ -1042,13 +1666,27 @@ def main(args=None):
                         default=False,
                         help="force a cold start, erasing any existing "
                              "saved state")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="use the asyncio-based server implementation "
+                             "(requires Python 3.7 or later)")
+    parser.add_argument("--trace", metavar="FILE", default=None,
+                        help="record all commands and BMP activity in a "
+                             "trace file which may be replayed with "
+                             "spalloc-server-replay")
     args = parser.parse_args(args)
 
     if not args.quiet:
         logging.basicConfig(level=logging.INFO)
 
-    server = Server(config_filename=args.config,
-                    cold_start=args.cold_start)
+    server_class = Server
+    if args.asyncio:
+        if sys.version_info < (3, 7):
+            parser.error("--asyncio requires Python 3.7 or later")
+        from spalloc_server.async_server import AsyncioServer as server_class
+
+    server = server_class(config_filename=args.config,
+                          cold_start=args.cold_start,
+                          trace_filename=args.trace)
     try:
         # NB: Originally this loop was replaced with a call to server.join
         # however in Python 2, such blocking calls are not interruptible so we
@@ -1062,5 +1700,4 @@ def main(args=None):
 
 
 if __name__ == "__main__":  # pragma: no cover
-    import sys
     sys.exit(main())
@@ -0,0 +1,227 @@
+"""A compact binary log of the activity of a server.
+
+A trace records every command dispatched by a
+:py:class:`~spalloc_server.server.Server`, every BMP request completion and
+every job which times out, along with a timestamp for each. Traces may be
+replayed against a fresh :py:class:`~spalloc_server.controller.Controller`
+using :py:mod:`spalloc_server.replay`, for example to reproduce production
+load offline or to profile the scheduler.
+
+A trace file starts with a short header (:py:data:`.MAGIC` followed by a
+little-endian uint16 format version) followed by a series of records. Each
+record consists of a fixed-size record header (:py:data:`._RECORD_HEADER`)
+followed by a variable length payload:
+
+=========  ======  =====================================================
+Field      Type    Description
+=========  ======  =====================================================
+type       uint8   A :py:class:`.RecordType`.
+timestamp  double  The time at which the record was written (Unix time).
+client     int32   An ID identifying the client which sent a command or
+                   -1 for records not associated with a client.
+length     uint32  The length of the payload in bytes.
+=========  ======  =====================================================
+"""
+
+import json
+import struct
+import threading
+import time
+
+from collections import namedtuple
+
+from enum import IntEnum
+
+MAGIC = b"SPTR"
+"""The bytes at the start of every trace file."""
+
+VERSION = 2
+"""The version of the trace file format written by this module."""
+
+_FILE_HEADER = struct.Struct("<4sH")
+"""The header at the start of a trace file: (magic, version)."""
+
+_RECORD_HEADER = struct.Struct("<BdiI")
+"""The header of every record: (type, timestamp, client, payload length)."""
+
+
+class RecordType(IntEnum):
+    """The types of record which may appear in a trace."""
+
+    config = 0
+    """The server (re-)read its configuration file. The payload is the
+    (UTF-8 encoded) contents of the config file."""
+
+    command = 1
+    """A client sent a command. The payload is the line received from the
+    client (a JSON object)."""
+
+    bmp_request_complete = 2
+    """A BMP request issued on behalf of a job completed. The payload is a
+    JSON list ``[job_id, seq, success]`` where ``seq`` is the controller's
+    sequence number for the request (see
+    :py:attr:`~spalloc_server.controller.Controller.on_bmp_request_complete`).
+    """
+
+    jobs_timed_out = 3
+    """Jobs were destroyed because they were not kept alive. The payload is a
+    JSON list of the job IDs destroyed."""
+
+
+class TraceFormatError(Exception):
+    """Thrown when a trace file is corrupt or of an unsupported version."""
+
+
+class TraceRecord(namedtuple("TraceRecord", "type,timestamp,client,payload")):
+    """A single record read from a trace by :py:func:`.read_trace`.
+
+    Parameters
+    ----------
+    type : :py:class:`.RecordType`
+    timestamp : float
+        The time at which the record was written.
+    client : int or None
+        For :py:attr:`~.RecordType.command` records, an ID identifying the
+        client which sent the command. None otherwise.
+    payload
+        The payload of the record, decoded according to its type:
+
+        * :py:attr:`~.RecordType.config`: the config file contents (str).
+        * :py:attr:`~.RecordType.command`: the line received (bytes).
+        * :py:attr:`~.RecordType.bmp_request_complete`: ``(job_id, seq,
+          success)``.
+        * :py:attr:`~.RecordType.jobs_timed_out`: ``[job_id, ...]``.
+    """
+
+    # Python 3.4 Workaround: https://bugs.python.org/issue24931
+    __slots__ = tuple()
+
+
+class TraceWriter(object):
+    """Writes a trace to a file.
+
+    All methods are thread safe.
+    """
+
+    def __init__(self, f):
+        """
+        Parameters
+        ----------
+        f : file
+            A file opened for writing in binary mode. The file is closed by
+            :py:meth:`.close`.
+        """
+        self._f = f
+        self._lock = threading.Lock()
+
+        self._f.write(_FILE_HEADER.pack(MAGIC, VERSION))
+
+    def _write(self, type, payload, client=-1):
+        """Append a record to the trace.
+
+        Parameters
+        ----------
+        type : :py:class:`.RecordType`
+        payload : bytes
+        client : int
+        """
+        header = _RECORD_HEADER.pack(type, time.time(), client, len(payload))
+        with self._lock:
+            self._f.write(header + payload)
+
+    def config(self, config_script):
+        """Record the contents of a newly loaded config file."""
+        self._write(RecordType.config, config_script.encode("utf-8"))
+
+    def command(self, client, line):
+        """Record a command line received from a client.
+
+        Parameters
+        ----------
+        client : int
+            A non-negative ID which uniquely identifies the client amongst all
+            currently connected clients (e.g. its socket's file number).
+        line : bytes
+            The line received.
+        """
+        self._write(RecordType.command, line, client)
+
+    def bmp_request_complete(self, job_id, seq, success):
+        """Record the completion of a BMP request issued for a job.
+
+        Parameters
+        ----------
+        job_id : int
+        seq : int
+            The sequence number the controller gave the request.
+        success : bool
+        """
+        self._write(RecordType.bmp_request_complete,
+                    json.dumps([job_id, seq, bool(success)]).encode("utf-8"))
+
+    def jobs_timed_out(self, job_ids):
+        """Record the destruction of jobs which were not kept alive."""
+        self._write(RecordType.jobs_timed_out,
+                    json.dumps(list(job_ids)).encode("utf-8"))
+
+    def close(self):
+        """Flush and close the trace file."""
+        with self._lock:
+            self._f.close()
+
+
+def read_trace(f):
+    """Read the records in a trace file.
+
+    Parameters
+    ----------
+    f : file
+        A file opened for reading in binary mode.
+
+    Yields
+    ------
+    :py:class:`.TraceRecord`
+
+    Raises
+    ------
+    TraceFormatError
+        If the file is not a trace, is of an unsupported version or is
+        truncated. Note that records before a truncated record are still
+        produced, allowing traces from servers which crashed to be read.
+    """
+    header = f.read(_FILE_HEADER.size)
+    if len(header) != _FILE_HEADER.size:
+        raise TraceFormatError("File is not a trace.")
+    magic, version = _FILE_HEADER.unpack(header)
+    if magic != MAGIC:
+        raise TraceFormatError("File is not a trace.")
+    if version != VERSION:
+        raise TraceFormatError(
+            "Unsupported trace format version {}.".format(version))
+
+    while True:
+        header = f.read(_RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) != _RECORD_HEADER.size:
+            raise TraceFormatError("Trace is truncated.")
+        type, timestamp, client, length = _RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) != length:
+            raise TraceFormatError("Trace is truncated.")
+
+        try:
+            type = RecordType(type)
+        except ValueError:
+            raise TraceFormatError("Unknown record type {}.".format(type))
+
+        if type == RecordType.config:
+            payload = payload.decode("utf-8")
+        elif type == RecordType.bmp_request_complete:
+            job_id, seq, success = json.loads(payload.decode("utf-8"))
+            payload = (job_id, seq, success)
+        elif type == RecordType.jobs_timed_out:
+            payload = json.loads(payload.decode("utf-8"))
+
+        yield TraceRecord(type, timestamp,
+                          client if client >= 0 else None, payload)
@@ -17,11 +17,12 @@ def MockABC(monkeypatch):  # pragma: no cover
 
         num_created = 0
 
-        def __init__(self, hostname, on_thread_start=None):
+        def __init__(self, hostname, on_thread_start=None, engine=None):
             MockAsyncBMPController.num_created += 1
 
             self.hostname = hostname
             self.on_thread_start = on_thread_start
+            self.engine = engine
 
             # A lock which must be held when handling a request (may be used to
             # simulate the machine taking some amount of time to respond)
@@ -1,10 +1,16 @@
 import pytest
 
+import pickle
+
+import random
+
+from mock import Mock
+
 from rig.links import Links
 
 from spalloc_server.coordinates import board_down_link, WrapAround
 from spalloc_server.allocator import \
-    _AllocationType, _CandidateFilter, Allocator
+    _AllocationType, _CandidateFilter, _LRUCache, Allocator, PACKERS
 
 
 class TestCandidateFilter(object):
@@ -251,9 +257,149 @@ class TestCandidateFilter(object):
 
         assert cf(0, 0, 1, 1) == (expected_boards < 3)
 
+    @pytest.mark.parametrize("max_dead_links", [None, 0, 2, 10])
+    @pytest.mark.parametrize("max_dead_boards", [None, 0, 1, 4])
+    def test_quick_reject(self, max_dead_boards, max_dead_links):
+        # Quick rejection should never reject a candidate which would be
+        # accepted by a full check.
+        w, h = 4, 3
+        rng = random.Random(0)
+        all_boards = [(x, y, z) for x in range(w) for y in range(h)
+                      for z in range(3)]
+        for _ in range(10):
+            dead_boards = set(b for b in all_boards if rng.random() < 0.1)
+            dead_links = set((x, y, z, link) for x, y, z in all_boards
+                             for link in Links if rng.random() < 0.05)
+            cf = _CandidateFilter(w, h, dead_boards, dead_links,
+                                  max_dead_boards, max_dead_links, False)
+            for x in range(w):
+                for y in range(h):
+                    for width in range(1, w - x + 1):
+                        for height in range(1, h - y + 1):
+                            if cf._quick_reject(x, y, width, height):
+                                cf._quick_reject = lambda *args: False
+                                assert not cf(x, y, width, height)
+                                del cf._quick_reject
+
+    def test_quick_reject_dead_boards(self):
+        # A dead bottom-left board is always rejected
+        cf = _CandidateFilter(2, 2, set([(1, 1, 0)]), set(),
+                              None, None, False)
+        assert cf._quick_reject(1, 1, 1, 1)
+        assert not cf._quick_reject(0, 0, 2, 2)
+
+        # Too many dead boards within the region
+        cf = _CandidateFilter(2, 2, set([(1, 1, 1), (0, 1, 2)]), set(),
+                              1, None, False)
+        assert cf._quick_reject(0, 0, 2, 2)
+        assert not cf._quick_reject(0, 0, 1, 2)
+        assert not cf._quick_reject(0, 0, 2, 1)
+
+    def test_cache(self):
+        w, h = 4, 3
+        cache = _LRUCache(10)
+        cf = _CandidateFilter(w, h, set([(1, 1, 0)]), set(), 0, None, False,
+                              cache=cache)
+
+        # Results should be cached, whether successful or not
+        assert cf(0, 0, 1, 1)
+        boards = cf.boards
+        assert cf(1, 1, 1, 1) is False
+        assert len(cache) == 2
+
+        cf._check = Mock(side_effect=Exception())
+        assert cf(1, 1, 1, 1) is False
+        assert cf(0, 0, 1, 1)
+        assert cf.boards == boards
+
+        # The copy of the boards returned should be independent of the cache
+        cf.boards.clear()
+        assert cf(0, 0, 1, 1)
+        assert cf.boards == boards
+
+        # Different requirements should not hit the cache
+        cf2 = _CandidateFilter(w, h, set([(1, 1, 0)]), set(), 1, None, False,
+                               cache=cache)
+        assert cf2(0, 0, 1, 1)
+        assert len(cache) == 3
+
+
+def test_lru_cache():
+    cache = _LRUCache(2)
+    assert cache.get(1) is None
+
+    cache.set(1, "one")
+    cache.set(2, "two")
+    assert len(cache) == 2
+    assert cache.get(1) == "one"
+
+    # Least recently used entry should be evicted
+    cache.set(3, "three")
+    assert len(cache) == 2
+    assert cache.get(2) is None
+    assert cache.get(1) == "one"
+    assert cache.get(3) == "three"
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.get(1) is None
+
 
 class TestAllocator(object):
 
+    def test_candidate_cache(self):
+        a = Allocator(3, 4)
+        assert a._alloc_triads_possible(2, 2, max_dead_boards=0)
+        assert len(a._candidate_cache) > 0
+
+        # Changing the faults in the machine should invalidate the cache
+        a.dead_boards.update([(0, 0, 0), (0, 3, 0), (2, 0, 0), (2, 3, 0)])
+        assert a._alloc_triads_possible(2, 2, max_dead_boards=0) is False
+        a.dead_boards = set()
+        assert a._alloc_triads_possible(2, 2, max_dead_boards=0)
+
+    @pytest.mark.parametrize("packer", ["pack_tree", "max_rects"])
+    def test_packer(self, packer):
+        # Should work equally well with any packer
+        a = Allocator(3, 4, dead_boards=set([(0, 0, 1)]), packer=packer)
+        assert isinstance(a.pack_tree, PACKERS[packer])
+
+        allocs = [a.alloc(1, 2), a.alloc(5), a.alloc(), a.alloc(1, 1, 2)]
+        assert None not in allocs
+        assert a.alloc(3, 4) is None
+        for allocation_id, _, _, _ in allocs:
+            a.free(allocation_id)
+        assert a.alloc(3, 4) is not None
+
+    def test_pickle(self):
+        a = Allocator(3, 4, dead_boards=set([(0, 0, 1)]))
+        assert len(a.alloc(2, 2)[1]) == 2 * 2 * 3 - 1
+        a2 = pickle.loads(pickle.dumps(a))
+        assert len(a2._candidate_cache) == 0
+        assert a2.alloc(2, 2) is not None
+        assert a2.alloc(2, 2) is None
+
+    def test_connectivity(self):
+        a = Allocator(3, 4)
+        ci = a.connectivity
+        assert ci.count(ci.live) == 3 * 4 * 3
+
+        # Should be reused while the faults remain the same
+        assert a.connectivity is ci
+
+        # Should be rebuilt when the faults are changed, either in-place or by
+        # replacement
+        a.dead_boards.add((0, 0, 0))
+        ci = a.connectivity
+        assert ci.count(ci.live) == (3 * 4 * 3) - 1
+        a.dead_boards = set()
+        ci = a.connectivity
+        assert ci.count(ci.live) == 3 * 4 * 3
+
+        a.dead_links = set((0, 0, 0, link) for link in Links)
+        assert a.connectivity.boards(a.connectivity.reachable(0, 0, 3, 4)) \
+            == set([(0, 0, 0)])
+
     def test_alloc_triads_dead_boards(self):
         # Should not be able to allocate if too many boards are dead
         a = Allocator(3, 4, dead_boards=set([(0, 0, 0)]))
@@ -4,11 +4,21 @@ from mock import Mock, call
 
 import threading
 
-from spalloc_server.async_bmp_controller import AsyncBMPController
+import time
+
+from spalloc_server import async_bmp_controller
+from spalloc_server.async_bmp_controller import \
+    AsyncBMPController, BMPEngine, LINK_BATCH_SIZE, LINK_WINDOW_SIZE
 
 from rig.links import Links
 
 
+@pytest.fixture(autouse=True)
+def no_post_power_on_delay(monkeypatch):
+    """Don't wait for (non-existent) boards to start up."""
+    monkeypatch.setattr(async_bmp_controller, "POST_POWER_ON_DELAY", 0.0)
+
+
 @pytest.yield_fixture
 def abc():
     """Make an AsyncBMPController and stop it at the end."""
@@ -85,7 +95,8 @@ def test_set_power(abc, bc, power_side_effect, success):
     abc.set_power(10, False, e)
     e.wait()
     assert e.success is success
-    bc.set_power.assert_called_once_with(state=False, board=set([10]))
+    bc.set_power.assert_called_once_with(
+        state=False, board=set([10]), post_power_on_delay=0.0)
     bc.set_power.reset_mock()
 
     e = OnDoneEvent()
@@ -93,7 +104,8 @@ def test_set_power(abc, bc, power_side_effect, success):
     bc.set_power.side_effect = power_side_effect
     e.wait()
     assert e.success is success
-    bc.set_power.assert_called_once_with(state=True, board=set([11]))
+    bc.set_power.assert_called_once_with(
+        state=True, board=set([11]), post_power_on_delay=0.0)
     bc.set_power.reset_mock()
 
 
@@ -111,7 +123,8 @@ def test_set_power_blocks(abc, bc):
     assert done_event.wait(0.1) is False
 
     # We should be sure the power command is blocking on the BMP call
-    bc.set_power.assert_called_once_with(state=False, board=set([10]))
+    bc.set_power.assert_called_once_with(
+        state=False, board=set([10]), post_power_on_delay=0.0)
 
     # When the BMP call completes, so should the done_event!
     event.set()
@@ -138,7 +151,8 @@ def test_set_power_merge(abc, bc, power_side_effect, success):
         event.wait()
         assert event.success is success
 
-    bc.set_power.assert_called_once_with(state=False, board=set([10, 11, 13]))
+    bc.set_power.assert_called_once_with(
+        state=False, board=set([10, 11, 13]), post_power_on_delay=0.0)
 
 
 @pytest.mark.timeout(1.0)
@@ -154,9 +168,9 @@ def test_set_power_dont_merge(abc, bc):
         event.wait()
 
     assert bc.set_power.mock_calls == [
-        call(state=False, board=set([10])),
-        call(state=True, board=set([11])),
-        call(state=False, board=set([12])),
+        call(state=False, board=set([10]), post_power_on_delay=0.0),
+        call(state=True, board=set([11]), post_power_on_delay=0.0),
+        call(state=False, board=set([12]), post_power_on_delay=0.0),
     ]
 
 
@@ -205,6 +219,87 @@ def test_set_link_enable_blocks(abc, bc):
     done_event.wait()
 
 
+@pytest.fixture
+def connection(bc):
+    """Mock out the BMPController's SCP connection, acknowledging every packet
+    sent in a burst.
+    """
+    connection = Mock()
+    connection.send_scp_burst.side_effect = \
+        (lambda size, window, calls: [call.callback(b"") for call in calls])
+    bc.connections = {(0, 0): connection}
+    return connection
+
+
+@pytest.mark.timeout(1.0)
+def test_set_link_enable_batch(abc, bc, connection):
+    # Link requests queued together should be sent in a single burst
+    events = [OnDoneEvent() for _ in range(3)]
+    with abc:
+        abc.set_link_enable(10, Links.east, True, events[0])
+        abc.set_link_enable(10, Links.north, False, events[1])
+        abc.set_link_enable(11, Links.west, True, events[2])
+    for e in events:
+        e.wait()
+        assert e.success is True
+
+    assert len(bc.write_fpga_reg.mock_calls) == 0
+    assert len(connection.send_scp_burst.mock_calls) == 1
+    _, (size, window, calls), _ = connection.send_scp_burst.mock_calls[0]
+    assert window == LINK_WINDOW_SIZE
+    assert [(c.p, c.arg1, c.arg2, c.arg3, c.data) for c in calls] == [
+        (10, 0x0000005C, 4, 0, b"\x00\x00\x00\x00"),
+        (10, 0x0000005C, 4, 2, b"\x01\x00\x00\x00"),
+        (11, 0x0001005C, 4, 1, b"\x00\x00\x00\x00"),
+    ]
+
+
+@pytest.mark.timeout(1.0)
+def test_set_link_enable_batch_size(abc, bc, connection):
+    # Batches should be limited in size and never change the same link twice
+    events = [OnDoneEvent() for _ in range(LINK_BATCH_SIZE + 2)]
+    with abc:
+        for i, e in enumerate(events[:-1]):
+            abc.set_link_enable(i, Links.east, True, e)
+        abc.set_link_enable(LINK_BATCH_SIZE, Links.east, False, events[-1])
+    for e in events:
+        e.wait()
+        assert e.success is True
+
+    assert [len(c[1][2]) for c in connection.send_scp_burst.mock_calls] == \
+        [LINK_BATCH_SIZE]
+    bc.write_fpga_reg.assert_has_calls([
+        call(0, 0x5C, False, board=LINK_BATCH_SIZE),
+        call(0, 0x5C, True, board=LINK_BATCH_SIZE),
+    ])
+
+
+@pytest.mark.timeout(1.0)
+def test_set_link_enable_batch_failure(abc, bc, connection):
+    # If a burst fails, unacknowledged requests should be retried individually
+    def burst(size, window, calls):
+        calls[0].callback(b"")
+        raise IOError("Fail.")
+    connection.send_scp_burst.side_effect = burst
+
+    def write_fpga_reg(fpga, addr, value, board):
+        if board == 12:
+            raise IOError("Fail.")
+    bc.write_fpga_reg.side_effect = write_fpga_reg
+
+    events = [OnDoneEvent() for _ in range(3)]
+    with abc:
+        for board, e in zip((10, 11, 12), events):
+            abc.set_link_enable(board, Links.east, True, e)
+    for e in events:
+        e.wait()
+    assert [e.success for e in events] == [True, True, False]
+    assert bc.write_fpga_reg.mock_calls == [
+        call(0, 0x5C, False, board=11),
+        call(0, 0x5C, False, board=12),
+    ]
+
+
 @pytest.mark.timeout(1.0)
 def test_power_priority(abc, bc):
     # Make sure that power queue has higher priority
@@ -225,7 +320,8 @@ def test_power_priority(abc, bc):
     assert e1.wait(0.1) is False
 
     # Make sure just the power command has been called
-    bc.set_power.assert_called_once_with(state=True, board=set([10]))
+    bc.set_power.assert_called_once_with(
+        state=True, board=set([10]), post_power_on_delay=0.0)
     bc.set_power.reset_mock()
     assert len(bc.write_fpga_reg.mock_calls) == 0
 
@@ -238,7 +334,8 @@ def test_power_priority(abc, bc):
 
     # Make sure just the power command has been called a second time (and not
     # the link setting command)
-    bc.set_power.assert_called_once_with(state=False, board=set([12]))
+    bc.set_power.assert_called_once_with(
+        state=False, board=set([12]), post_power_on_delay=0.0)
     bc.set_power.reset_mock()
     assert len(bc.write_fpga_reg.mock_calls) == 0
 
@@ -289,6 +386,36 @@ def test_power_removes_link_enables(abc, bc):
     bc.write_fpga_reg.assert_called_once_with(0, 0x5C, False, board=10)
 
 
+@pytest.mark.timeout(1.0)
+def test_power_removes_link_enables_in_order(abc, bc, connection):
+    # Cancelling a board's link requests should leave the other boards'
+    # requests queued in their original order
+    with abc:
+        events = [OnDoneEvent() for _ in range(5)]
+        abc.set_link_enable(10, Links.east, True, events[0])
+        abc.set_link_enable(11, Links.east, True, events[1])
+        abc.set_link_enable(10, Links.west, True, events[2])
+        abc.set_link_enable(12, Links.east, True, events[3])
+        abc.set_power(10, False, events[4])
+
+        # Only the cancelled requests should be completed (unsuccessfully)
+        assert events[0].success is False
+        assert events[1].success is None
+        assert events[2].success is False
+        assert events[3].success is None
+        assert [r.board for r in abc._link_requests.values()] == [11, 12]
+        assert sorted(abc._board_link_requests) == [11, 12]
+
+    for e in events:
+        e.wait()
+    assert [e.success for e in events] == [False, True, False, True, True]
+
+    # The remaining link requests should be sent in order (once powered)
+    _, (size, window, calls), _ = connection.send_scp_burst.mock_calls[0]
+    assert [c.p for c in calls] == [11, 12]
+    assert abc._board_link_requests == {}
+
+
 @pytest.mark.timeout(1.0)
 def test_stop_drains(abc, bc):
     # Make sure that the queues are emptied before the stop command is
@@ -308,3 +435,181 @@ def test_stop_drains(abc, bc):
 
     # And the loop should stop!
     abc.join()
+
+
+@pytest.mark.timeout(1.0)
+def test_shared_engine():
+    # Several controllers should share a bounded number of worker threads
+    # while each BMP's requests are still carried out in order.
+    engine = BMPEngine(num_workers=2)
+    abcs = [AsyncBMPController("localhost", engine=engine) for _ in range(4)]
+    bcs = []
+    for abc in abcs:
+        abc._bc = Mock()
+        bcs.append(abc._bc)
+
+    # Block the BMPs until all requests have been queued
+    event = threading.Event()
+    for bc in bcs:
+        bc.set_power.side_effect = (lambda *a, **k: event.wait())
+
+    done = []
+    for abc in abcs:
+        with abc:
+            for board in range(3):
+                e = OnDoneEvent()
+                abc.set_power(board, board % 2 == 0, e)
+                done.append(e)
+    assert len(engine._workers) == 2
+
+    event.set()
+    for e in done:
+        e.wait()
+        assert e.success is True
+
+    for bc in bcs:
+        assert bc.set_power.mock_calls == [
+            call(state=True, board=set([0]), post_power_on_delay=0.0),
+            call(state=False, board=set([1]), post_power_on_delay=0.0),
+            call(state=True, board=set([2]), post_power_on_delay=0.0),
+        ]
+
+    for abc in abcs:
+        abc.stop()
+    for abc in abcs:
+        abc.join()
+    engine.stop()
+    engine.join()
+    assert engine._workers == []
+
+
+@pytest.mark.timeout(1.0)
+def test_idle_workers_exit(monkeypatch):
+    # Workers beyond the minimum should exit once idle for a while
+    monkeypatch.setattr(async_bmp_controller, "WORKER_IDLE_TIMEOUT", 0.1)
+    engine = BMPEngine(num_workers=3, min_workers=1)
+    abcs = [AsyncBMPController("localhost", engine=engine) for _ in range(3)]
+
+    event = threading.Event()
+    done = []
+    for abc in abcs:
+        abc._bc = Mock()
+        abc._bc.set_power.side_effect = (lambda *a, **k: event.wait())
+        e = OnDoneEvent()
+        abc.set_power(10, False, e)
+        done.append(e)
+    assert len(engine._workers) == 3
+
+    event.set()
+    for e in done:
+        e.wait()
+    time.sleep(0.3)
+    assert len(engine._workers) == 1
+
+    # New workers are started again when needed
+    event.clear()
+    for abc in abcs:
+        abc.set_power(10, False, OnDoneEvent())
+    assert len(engine._workers) == 3
+    event.set()
+
+    for abc in abcs:
+        abc.stop()
+        abc.join()
+    engine.stop()
+    engine.join()
+    assert engine._workers == []
+
+
+@pytest.mark.timeout(1.0)
+def test_on_thread_start_delays_requests():
+    # Requests should not be carried out until on_thread_start returns. It is
+    # called by the engine's start-up thread and so never ties up a worker,
+    # even when the engine has only one.
+    engine = BMPEngine(num_workers=1)
+    started = threading.Event()
+    abc = AsyncBMPController("localhost", on_thread_start=started.wait,
+                             engine=engine)
+    bc = abc._bc = Mock()
+
+    e = OnDoneEvent()
+    abc.set_power(10, True, e)
+    assert e.wait(0.1) is False
+    assert not bc.set_power.called
+
+    # Start-up functions are called in order...
+    other_started = threading.Event()
+    another = AsyncBMPController(
+        "localhost", on_thread_start=other_started.set, engine=engine)
+    assert other_started.wait(0.1) is False
+
+    # ...but another controller may use the engine in the meantime
+    other = AsyncBMPController("localhost", engine=engine)
+    other._bc = Mock()
+    other_done = OnDoneEvent()
+    other.set_power(11, True, other_done)
+    other_done.wait()
+    other.stop()
+    other.join()
+
+    assert len(engine._workers) == 1
+
+    started.set()
+    e.wait()
+    bc.set_power.assert_called_once_with(
+        state=True, board=set([10]), post_power_on_delay=0.0)
+    assert other_started.wait(0.1) is True
+
+    for a in (abc, another):
+        a.stop()
+        a.join()
+    engine.stop()
+    engine.join()
+    assert engine._starter is None
+
+
+def test_engine_needs_a_worker():
+    with pytest.raises(ValueError):
+        BMPEngine(num_workers=0)
+
+    engine = BMPEngine(num_workers=1)
+    with pytest.raises(ValueError):
+        engine.num_workers = 0
+    assert engine.num_workers == 1
+
+
+@pytest.mark.timeout(1.0)
+def test_post_power_on_delay(monkeypatch):
+    # Power-on commands (and the requests queued behind them) should only
+    # complete once the boards have had time to start up, without occupying
+    # a worker in the meantime.
+    monkeypatch.setattr(async_bmp_controller, "POST_POWER_ON_DELAY", 0.3)
+    engine = BMPEngine(num_workers=1)
+    abc0 = AsyncBMPController("localhost", engine=engine)
+    abc1 = AsyncBMPController("localhost", engine=engine)
+    abc0._bc = Mock()
+    abc1._bc = Mock()
+
+    power_done = OnDoneEvent()
+    link_done = OnDoneEvent()
+    with abc0:
+        abc0.set_power(10, True, power_done)
+        abc0.set_link_enable(10, Links.east, False, link_done)
+    assert power_done.wait(0.1) is False
+
+    # Other BMPs can be used during the delay
+    other_done = OnDoneEvent()
+    abc1.set_power(11, False, other_done)
+    assert other_done.wait(0.1) is True
+    assert not abc0._bc.write_fpga_reg.called
+
+    power_done.wait()
+    link_done.wait()
+    assert power_done.success is True
+    assert link_done.success is True
+
+    for abc in (abc0, abc1):
+        abc.stop()
+        abc.join()
+    engine.stop()
+    engine.join()
@@ -0,0 +1,245 @@
+import pytest
+
+import json
+import os
+import signal
+import socket
+import time
+
+from mock import Mock
+
+from spalloc_server import __version__
+from spalloc_server.configuration import Configuration
+from spalloc_server.controller import JobState
+from spalloc_server.server import main
+
+import test_server
+from test_server import SimpleClient
+
+from spalloc_server.async_server import AsyncioServer  # noqa: E402
+
+# Share the config file fixtures of the Server tests
+config_dir = test_server.config_dir
+config_file = test_server.config_file
+simple_config = test_server.simple_config
+fast_keepalive_config = test_server.fast_keepalive_config
+
+
+pytestmark = pytest.mark.usefixtures("MockABC")
+
+
+@pytest.yield_fixture
+def s(MockABC, config_file):
+    # A server which is created and shut down with each use.
+    s = AsyncioServer(config_file)
+
+    yield s
+
+    s.stop_and_join()
+
+
+@pytest.yield_fixture
+def c(s):
+    c = SimpleClient()
+    yield c
+    c.close()
+
+
+@pytest.mark.timeout(1.0)
+def test_startup_shutdown(simple_config, s):
+    pass
+
+
+@pytest.mark.timeout(1.0)
+def test_stop_and_join_disconnects(MockABC, simple_config):
+    s = AsyncioServer(simple_config)
+    c = SimpleClient()
+    assert c.call("version") == __version__
+
+    s.stop_and_join()
+    assert c.sock.recv(1024) == b""
+    assert not s.is_alive()
+
+
+@pytest.mark.timeout(1.0)
+def test_version_command(simple_config, s, c):
+    assert c.call("version") == __version__
+
+
+@pytest.mark.timeout(1.0)
+def test_job_management(simple_config, s, c):
+    job_id = c.call("create_job", owner="me")
+    time.sleep(0.05)
+    assert c.call("get_job_state", job_id)["state"] == JobState.ready
+
+    c.call("destroy_job", job_id, reason="Gone.")
+    state = c.call("get_job_state", job_id)
+    assert state["state"] == JobState.destroyed
+    assert state["reason"] == "Gone."
+
+
+@pytest.mark.timeout(1.0)
+def test_pipelined_commands(simple_config, s, c):
+    # Several commands arriving at once should each get a reply, in order
+    c.sock.send(b"".join(
+        json.dumps({"command": "version"}).encode("utf-8") + b"\n\n"
+        for _ in range(10)))
+    for _ in range(10):
+        assert c.get_return() == __version__
+
+
+@pytest.mark.timeout(1.0)
+def test_bad_command(simple_config, s):
+    # If a bad command is sent, the server should just disconnect the client
+    c = SimpleClient()
+    c.send_call("does not exist")
+    assert c.sock.recv(1024) == b""
+
+    # Other clients should be unaffected
+    c = SimpleClient()
+    assert c.call("version") == __version__
+
+
+@pytest.mark.timeout(1.0)
+def test_command_too_long(simple_config, s, c, monkeypatch):
+    monkeypatch.setattr(s, "_configuration",
+                        s._configuration._replace(max_command_length=64))
+    assert c.call("version") == __version__
+    c.sock.send(b"[" * 100)
+    assert c.sock.recv(1024) == b""
+
+
+@pytest.mark.timeout(1.0)
+def test_disconnect(simple_config, s):
+    c = SimpleClient()
+    c.call("notify_job")
+    assert len(s._client_job_watches) == 1
+
+    # The client's state should be cleaned up when it disconnects (even
+    # mid-command)
+    c.sock.send(b'{"command": ')
+    c.close()
+    time.sleep(0.05)
+    assert s._client_sockets == {}
+    assert s._client_job_watches == {}
+
+
+@pytest.mark.timeout(2.0)
+def test_slow_client(simple_config, s):
+    # A client which sends lots of commands but never reads the replies
+    # should not prevent other clients from being served.
+    slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    slow.connect(("127.0.0.1", 22244))
+    slow.setblocking(False)
+    command = json.dumps({"command": "list_machines"}).encode("utf-8") + b"\n"
+    try:
+        for _ in range(10000):
+            slow.send(command)
+    except (OSError, IOError):
+        # The server has stopped reading the slow client's commands
+        pass
+
+    c = SimpleClient()
+    for _ in range(10):
+        assert c.call("version") == __version__
+    c.close()
+    slow.close()
+
+
+@pytest.mark.timeout(2.0)
+def test_disconnect_slow_client(config_file, caplog):
+    # A client which never reads its notifications should eventually be
+    # disconnected
+    with open(config_file, "w") as f:
+        f.write("configuration = Configuration(\n"
+                "    machines=[Machine.single_board(\n"
+                "        'm', bmp_ip='10.0.0.0', spinnaker_ip='11.0.0.0')],\n"
+                "    max_client_output_buffer=1024)\n")
+    s = AsyncioServer(config_file)
+    try:
+        slow = SimpleClient()
+        slow.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow.call("notify_job")
+        while not s._client_sockets:
+            time.sleep(0.01)
+        for client in s._client_sockets.values():
+            client.writer.get_extra_info("socket").setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+        c = SimpleClient()
+        assert c.call("version") == __version__
+        assert len(s._client_sockets) == 2
+        while len(s._client_sockets) > 1:
+            job_id = c.call("create_job", owner="me", keepalive=None)
+            c.call("destroy_job", job_id)
+        assert c.call("version") == __version__
+        c.close()
+        slow.close()
+    finally:
+        s.stop_and_join()
+
+    # The client should be reported as slow, not as failing to be sent to
+    assert "is not reading its messages" in caplog.text
+    assert "Could not send notification" not in caplog.text
+
+
+@pytest.mark.timeout(1.0)
+def test_job_notifications(simple_config, s):
+    c0 = SimpleClient()
+    c1 = SimpleClient()
+    c1.call("notify_job")
+
+    with s._controller._bmp_controllers["m"][(0, 0)].handler_lock:
+        job_id = c0.call("create_job", owner="me")
+        assert c1.get_notification() == {"jobs_changed": [job_id]}
+    assert c1.get_notification() == {"jobs_changed": [job_id]}
+
+    c0.close()
+    c1.close()
+
+
+@pytest.mark.timeout(1.0)
+def test_keepalive_expiration(fast_keepalive_config, s, c):
+    job_id = c.call("create_job", keepalive=0.15, owner="me")
+
+    time.sleep(0.05)
+    assert s._controller.get_job_state(job_id).state != JobState.destroyed
+
+    time.sleep(0.25)
+    assert s._controller.get_job_state(job_id).state == JobState.destroyed
+
+
+@pytest.mark.timeout(1.0)
+def test_reread_config_file(simple_config, s):
+    assert list(s._controller.machines) == ["m"]
+
+    with open(simple_config, "w") as f:
+        f.write("configuration = {}".format(repr(
+            Configuration(port=22245))))
+    os.kill(os.getpid(), signal.SIGHUP)
+    time.sleep(0.2)
+
+    # Configuration should have changed and the server now be listening on
+    # the new port
+    assert list(s._controller.machines) == []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(("127.0.0.1", 22245))
+    sock.send(b'{"command": "version"}\n')
+    assert json.loads(sock.recv(1024).decode("utf-8")) == \
+        {"return": __version__}
+    sock.close()
+
+
+def test_commandline(monkeypatch, config_file):
+    server = Mock()
+    server.is_alive.return_value = False
+    Server = Mock(return_value=server)
+    import spalloc_server.async_server
+    monkeypatch.setattr(spalloc_server.async_server, "AsyncioServer", Server)
+
+    main([config_file, "--asyncio"])
+
+    Server.assert_called_once_with(config_filename=config_file,
+                                   cold_start=False,
+                                   trace_filename=None)
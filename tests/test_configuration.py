@@ -2,6 +2,7 @@ import pytest
 
 import tempfile
 import os
+import pickle
 
 from spalloc_server.configuration import \
     Configuration, Machine, board_locations_from_spinner
@@ -59,6 +60,8 @@ def test_sensible_defaults():
     assert c.ip == ""
     assert c.timeout_check_interval == 5.0
     assert c.max_retired_jobs == 1200
+    assert c.max_client_output_buffer == 8 * 1024 * 1024
+    assert c.max_command_length == 1024 * 1024
 
 
 def test_machine_type():
@@ -76,6 +79,12 @@ def test_no_collisions():
     assert c.machines == machines
 
 
+def test_max_bmp_workers():
+    assert Configuration(max_bmp_workers=1).max_bmp_workers == 1
+    with pytest.raises(ValueError):
+        Configuration(max_bmp_workers=0)
+
+
 def test_name_collision():
     with pytest.raises(ValueError):
         machines = [test_machine("a"), test_machine("b"), test_machine("a")]
@@ -185,6 +194,23 @@ def test_board_locations_no_duplicates(working_args):
         Machine(**working_args)
 
 
+def test_boards_by_location(working_args):
+    # The reverse lookup should be built on construction (and survive copying
+    # and pickling)
+    m = Machine(**working_args)
+    expected = {cfb: xyz
+                for xyz, cfb in working_args["board_locations"].items()}
+    assert m.boards_by_location == expected
+    assert m._replace(name="m2").boards_by_location == expected
+    assert pickle.loads(pickle.dumps(m)).boards_by_location == expected
+
+    # Moving a board should be reflected in copies
+    working_args["board_locations"][(0, 0, 0)] = (10, 0, 99)
+    m2 = m._replace(board_locations=working_args["board_locations"])
+    assert m2.boards_by_location[(10, 0, 99)] == (0, 0, 0)
+    assert (0, 0, 0) not in m2.boards_by_location
+
+
 def test_board_locations_defined(working_args):
     # If any live board locations are not given, we should fail. We reomve a
     # dead board whose location is otherwise not set
@@ -207,6 +233,19 @@ def test_spinnaker_ips_defined(working_args):
         Machine(**working_args)
 
 
+@pytest.mark.parametrize("packer", ["pack_tree", "max_rects"])
+def test_packer(working_args, packer):
+    assert Machine(**working_args).packer == "pack_tree"
+    working_args["packer"] = packer
+    assert Machine(**working_args).packer == packer
+
+
+def test_bad_packer(working_args):
+    working_args["packer"] = "magic"
+    with pytest.raises(ValueError):
+        Machine(**working_args)
+
+
 def test_infer_width_and_height(working_args):
     del working_args["width"]
     del working_args["height"]
@@ -238,6 +277,11 @@ def test_single_board():
     assert m.board_locations == {(0, 0, 0): (0, 0, 0)}
     assert m.bmp_ips == {(0, 0): "bmp"}
     assert m.spinnaker_ips == {(0, 0, 0): "spinn"}
+    assert m.packer == "pack_tree"
+
+    m = Machine.single_board("m", set(["default"]), "bmp", "spinn",
+                             packer="max_rects")
+    assert m.packer == "max_rects"
 
 
 def test_single_board_no_ip():
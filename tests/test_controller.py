@@ -1,6 +1,6 @@
 import pytest
 
-from mock import Mock
+from mock import Mock, MagicMock, call
 
 import threading
 
@@ -16,11 +16,15 @@ from rig.links import Links
 
 import pickle
 
-from six import iteritems
+from six import iteritems, itervalues
 
+import spalloc_server.controller
+from spalloc_server import async_bmp_controller
+from spalloc_server.async_bmp_controller import AsyncBMPController
 from spalloc_server.coordinates import board_down_link
 from spalloc_server.configuration import Machine
 from spalloc_server.controller import Controller, JobState
+from spalloc_server.max_rects import MaxRectsPacker
 
 from common import simple_machine
 
@@ -327,6 +331,14 @@ def test_controller_set_machines(conn, MockABC):
             (m1.width * m1.height) +
             (m0.width * m0.height))
 
+    # Changing the packing algorithm should also result in a re-spin
+    m1 = m1._replace(packer="max_rects")
+    machines["m1"] = m1
+    conn.machines = machines
+    m1_alloc_after_packer = conn._job_queue._machines["m1"].allocator
+    assert m1_alloc_after_packer is not m1_alloc_after
+    assert isinstance(m1_alloc_after_packer.pack_tree, MaxRectsPacker)
+
 
 def test_set_machines_sequencing(conn):
     """Correct sequencing must be observed between old machines being spun down
@@ -436,7 +448,7 @@ def test_destroy_timed_out_jobs(conn, m):
 
     # Make sure jobs can timeout
     time.sleep(0.15)
-    conn.destroy_timed_out_jobs()
+    assert conn.destroy_timed_out_jobs() == [job_id]
     assert conn.get_job_state(job_id).state == JobState.destroyed
     assert conn.get_job_state(job_id).reason == "Job timed out."
 
@@ -448,9 +460,59 @@ def test_destroy_timed_out_jobs(conn, m):
     assert conn.get_job_state(job_id_forever).state == JobState.ready
 
 
+def test_on_jobs_timed_out(conn, m):
+    # Timed out jobs should be reported before they are destroyed (and so
+    # before their boards are powered down)
+    states = []
+    on_jobs_timed_out = Mock(side_effect=lambda job_ids: states.extend(
+        conn.get_job_state(job_id).state for job_id in job_ids))
+    conn.on_jobs_timed_out = on_jobs_timed_out
+    assert conn.on_jobs_timed_out is on_jobs_timed_out
+
+    job_id0 = conn.create_job(owner="me", keepalive=0.1)
+    job_id1 = conn.create_job(owner="me", keepalive=0.1)
+    conn.destroy_timed_out_jobs()
+    assert not on_jobs_timed_out.called
+
+    time.sleep(0.15)
+    assert conn.destroy_timed_out_jobs() == [job_id0, job_id1]
+    assert on_jobs_timed_out.mock_calls == [call([job_id0, job_id1])]
+    assert JobState.destroyed not in states
+    assert conn.get_job_state(job_id0).state == JobState.destroyed
+
+
+def test_next_timeout(conn, m):
+    assert conn.next_timeout is None
+
+    # Jobs without a keepalive never time out
+    conn.create_job(owner="me", keepalive=None)
+    assert conn.next_timeout is None
+
+    job_id0 = conn.create_job(owner="me", keepalive=0.1)
+    job_id1 = conn.create_job(owner="me", keepalive=10.0)
+    assert conn.next_timeout == conn._jobs[job_id0].keepalive_until
+
+    # Keeping a job alive should be accounted for once the old timeout is
+    # reached
+    time.sleep(0.06)
+    conn.job_keepalive(job_id0)
+    time.sleep(0.06)
+    assert conn.next_timeout < time.time()
+    assert conn.destroy_timed_out_jobs() == []
+    assert conn.next_timeout == conn._jobs[job_id0].keepalive_until
+
+    # Destroyed jobs should be skipped
+    conn.destroy_job(job_id0)
+    time.sleep(0.11)
+    assert conn.destroy_timed_out_jobs() == []
+    assert conn.next_timeout == conn._jobs[job_id1].keepalive_until
+
+
 def test_get_job_state(conn, m):
     job_id1 = conn.create_job(owner="me", keepalive=123.0)
-    conn._jobs[job_id1].start_time = 1234.5
+    with conn:
+        conn._jobs[job_id1].start_time = 1234.5
+        conn._mark_jobs_changed([job_id1])
 
     # Allow Mock BMP time to respond
     time.sleep(0.05)
@@ -510,6 +572,30 @@ def test_get_job_machine_info(conn, m):
     assert conn.get_job_machine_info(1234) == (None, None, None, None, None)
 
 
+def test_get_job_changes(conn, m):
+    job_id0 = conn.create_job(1, 1, owner="me", keepalive=123.0)
+    job_id1 = conn.create_job(1, 1, owner="me", keepalive=123.0)
+    time.sleep(0.05)
+    conn.destroy_job(job_id0, "Done.")
+    time.sleep(0.05)
+
+    # Should not count as a query of the job
+    conn._jobs[job_id1].keepalive_until = 1234.5
+
+    assert conn.get_job_changes([job_id0, job_id1, 1234]) == [
+        (job_id0, JobState.destroyed, None, "Done.", None, None),
+        (job_id1, JobState.ready, True, None, m,
+         set([(0, 1, 0), (0, 1, 1), (0, 1, 2)])),
+        (1234, JobState.unknown, None, None, None, None),
+    ]
+    assert conn._jobs[job_id1].keepalive_until == 1234.5
+
+    # Queued jobs have no machine
+    job_id2 = conn.create_job(1, 2, owner="me")
+    assert conn.get_job_changes([job_id2]) == [
+        (job_id2, JobState.queued, None, None, None, None)]
+
+
 @pytest.mark.timeout(1.0)
 @pytest.mark.parametrize("args,width,height",
                          [([], 8, 8),         # Single board
@@ -588,6 +674,149 @@ def test_power_off_job_boards(conn, m):
     conn.power_off_job_boards(job_id_pending)
 
 
+def test_bmp_engine(conn):
+    # All BMP controllers should share an engine whose number of workers is
+    # limited, however many BMPs there are
+    conn.max_bmp_workers = 2
+    conn.machines = {"m": simple_machine("m", 3, 3)}
+    controllers = list(itervalues(conn._bmp_controllers["m"]))
+    assert len(controllers) == 9
+    assert all(c.engine is conn._bmp_engine for c in controllers)
+    assert conn._bmp_engine.num_workers == 2
+
+    # Keep every BMP busy: no more than two should be communicated with at
+    # once
+    engine = conn._bmp_engine
+    event = threading.Event()
+    running = []
+    steps = []
+
+    class BusyBMP(object):
+        def _step(self):
+            running.append(self)
+            steps.append(len(running))
+            event.wait()
+            running.remove(self)
+
+    for _ in controllers:
+        engine.schedule(BusyBMP())
+    time.sleep(0.05)
+    assert len(engine._workers) == 2
+    assert steps == [1, 2]
+
+    event.set()
+    time.sleep(0.05)
+    assert len(steps) == 9
+    assert max(steps) == 2
+    assert len(engine._workers) <= 2
+
+    # Changing the limit applies to the engine
+    conn.max_bmp_workers = 3
+    assert engine.num_workers == 3
+
+    # The engine always needs a worker
+    with pytest.raises(ValueError):
+        conn.max_bmp_workers = 0
+    assert conn.max_bmp_workers == 3
+    assert engine.num_workers == 3
+
+
+@pytest.mark.timeout(2.0)
+def test_reconfigure_with_one_bmp_worker(monkeypatch):
+    # When a machine is re-created, the new BMP controllers wait for the old
+    # ones to power down the machine's boards. This must not deadlock even
+    # when the only BMP worker is needed to carry out those power-offs.
+    monkeypatch.setattr(async_bmp_controller, "POST_POWER_ON_DELAY", 0.0)
+    monkeypatch.setattr(async_bmp_controller, "BMPController",
+                        lambda hostname: MagicMock())
+    monkeypatch.setattr(spalloc_server.controller, "AsyncBMPController",
+                        AsyncBMPController)
+
+    conn = Controller(max_bmp_workers=1)
+    try:
+        conn.machines = {"m": simple_machine("m", 1, 2)}
+        job_id = conn.create_job(owner="me")
+        while conn.get_job_state(job_id).state != JobState.ready:
+            time.sleep(0.01)
+        old = conn._bmp_controllers["m"][(0, 0)]
+
+        # Changing the BMP IPs re-creates the machine, destroying the job and
+        # powering off its boards
+        conn.machines = {"m": simple_machine("m", 1, 2, ip_prefix="new-")}
+        assert conn._bmp_controllers["m"][(0, 0)] is not old
+        old.join()
+        old._bc.set_power.assert_called_with(
+            state=False, board=set([0]), post_power_on_delay=0.0)
+
+        # The new machine's BMP controllers may then be used
+        job_id = conn.create_job(owner="me")
+        while conn.get_job_state(job_id).state != JobState.ready:
+            time.sleep(0.01)
+        assert len(conn._bmp_engine._workers) == 1
+    finally:
+        conn.stop()
+        conn.join()
+
+
+def test_redundant_power_commands_skipped(conn, m):
+    job_id = conn.create_job(owner="me")
+    time.sleep(0.05)
+
+    controller = conn._bmp_controllers[m][(0, 0)]
+    conn.power_off_job_boards(job_id)
+    time.sleep(0.05)
+    assert conn.get_job_state(job_id).state is JobState.ready
+
+    controller.set_power_calls = []
+    controller.set_link_enable_calls = []
+
+    # Powering off boards which are already off should not require any BMP
+    # commands
+    conn.power_off_job_boards(job_id)
+    assert conn.get_job_state(job_id).state is JobState.ready
+    assert controller.set_power_calls == []
+
+    # Boards being powered on should always be reset and their links set up
+    # again
+    conn.power_on_job_boards(job_id)
+    assert conn.get_job_state(job_id).state is JobState.power
+    assert [s for b, s, f in controller.set_power_calls] == [True]
+    assert len(controller.set_link_enable_calls) == 6
+    time.sleep(0.05)
+    assert conn.get_job_state(job_id).state is JobState.ready
+
+    # ...every time they are powered on (since their links are reset)
+    controller.set_power_calls = []
+    controller.set_link_enable_calls = []
+    conn.power_on_job_boards(job_id)
+    assert [s for b, s, f in controller.set_power_calls] == [True]
+    assert len(controller.set_link_enable_calls) == 6
+    time.sleep(0.05)
+    assert conn.get_job_state(job_id).state is JobState.ready
+
+    # Destroying a job whose boards are off should not power them off again
+    conn.power_off_job_boards(job_id)
+    controller.set_power_calls = []
+    conn.destroy_job(job_id)
+    assert controller.set_power_calls == []
+
+
+def test_failed_power_commands_not_skipped(conn, m):
+    job_id = conn.create_job(owner="me")
+    time.sleep(0.05)
+
+    # If powering off fails, the board's state is unknown and so it must be
+    # powered off again when the job is destroyed (as a result of the
+    # failure).
+    controller = conn._bmp_controllers[m][(0, 0)]
+    controller.success = False
+    controller.set_power_calls = []
+    conn.power_off_job_boards(job_id)
+    time.sleep(0.05)
+    assert conn.get_job_state(job_id).state is JobState.destroyed
+    assert [s for b, s, f in controller.set_power_calls] == [False, False]
+
+
 def test_destroy_job(conn, m):
     controller0 = conn._bmp_controllers[m][(0, 0)]
     controller1 = conn._bmp_controllers[m][(0, 1)]
@@ -663,6 +892,10 @@ def test_list_jobs(conn, m):
     assert jobs[0].kwargs == {}
     assert jobs[1].kwargs == {"require_torus": True}
 
+    # Modifying the listed jobs must not modify the controller's records
+    jobs[1].kwargs["require_torus"] = False
+    assert conn.list_jobs()[1].kwargs == {"require_torus": True}
+
     assert jobs[0].allocated_machine_name == m
     assert jobs[1].allocated_machine_name is None
 
@@ -906,6 +1139,91 @@ class TestWhereIs(object):
         assert loc["chip"] == chip_xy
 
 
+class TestWhereIsMany(object):
+
+    COLUMNS = ("logical", "physical", "chip", "board_chip", "job_id",
+               "job_chip")
+
+    def check(self, conn, locations, **kwargs):
+        """Check where_is_many gives the same answers as where_is for each
+        location listed.
+        """
+        names = sorted(locations[0])
+        many_kwargs = kwargs.copy()
+        for name in names:
+            many_kwargs[name] = [location[name] for location in locations]
+        result = conn.where_is_many(**many_kwargs)
+
+        found = 0
+        for i, location in enumerate(locations):
+            location.update(kwargs)
+            expected = conn.where_is(**location)
+            if expected is None:
+                assert all(result[column][i] is None
+                           for column in self.COLUMNS)
+            else:
+                found += 1
+                assert result["machine"] == expected["machine"]
+                assert {column: result[column][i]
+                        for column in self.COLUMNS} == {
+                    column: expected[column] for column in self.COLUMNS}
+        return found
+
+    def test_bad_arguments(self, conn, big_m):
+        with pytest.raises(TypeError):
+            conn.where_is_many()
+        with pytest.raises(TypeError):
+            conn.where_is_many(machine=big_m, x=[0], y=[0])  # z missing
+        with pytest.raises(ValueError):
+            conn.where_is_many(machine=big_m, chip_x=[0, 1], chip_y=[0])
+
+    def test_unknown_machine_or_job(self, conn, big_m):
+        assert conn.where_is_many(machine="bad", chip_x=[0],
+                                  chip_y=[0]) is None
+        assert conn.where_is_many(machine="bad", cabinet=[0], frame=[0],
+                                  board=[0]) is None
+        assert conn.where_is_many(job_id=123, chip_x=[0], chip_y=[0]) is None
+
+    def test_empty(self, conn, big_m):
+        assert conn.where_is_many(machine=big_m, chip_x=[], chip_y=[]) == {
+            "machine": big_m, "logical": [], "physical": [], "chip": [],
+            "board_chip": [], "job_id": [], "job_chip": []}
+
+    def test_chips(self, conn, big_m_with_hole):
+        conn.create_job(2, 1, owner="me")
+        conn.create_job(owner="me")
+        # Includes chips which wrap around and the dead board
+        assert self.check(conn, [{"chip_x": x, "chip_y": y}
+                                 for x in range(-12, 60, 3)
+                                 for y in range(-12, 36, 5)],
+                          machine=big_m_with_hole) > 0
+
+    def test_logical(self, conn, big_m_with_hole):
+        conn.create_job(2, 1, owner="me")
+        assert self.check(conn, [{"x": x, "y": y, "z": z}
+                                 for x in range(5)
+                                 for y in range(3)
+                                 for z in range(3)],
+                          machine=big_m_with_hole) > 0
+
+    def test_physical(self, conn, big_m_with_hole):
+        conn.create_job(2, 1, owner="me")
+        assert self.check(conn, [{"cabinet": c, "frame": f, "board": b}
+                                 for c in range(0, 40, 10)
+                                 for f in range(0, 30, 10)
+                                 for b in range(0, 30, 10)],
+                          machine=big_m_with_hole) > 0
+
+    @pytest.mark.parametrize("job_id", [1, 2])
+    def test_job_chips(self, conn, big_m_with_hole, job_id):
+        assert conn.create_job(2, 2, owner="me") == 1
+        assert conn.create_job(2, 1, owner="me") == 2
+        assert self.check(conn, [{"chip_x": x, "chip_y": y}
+                                 for x in range(-4, 40, 3)
+                                 for y in range(-4, 40, 3)],
+                          job_id=job_id) > 0
+
+
 @pytest.mark.parametrize("success,mid_state,end_state",
                          [(True, JobState.unknown, JobState.ready),
                           (False, JobState.destroyed, JobState.destroyed)])
@@ -921,6 +1239,7 @@ def test_bmp_on_request_complete(MockABC, conn, m,
     # interacting with the job
     with conn._lock:
         job.state = JobState.unknown
+        conn._mark_jobs_changed([job_id])
 
         # The function should simply decrement the counter until it reaches
         # zero at which point it should flag the object as "Ready" unless
@@ -934,11 +1253,58 @@ def test_bmp_on_request_complete(MockABC, conn, m,
                 assert conn.get_job_state(job_id).state == JobState.unknown
             else:
                 assert conn.get_job_state(job_id).state == mid_state
-            conn._bmp_on_request_complete(job, success)
+            conn._bmp_on_request_complete(job, request_num, success)
 
         assert conn.get_job_state(job_id).state == end_state
 
 
+def test_on_bmp_request_complete(MockABC, conn, m):
+    on_bmp_request_complete = Mock()
+    conn.on_bmp_request_complete = on_bmp_request_complete
+    assert conn.on_bmp_request_complete is on_bmp_request_complete
+
+    # Every BMP request made for the job should be reported (one power
+    # command and six link commands) along with the sequence number of each
+    # request
+    job_id = conn.create_job(owner="me")
+    time.sleep(0.05)
+    assert conn.get_job_state(job_id).state == JobState.ready
+    assert on_bmp_request_complete.mock_calls == [
+        call(job_id, seq, True) for seq in range(7)]
+
+    # Sequence numbers continue with later requests
+    on_bmp_request_complete.reset_mock()
+    conn.power_off_job_boards(job_id)
+    time.sleep(0.05)
+    assert on_bmp_request_complete.mock_calls == [call(job_id, 7, True)]
+
+
+def test_bmp_controller_factory(MockABC):
+    # BMP requests should go to the controllers produced by the factory
+    # and not to the AsyncBMPController
+    bmp_controllers = []
+
+    def factory(hostname, on_thread_start=None):
+        bmp_controller = Mock()
+        bmp_controller.__enter__ = Mock()
+        bmp_controller.__exit__ = Mock()
+        bmp_controllers.append(bmp_controller)
+        return bmp_controller
+
+    conn = Controller(bmp_controller_factory=factory)
+    try:
+        conn.machines = {"m": simple_machine("m", 1, 2)}
+        assert MockABC.num_created == 0
+        assert len(bmp_controllers) == 2
+
+        job_id = conn.create_job(owner="me")
+        assert conn.get_job_state(job_id).state == JobState.power
+        assert sum(len(c.set_power.mock_calls) for c in bmp_controllers) == 1
+    finally:
+        conn.stop()
+        conn.join()
+
+
 @pytest.mark.parametrize("power", [True, False])
 @pytest.mark.parametrize("link_enable", [True, False, None])
 def test_set_job_power_and_links(MockABC, conn, m, power, link_enable):
@@ -1019,6 +1385,49 @@ def test_pickle(MockABC):
         conn2.join()
 
 
+def test_unpickle_missing_unpickled_attributes(MockABC):
+    # State saved before these attributes were added should still be
+    # restored
+    conn = Controller()
+    conn.stop()
+    conn.join()
+    state = conn.__getstate__()
+    for name in ("_on_bmp_request_complete", "_on_jobs_timed_out",
+                 "_bmp_controller_factory", "_bmp_engine", "_max_bmp_workers"):
+        del state[name]
+
+    conn2 = Controller.__new__(Controller)
+    conn2.__setstate__(state)
+    try:
+        assert conn2.on_jobs_timed_out is None
+        assert conn2._bmp_controller_factory is None
+        assert conn2._bmp_engine is not None
+        assert conn2.max_bmp_workers == 8
+    finally:
+        conn2.stop()
+        conn2.join()
+
+
+@pytest.mark.timeout(1.0)
+def test_context_manager(conn, m):
+    # While the controller is held by one thread, other threads should be
+    # blocked
+    done = threading.Event()
+
+    def create_job():
+        conn.create_job(owner="me")
+        done.set()
+
+    with conn:
+        t = threading.Thread(target=create_job)
+        t.start()
+        assert not done.wait(0.05)
+        assert conn.list_jobs() == []
+    t.join()
+    assert done.is_set()
+    assert len(conn.list_jobs()) == 1
+
+
 def test_max_retired_jobs(conn):
     # Should be able to access the number of retired jobs
     assert conn.max_retired_jobs == 2
@@ -1152,6 +1561,165 @@ def test_changed_machines(conn):
     assert conn.changed_machines == set()
 
 
+def test_versions(conn):
+    # The version counters should change whenever jobs or machines change
+    jobs_version = conn.jobs_version
+    machines_version = conn.machines_version
+
+    conn.machines = {"m0": simple_machine("m0", 1, 2)}
+    assert conn.jobs_version == jobs_version
+    assert conn.machines_version > machines_version
+    machines_version = conn.machines_version
+
+    # Unchanged configurations should not count as a change
+    conn.machines = {"m0": simple_machine("m0", 1, 2)}
+    assert conn.machines_version == machines_version
+
+    job_id = conn.create_job(owner="me")
+    assert conn.jobs_version > jobs_version
+    assert conn.machines_version > machines_version
+    jobs_version = conn.jobs_version
+    machines_version = conn.machines_version
+
+    # Reading the versions should not affect the change sets (and vice versa)
+    assert conn.changed_jobs == set([job_id])
+    assert conn.changed_machines == set(["m0"])
+    assert conn.jobs_version == jobs_version
+    assert conn.machines_version == machines_version
+
+    # Queries are not changes
+    conn.get_job_state(job_id)
+    conn.list_jobs()
+    assert conn.jobs_version == jobs_version
+
+    conn.destroy_job(job_id)
+    assert conn.jobs_version > jobs_version
+    assert conn.machines_version > machines_version
+
+
+def test_machine_list_version(conn):
+    # The version should change whenever the list of machines changes but not
+    # when jobs are allocated on them
+    version = conn.machine_list_version
+    m0 = simple_machine("m0", 1, 2)
+    m1 = simple_machine("m1", 1, 2, ip_prefix="1")
+    conn.machines = OrderedDict([("m0", m0), ("m1", m1)])
+    assert conn.machine_list_version > version
+    version = conn.machine_list_version
+
+    # Unchanged configurations should not count as a change
+    conn.machines = OrderedDict([("m0", m0), ("m1", m1)])
+    assert conn.machine_list_version == version
+
+    # Allocating and freeing jobs does not change the list
+    job_id = conn.create_job(owner="me")
+    conn.destroy_job(job_id)
+    assert conn.machine_list_version == version
+
+    # Re-ordering the machines does
+    conn.machines = OrderedDict([("m1", m1), ("m0", m0)])
+    assert conn.machine_list_version > version
+    assert [m.name for m in conn.list_machines()] == ["m1", "m0"]
+    version = conn.machine_list_version
+
+    # As does changing a machine
+    m1 = simple_machine("m1", 1, 2, tags=set(["foo"]), ip_prefix="1")
+    conn.machines = OrderedDict([("m1", m1), ("m0", m0)])
+    assert conn.machine_list_version > version
+
+
+def test_queries_do_not_take_lock(conn, m):
+    job_id = conn.create_job(owner="me", keepalive=None)
+    time.sleep(0.05)
+
+    # Read-only queries should be answered while another thread (e.g. one
+    # allocating a job) holds the controller's lock.
+    results = {}
+
+    def query():
+        results["state"] = conn.get_job_state(job_id).state
+        results["info"] = conn.get_job_machine_info(job_id).machine_name
+        results["changes"] = conn.get_job_changes([job_id])[0].state
+        results["jobs"] = [job.job_id for job in conn.list_jobs()]
+        results["machines"] = [machine.name for machine in
+                               conn.list_machines()]
+        results["position"] = conn.get_board_position(m, 0, 0, 0)
+        results["xyz"] = conn.get_board_at_position(m, 0, 0, 0)
+        results["where_is"] = conn.where_is(machine=m, x=0, y=1, z=0)
+        results["machines_dict"] = list(conn.machines)
+
+    with conn:
+        thread = threading.Thread(target=query)
+        thread.start()
+        thread.join(1.0)
+        assert not thread.is_alive()
+
+    assert results == {
+        "state": JobState.ready,
+        "info": m,
+        "changes": JobState.ready,
+        "jobs": [job_id],
+        "machines": [m],
+        "position": (0, 0, 0),
+        "xyz": (0, 0, 0),
+        "where_is": {"machine": m, "logical": (0, 1, 0),
+                     "physical": (0, 1, 0), "chip": (0, 12),
+                     "board_chip": (0, 0), "job_id": None,
+                     "job_chip": None},
+        "machines_dict": [m],
+    }
+
+
+def test_snapshots_follow_changes(conn, m):
+    job_id = conn.create_job(owner="me", keepalive=None)
+    time.sleep(0.05)
+
+    # Snapshots already returned are never modified by later changes
+    snapshot = conn._job_snapshots[job_id]
+    jobs = conn.list_jobs()
+    conn.power_off_job_boards(job_id)
+    assert snapshot.power is True
+    assert jobs[0].power is True
+
+    # ...but queries reflect the change
+    time.sleep(0.05)
+    assert conn.get_job_state(job_id).power is False
+    assert conn.list_jobs()[0].power is False
+
+    # Destroyed jobs are removed from the snapshots and reported as destroyed
+    conn.destroy_job(job_id, "Gone")
+    assert job_id not in conn._job_snapshots
+    assert conn.list_jobs() == []
+    assert conn.get_job_state(job_id).state == JobState.destroyed
+
+    # Machine changes are published too
+    conn.machines = {}
+    assert conn.list_machines() == []
+    assert conn.get_board_position(m, 0, 0, 0) is None
+
+
+def test_board_jobs_index(conn, m):
+    # Boards should be indexed as soon as they are allocated
+    job_id0 = conn.create_job(owner="me", keepalive=None)
+    job_id1 = conn.create_job(1, 1, owner="me", keepalive=None)
+    boards0 = conn._jobs[job_id0].boards
+    boards1 = conn._jobs[job_id1].boards
+    assert conn._board_jobs == {m: dict(
+        [(xyz, job_id0) for xyz in boards0] +
+        [(xyz, job_id1) for xyz in boards1])}
+    for x, y, z in boards1:
+        assert conn.where_is(machine=m, x=x, y=y, z=z)["job_id"] == job_id1
+
+    # ...and removed once freed
+    conn.destroy_job(job_id1)
+    assert conn._board_jobs == {m: {xyz: job_id0 for xyz in boards0}}
+    for x, y, z in boards1:
+        assert conn.where_is(machine=m, x=x, y=y, z=z)["job_id"] is None
+
+    conn.destroy_job(job_id0)
+    assert conn._board_jobs == {m: {}}
+
+
 def test_on_background_state_change(conn, m, on_background_state_change):
     controller0 = conn._bmp_controllers[m][(0, 0)]
     controller1 = conn._bmp_controllers[m][(0, 1)]
@@ -1,10 +1,11 @@
 import pytest
 
 from rig.links import Links
+from rig.geometry import spinn5_chip_coord
 
 from spalloc_server.coordinates import \
     link_to_vector, board_down_link, board_to_chip, chip_to_board, \
-    triad_dimensions_to_chips, WrapAround
+    boards_to_chips, chips_to_boards, triad_dimensions_to_chips, WrapAround
 
 
 def test_link_to_vector():
@@ -76,6 +77,26 @@ def test_chip_to_board(bxyz, cxywh):
     assert chip_to_board(*cxywh) == bxyz
 
 
+def test_boards_to_chips():
+    # Should match board_to_chip
+    boards = [(x, y, z) for x in range(3) for y in range(4) for z in range(3)]
+    chip_x, chip_y = boards_to_chips(*zip(*boards))
+    assert list(zip(chip_x.tolist(), chip_y.tolist())) == \
+        [board_to_chip(*xyz) for xyz in boards]
+
+
+@pytest.mark.parametrize("w,h", [(12, 12), (24, 36), (48, 24)])
+def test_chips_to_boards(w, h):
+    # Should match chip_to_board and spinn5_chip_coord
+    chips = [(x, y) for x in range(w) for y in range(h)]
+    chip_x, chip_y = zip(*chips)
+    x, y, z, board_chip_x, board_chip_y = chips_to_boards(chip_x, chip_y, w, h)
+    assert list(zip(x.tolist(), y.tolist(), z.tolist())) == \
+        [chip_to_board(cx, cy, w, h) for cx, cy in chips]
+    assert list(zip(board_chip_x.tolist(), board_chip_y.tolist())) == \
+        [spinn5_chip_coord(cx, cy) for cx, cy in chips]
+
+
 @pytest.mark.parametrize("wht,wh",
                          [((1, 1, WrapAround.none), (16, 16)),
                           ((1, 1, WrapAround.x), (12, 16)),
@@ -6,6 +6,8 @@ from rig.links import Links
 
 from spalloc_server.coordinates import board_down_link
 from spalloc_server.job_queue import JobQueue
+from spalloc_server.pack_tree import PackTree
+from spalloc_server.max_rects import MaxRectsPacker
 
 
 @pytest.fixture
@@ -58,6 +60,9 @@ def test_add_machine(q, monkeypatch):
     assert q._machines["foo"].allocator.dead_boards is dead_boards
     assert q._machines["foo"].allocator.dead_links is dead_links
 
+    # Should use a PackTree by default
+    assert isinstance(q._machines["foo"].allocator.pack_tree, PackTree)
+
     # Should be able to specify custom tags
     q.add_machine("bar", 1, 2, tags=set(["pie", "chips"]))
     assert q._machines["bar"].tags == set(["pie", "chips"])
@@ -65,12 +70,17 @@ def test_add_machine(q, monkeypatch):
     # Should have re-queued everything again
     assert len(_regenerate_queues.mock_calls) == 2
 
+    # Should be able to choose the packer
+    q.add_machine("baz", 1, 2, packer="max_rects")
+    assert isinstance(q._machines["baz"].allocator.pack_tree, MaxRectsPacker)
+    assert len(_regenerate_queues.mock_calls) == 3
+
     # Should fail to create machine with same name
     with pytest.raises(ValueError):
         q.add_machine("foo", 1, 2)
 
     # Should have done nothing
-    assert len(_regenerate_queues.mock_calls) == 2
+    assert len(_regenerate_queues.mock_calls) == 3
 
 
 def test_move_machine_to_end(q, on_allocate):
@@ -0,0 +1,139 @@
+import pytest
+
+import random
+
+from collections import deque
+
+from rig.links import Links
+
+from spalloc_server.coordinates import board_down_link
+from spalloc_server.machine_index import ConnectivityIndex, FaultIndex
+
+
+def bfs_boards(w, h, dead_boards, dead_links, x, y, width, height):
+    """A simple reference implementation of ConnectivityIndex.reachable."""
+    boards = set()
+    to_visit = deque([(x, y, 0)])
+    while to_visit:
+        x1, y1, z1 = to_visit.popleft()
+        if (x1, y1, z1) in dead_boards or (x1, y1, z1) in boards:
+            continue
+        boards.add((x1, y1, z1))
+        for link in Links:
+            if (x1, y1, z1, link) in dead_links:
+                continue
+            x2, y2, z2, _ = board_down_link(x1, y1, z1, link, w, h)
+            if x <= x2 < x + width and y <= y2 < y + height:
+                to_visit.append((x2, y2, z2))
+    return boards
+
+
+def test_bit():
+    ci = ConnectivityIndex(4, 3, set(), set())
+    bits = set(ci.bit(x, y, z)
+               for x in range(4) for y in range(3) for z in range(3))
+    assert bits == set(range(4 * 3 * 3))
+
+
+def test_live():
+    ci = ConnectivityIndex(2, 2, set([(0, 0, 1), (1, 1, 2)]), set())
+    assert ci.count(ci.live) == 10
+    assert ci.boards(ci.live) == set(
+        (x, y, z) for x in range(2) for y in range(2) for z in range(3)
+        if (x, y, z) not in ((0, 0, 1), (1, 1, 2)))
+
+
+@pytest.mark.parametrize("x,y,width,height", [(0, 0, 1, 1),
+                                              (1, 2, 3, 1),
+                                              (3, 0, 2, 4),
+                                              (0, 0, 5, 4)])
+def test_region(x, y, width, height):
+    ci = ConnectivityIndex(5, 4, set(), set())
+    assert ci.boards(ci.region(x, y, width, height)) == set(
+        (x_, y_, z)
+        for x_ in range(x, x + width)
+        for y_ in range(y, y + height)
+        for z in range(3))
+
+
+def test_count_and_boards():
+    ci = ConnectivityIndex(3, 3, set(), set())
+    assert ci.count(0) == 0
+    assert ci.boards(0) == set()
+
+    boards = (1 << ci.bit(0, 0, 0)) | (1 << ci.bit(2, 1, 2))
+    assert ci.count(boards) == 2
+    assert ci.boards(boards) == set([(0, 0, 0), (2, 1, 2)])
+
+
+def test_reachable_dead_start():
+    ci = ConnectivityIndex(3, 3, set([(1, 1, 0)]), set())
+    assert ci.reachable(1, 1, 1, 1) == 0
+    assert ci.reachable(1, 1, 2, 2) == 0
+
+
+def test_reachable_dead_links():
+    # Isolate board (0, 0, 0) from all its neighbours
+    w, h = 4, 4
+    dead_links = set((0, 0, 0, link) for link in Links)
+    ci = ConnectivityIndex(w, h, set(), dead_links)
+    assert ci.boards(ci.reachable(0, 0, w, h)) == set([(0, 0, 0)])
+
+    # Other boards can still reach it, however (links are not assumed to be
+    # bidirectionally dead).
+    assert len(ci.boards(ci.reachable(1, 0, w - 1, h))) == (w - 1) * h * 3
+
+
+@pytest.mark.parametrize("w,h", [(1, 1), (1, 3), (2, 2), (5, 4)])
+def test_reachable_matches_bfs(w, h):
+    rng = random.Random(w * 100 + h)
+    all_boards = [(x, y, z) for x in range(w) for y in range(h)
+                  for z in range(3)]
+    for _ in range(10):
+        dead_boards = set(b for b in all_boards if rng.random() < 0.15)
+        dead_links = set((x, y, z, link) for x, y, z in all_boards
+                         for link in Links if rng.random() < 0.1)
+        ci = ConnectivityIndex(w, h, dead_boards, dead_links)
+
+        for x in range(w):
+            for y in range(h):
+                for width in range(1, w - x + 1):
+                    for height in range(1, h - y + 1):
+                        assert ci.boards(ci.reachable(x, y, width, height)) \
+                            == bfs_boards(w, h, dead_boards, dead_links,
+                                          x, y, width, height)
+
+
+@pytest.mark.parametrize("w,h", [(1, 1), (1, 3), (2, 2), (5, 4)])
+def test_fault_index(w, h):
+    rng = random.Random(w * 100 + h)
+    all_boards = [(x, y, z) for x in range(w) for y in range(h)
+                  for z in range(3)]
+    for _ in range(10):
+        dead_boards = set(b for b in all_boards if rng.random() < 0.15)
+        dead_links = set((x, y, z, link) for x, y, z in all_boards
+                         for link in Links if rng.random() < 0.1)
+        fi = FaultIndex(w, h, dead_boards, dead_links)
+
+        for x in range(w):
+            for y in range(h):
+                for width in range(1, w - x + 1):
+                    for height in range(1, h - y + 1):
+                        region = set((x_, y_, z)
+                                     for x_ in range(x, x + width)
+                                     for y_ in range(y, y + height)
+                                     for z in range(3))
+
+                        assert fi.dead_boards(x, y, width, height) == \
+                            len(region & dead_boards)
+
+                        num_dead_links = 0
+                        for x1, y1, z1, link in dead_links:
+                            x2, y2, z2, wrapped = board_down_link(
+                                x1, y1, z1, link, w, h)
+                            if (not wrapped and
+                                    (x1, y1, z1) in region - dead_boards and
+                                    (x2, y2, z2) in region - dead_boards):
+                                num_dead_links += 1
+                        assert fi.dead_links(x, y, width, height) == \
+                            num_dead_links
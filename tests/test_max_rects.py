@@ -0,0 +1,181 @@
+import pytest
+
+from mock import Mock
+
+import random
+
+from spalloc_server.max_rects import MaxRectsPacker
+from spalloc_server.pack_tree import FreeError
+
+
+def check_free_rects(p):
+    """Check the free rectangles of a packer are exactly the maximal free
+    rectangles given the current allocations.
+    """
+    used = set()
+    for (x, y), (w, h) in p.allocations.items():
+        cells = set((x_, y_) for x_ in range(x, x + w)
+                    for y_ in range(y, y + h))
+        assert not used & cells
+        used.update(cells)
+
+    def is_free(x, y, w, h):
+        return (p.x <= x and x + w <= p.x + p.width and
+                p.y <= y and y + h <= p.y + p.height and
+                not any((x_, y_) in used
+                        for x_ in range(x, x + w)
+                        for y_ in range(y, y + h)))
+
+    for x, y, w, h in p.free_rects:
+        # Must be free...
+        assert is_free(x, y, w, h)
+        # ...and maximal
+        assert not is_free(x - 1, y, w + 1, h)
+        assert not is_free(x, y, w + 1, h)
+        assert not is_free(x, y - 1, w, h + 1)
+        assert not is_free(x, y, w, h + 1)
+
+    # Every free cell must be covered
+    assert set((x, y)
+               for x in range(p.x, p.x + p.width)
+               for y in range(p.y, p.y + p.height)
+               if (x, y) not in used) == set(
+        (x_, y_)
+        for x, y, w, h in p.free_rects
+        for x_ in range(x, x + w)
+        for y_ in range(y, y + h))
+
+
+def test_constructor():
+    p = MaxRectsPacker(1, 2, 3, 4)
+    assert p.x == 1
+    assert p.y == 2
+    assert p.width == 3
+    assert p.height == 4
+    assert p.allocations == {}
+    assert p.free_rects == [(1, 2, 3, 4)]
+
+
+@pytest.mark.parametrize("x,y,contains",
+                         [(0, 0, False),
+                          (1, 2, True),
+                          (3, 5, True),
+                          (4, 5, False),
+                          (3, 6, False)])
+def test_contains(x, y, contains):
+    p = MaxRectsPacker(1, 2, 3, 4)
+    assert ((x, y) in p) is contains
+
+
+class TestAlloc(object):
+
+    @pytest.mark.parametrize("w,h", [(4, 3), (3, 5), (4, 5)])
+    def test_too_large(self, w, h):
+        p = MaxRectsPacker(0, 0, 3, 4)
+        assert p.alloc(w, h) is None
+
+    def test_exact_match(self):
+        p = MaxRectsPacker(1, 2, 3, 4)
+        assert p.alloc(3, 4) == (1, 2)
+        assert p.free_rects == []
+        assert p.alloc(1, 1) is None
+
+    def test_candidate_filter(self):
+        p = MaxRectsPacker(0, 0, 3, 4)
+
+        # All four corners should be tried, each only once
+        candidate_filter = Mock(return_value=False)
+        assert p.alloc(2, 2, candidate_filter) is None
+        assert len(candidate_filter.mock_calls) == 4
+        assert set(c[1] for c in candidate_filter.mock_calls) == set([
+            (0, 0, 2, 2), (1, 0, 2, 2), (0, 2, 2, 2), (1, 2, 2, 2)])
+
+        candidate_filter = Mock(side_effect=(lambda x, y, w, h: x == 1))
+        assert p.alloc(2, 2, candidate_filter) in ((1, 0), (1, 2))
+
+    def test_spans_previous_cuts(self):
+        # Free space which spans parts of the machine divided up by previous
+        # allocations should still be usable.
+        p = MaxRectsPacker(0, 0, 4, 4)
+        allocations = set(p.alloc(2, 2) for _ in range(4))
+        assert allocations == set([(0, 0), (2, 0), (0, 2), (2, 2)])
+        assert p.alloc(1, 1) is None
+
+        p.free(0, 0)
+        p.free(2, 0)
+        check_free_rects(p)
+        assert p.alloc(4, 2) == (0, 0)
+        assert p.alloc(1, 1) is None
+
+
+def test_alloc_area():
+    p = MaxRectsPacker(0, 0, 4, 4)
+
+    # Too big
+    assert p.alloc_area(17) is None
+
+    # Should pick a suitable shape
+    x, y, w, h = p.alloc_area(6, 0.5)
+    assert w * h >= 6
+    assert min(w, h) / float(max(w, h)) >= 0.5
+    check_free_rects(p)
+
+    # Nothing suitable can be found
+    assert p.alloc_area(10) is None
+
+    # Candidate filter should be respected
+    assert p.alloc_area(1, candidate_filter=Mock(return_value=False)) is None
+
+
+def test_request():
+    p = MaxRectsPacker(0, 0, 3, 3)
+    assert p.request(5, 5) is None
+    assert p.request(1, 1) == (1, 1)
+    assert p.request(1, 1) is None
+    check_free_rects(p)
+
+
+def test_free():
+    p = MaxRectsPacker(0, 0, 3, 3)
+    with pytest.raises(FreeError):
+        p.free(3, 3)
+    with pytest.raises(FreeError):
+        p.free(0, 0)
+
+    assert p.alloc(2, 2) == (0, 0)
+    with pytest.raises(FreeError):
+        p.free(1, 1)
+
+    p.free(0, 0)
+    assert p.allocations == {}
+    assert p.free_rects == [(0, 0, 3, 3)]
+
+
+def test_random_usage():
+    rng = random.Random(1)
+    w, h = 12, 10
+    p = MaxRectsPacker(0, 0, w, h)
+    allocations = []
+    for _ in range(300):
+        choice = rng.random()
+        if allocations and choice < 0.4:
+            x, y = allocations.pop(rng.randrange(len(allocations)))
+            p.free(x, y)
+        elif choice < 0.7:
+            xy = p.alloc(rng.randint(1, 4), rng.randint(1, 4))
+            if xy is not None:
+                allocations.append(xy)
+        elif choice < 0.9:
+            xywh = p.alloc_area(rng.randint(1, 12), 0.3)
+            if xywh is not None:
+                allocations.append(xywh[:2])
+        else:
+            xy = p.request(rng.randrange(w), rng.randrange(h))
+            if xy is not None:
+                allocations.append(xy)
+        check_free_rects(p)
+
+    # After freeing everything, we should have the whole space
+    for x, y in allocations:
+        p.free(x, y)
+    assert p.free_rects == [(0, 0, w, h)]
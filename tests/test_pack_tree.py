@@ -355,6 +355,60 @@ class TestAlloc(object):
 
         assert p.alloc(3, 1) is None
 
+    def test_skip_full_children(self):
+        # Subtrees without a large enough free leaf should not be searched
+        p = PackTree(0, 0, 4, 4)
+        assert p.alloc(2, 3) == (0, 0)
+        assert p.children[0]._free_space() == (2, 1, 2)
+        assert p._free_space() == (2, 4, 8)
+
+        p.children[0].children[1].alloc = Mock(side_effect=Exception())
+        assert p.alloc(2, 2) == (2, 0)
+        assert p._free_space() == (2, 2, 4)
+
+
+def check_free_space(p):
+    """Check the free space summaries of a tree are consistent, returning the
+    set of free leaves.
+    """
+    if p.children is None:
+        return set() if p.allocated else set([p])
+
+    leaves = set()
+    for child in p.children:
+        leaves.update(check_free_space(child))
+    assert p._free_space() == (
+        max([0] + [leaf.width for leaf in leaves]),
+        max([0] + [leaf.height for leaf in leaves]),
+        max([0] + [leaf.width * leaf.height for leaf in leaves]))
+    return leaves
+
+
+def test_free_space_random():
+    # The free space summaries should remain accurate during arbitrary use
+    rng = random.Random(1)
+    w, h = 12, 10
+    p = PackTree(0, 0, w, h)
+    allocations = []
+    for _ in range(500):
+        choice = rng.random()
+        if allocations and choice < 0.4:
+            x, y = allocations.pop(rng.randrange(len(allocations)))
+            p.free(x, y)
+        elif choice < 0.7:
+            xy = p.alloc(rng.randint(1, 4), rng.randint(1, 4))
+            if xy is not None:
+                allocations.append(xy)
+        elif choice < 0.9:
+            xywh = p.alloc_area(rng.randint(1, 12), 0.3)
+            if xywh is not None:
+                allocations.append(xywh[:2])
+        else:
+            xy = p.request(rng.randrange(w), rng.randrange(h))
+            if xy is not None:
+                allocations.append(xy)
+        check_free_space(p)
+
 
 class TestRequest(object):
 
@@ -0,0 +1,98 @@
+import pytest
+
+import struct
+
+from spalloc_server import protocol
+from spalloc_server.protocol import \
+    JSONLinesProtocol, MsgpackProtocol, PROTOCOLS, DEFAULT_PROTOCOL, \
+    FrameTooLongError, get_protocol
+
+
+MESSAGE = {"command": "create_job",
+           "args": [1, 2],
+           "kwargs": {"owner": u"me", "keepalive": None, "tags": ["a"]}}
+
+
+def test_default_protocol():
+    assert DEFAULT_PROTOCOL is PROTOCOLS["json"]
+    assert isinstance(DEFAULT_PROTOCOL, JSONLinesProtocol)
+
+
+def test_json_round_trip():
+    p = JSONLinesProtocol()
+    data = p.encode(MESSAGE)
+    assert data.endswith(b"\n")
+    assert data.count(b"\n") == 1
+
+    # Frames should be read from the given offset
+    buffer = bytearray(b"\n" + data + data + b"{")
+    frame, end = p.read_frame(buffer)
+    assert (frame, end) == (b"", 1)
+    frame, end = p.read_frame(buffer, end)
+    assert end == 1 + len(data)
+    assert p.decode(frame) == MESSAGE
+    frame, end = p.read_frame(buffer, end)
+    assert end == 1 + 2 * len(data)
+    assert p.decode(frame) == MESSAGE
+    assert p.read_frame(buffer, end) == (None, end)
+
+
+@pytest.mark.parametrize("buffer", [b"", b"{", b'{"command": "version"}'])
+def test_json_incomplete_frame(buffer):
+    assert JSONLinesProtocol().read_frame(bytearray(buffer)) == (None, 0)
+
+
+def test_json_max_length():
+    p = JSONLinesProtocol()
+    assert p.read_frame(b"x1234\n", 1, 4) == (b"1234", 6)
+    assert p.read_frame(b"x1234", 1, 4) == (None, 1)
+    with pytest.raises(FrameTooLongError):
+        p.read_frame(b"x12345\n", 1, 4)
+
+    # Over-long lines should be detected before they are complete
+    with pytest.raises(FrameTooLongError):
+        p.read_frame(b"x12345", 1, 4)
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip("msgpack")
+    p = MsgpackProtocol()
+    data = p.encode(MESSAGE)
+    assert struct.unpack_from(">I", data) == (len(data) - 4, )
+
+    buffer = bytearray(b"\x00" + data + b"\x00")
+    frame, end = p.read_frame(buffer, 1)
+    assert end == 1 + len(data)
+    assert p.decode(frame) == MESSAGE
+    assert p.read_frame(buffer, end) == (None, end)
+
+
+@pytest.mark.parametrize("buffer", [b"", b"\x00\x00\x00",
+                                    b"\x00\x00\x00\x02\x80"])
+def test_msgpack_incomplete_frame(buffer):
+    assert MsgpackProtocol().read_frame(bytearray(buffer)) == (None, 0)
+
+
+def test_msgpack_empty_frame():
+    assert MsgpackProtocol().read_frame(b"\x00\x00\x00\x00abc") == (b"", 4)
+
+
+def test_msgpack_max_length():
+    p = MsgpackProtocol()
+    assert p.read_frame(b"\x00\x00\x00\x041234", 0, 4) == (b"1234", 8)
+
+    # Over-long frames should be detected from their header alone
+    with pytest.raises(FrameTooLongError):
+        p.read_frame(b"\x00\x00\x00\x05", 0, 4)
+
+
+def test_get_protocol(monkeypatch):
+    assert get_protocol("json") is PROTOCOLS["json"]
+
+    with pytest.raises(ValueError):
+        get_protocol("xml")
+
+    # Should fail if msgpack isn't installed
+    monkeypatch.setattr(protocol, "msgpack", None)
+    with pytest.raises(ValueError):
+        get_protocol("msgpack")
@@ -0,0 +1,212 @@
+import pytest
+
+import json
+import os.path
+import tempfile
+import shutil
+
+from spalloc_server.controller import JobState
+from spalloc_server.replay import Replayer, main
+from spalloc_server.server import _COMMANDS
+from spalloc_server.trace import RecordType, TraceRecord, TraceWriter
+
+
+CONFIG = (
+    "configuration = Configuration(\n"
+    "    machines=[\n"
+    "        Machine('m', set(['default']), 1, 2,\n"
+    "                set(), set(),\n"
+    "                {(x, y, z): (x, y, z)\n"
+    "                 for x in range(1)\n"
+    "                 for y in range(2)\n"
+    "                 for z in range(3)},\n"
+    "                {(x, y): '10.0.{}.{}'.format(x, y)\n"
+    "                 for x in range(1)\n"
+    "                 for y in range(2)},\n"
+    "                {(x, y, z): '11.{}.{}.{}'.format(x, y, z)\n"
+    "                 for x in range(1)\n"
+    "                 for y in range(2)\n"
+    "                 for z in range(3)})\n"
+    "    ]\n"
+    ")\n")
+
+
+def command(name, *args, **kwargs):
+    return json.dumps({"command": name,
+                       "args": args,
+                       "kwargs": kwargs}).encode("utf-8")
+
+
+@pytest.yield_fixture
+def trace_dir():
+    dirname = tempfile.mkdtemp()
+    yield dirname
+    shutil.rmtree(dirname)
+
+
+@pytest.fixture
+def trace_file(trace_dir):
+    filename = os.path.join(trace_dir, "trace")
+    w = TraceWriter(open(filename, "wb"))
+    w.config(CONFIG)
+    w.command(0, command("create_job", owner="me", keepalive=None))
+    w.command(1, command("create_job", 2, owner="me", keepalive=None))
+    for seq in range(7):
+        w.bmp_request_complete(1, seq, True)
+    w.command(0, command("no_such_command"))
+    w.close()
+    return filename
+
+
+@pytest.yield_fixture
+def r():
+    r = Replayer()
+    yield r
+    r.stop()
+
+
+def test_replay(r, trace_file):
+    with open(trace_file, "rb") as f:
+        r.replay_file(f)
+
+    assert r.num_records == 11
+    assert r.num_commands == 3
+    assert r.failed_commands == 1
+    assert r.unexpected_completions == 0
+
+    assert list(r.controller.machines) == ["m"]
+
+    # All of the first job's BMP requests completed, the second job's were
+    # never completed
+    assert r.controller.get_job_state(1).state == JobState.ready
+    assert r.controller.get_job_state(2).state == JobState.power
+
+
+def test_bmp_failure_and_timeout(r, trace_dir):
+    filename = os.path.join(trace_dir, "trace")
+    w = TraceWriter(open(filename, "wb"))
+    w.config(CONFIG)
+    w.command(0, command("create_job", owner="me", keepalive=None))
+    w.command(0, command("create_job", owner="me", keepalive=None))
+    w.bmp_request_complete(1, 0, False)
+    w.jobs_timed_out([2])
+    w.bmp_request_complete(3, 100, True)
+    w.close()
+
+    with open(filename, "rb") as f:
+        r.replay_file(f)
+
+    assert r.controller.get_job_state(1).state == JobState.destroyed
+    assert r.controller.get_job_state(1).reason == \
+        "Machine configuration failed, please try again later."
+    assert r.controller.get_job_state(2).state == JobState.destroyed
+    assert r.controller.get_job_state(2).reason == "Job timed out."
+    assert r.unexpected_completions == 1
+
+
+def test_out_of_order_completions(r, trace_dir):
+    # Completions must be matched to the request they belong to even when a
+    # job has several requests outstanding and they complete out of order.
+    filename = os.path.join(trace_dir, "trace")
+    w = TraceWriter(open(filename, "wb"))
+    w.config(CONFIG)
+    w.command(0, command("create_job", owner="me", keepalive=None))
+    w.close()
+    with open(filename, "rb") as f:
+        r.replay_file(f)
+
+    # One power command and six link commands are outstanding for the job
+    assert sorted(r._outstanding) == list(range(7))
+    assert all(on_done.args[0].id == 1
+               for on_done in r._outstanding.values())
+
+    # Completing a later request leaves earlier ones outstanding
+    r.replay(TraceRecord(RecordType.bmp_request_complete, 0.0, None,
+                         (1, 3, True)))
+    assert sorted(r._outstanding) == [0, 1, 2, 4, 5, 6]
+
+    # A completion whose job doesn't match the request is unexpected
+    r.replay(TraceRecord(RecordType.bmp_request_complete, 0.0, None,
+                         (2, 0, True)))
+    assert r.unexpected_completions == 1
+    assert sorted(r._outstanding) == [0, 1, 2, 4, 5, 6]
+
+    # As is a repeated completion
+    r.replay(TraceRecord(RecordType.bmp_request_complete, 0.0, None,
+                         (1, 3, True)))
+    assert r.unexpected_completions == 2
+
+    # The job becomes ready once all remaining requests complete
+    for seq in (6, 0, 5, 1, 4, 2):
+        assert r.controller.get_job_state(1).state == JobState.power
+        r.replay(TraceRecord(RecordType.bmp_request_complete, 0.0, None,
+                             (1, seq, True)))
+    assert r._outstanding == {}
+    assert r.controller.get_job_state(1).state == JobState.ready
+    assert r.unexpected_completions == 2
+
+
+def test_all_commands(r):
+    # Every command the server supports should be replayable
+    r.replay(TraceRecord(RecordType.config, 0.0, None, CONFIG))
+    commands = [
+        ("version", [], {}),
+        ("set_protocol", ["json"], {}),
+        ("create_job", [], {"owner": "me", "keepalive": None}),
+        ("job_keepalive", [1], {}),
+        ("get_job_state", [1], {}),
+        ("get_job_machine_info", [1], {}),
+        ("power_on_job_boards", [1], {}),
+        ("power_off_job_boards", [1], {}),
+        ("notify_job", [1], {"states": True}),
+        ("no_notify_job", [1], {}),
+        ("notify_machine", ["m"], {}),
+        ("no_notify_machine", ["m"], {}),
+        ("list_jobs", [], {}),
+        ("list_machines", [], {}),
+        ("get_board_position", ["m", 0, 0, 0], {}),
+        ("get_board_at_position", ["m", 0, 0, 0], {}),
+        ("where_is", [], {"machine": "m", "x": 0, "y": 0, "z": 0}),
+        ("where_is_many", [], {"machine": "m", "x": [0], "y": [0],
+                               "z": [0]}),
+        ("batch", [[{"command": "version"}]], {}),
+        ("destroy_job", [1], {}),
+    ]
+    assert set(name for name, _, _ in commands) == set(_COMMANDS)
+    for name, args, kwargs in commands:
+        r.replay(TraceRecord(RecordType.command, 0.0, 0,
+                             command(name, *args, **kwargs)))
+    assert r.failed_commands == 0
+    assert r.controller.get_job_state(1).state == JobState.destroyed
+
+
+def test_notifications(r, trace_dir):
+    # Notification commands should be accepted (though not acted upon)
+    filename = os.path.join(trace_dir, "trace")
+    w = TraceWriter(open(filename, "wb"))
+    w.command(0, command("notify_job"))
+    w.command(0, command("notify_machine", "m"))
+    w.close()
+
+    with open(filename, "rb") as f:
+        r.replay_file(f)
+    assert r.failed_commands == 0
+
+
+@pytest.mark.parametrize("as_json", [False, True])
+def test_main(trace_file, trace_dir, capsys, as_json):
+    profile = os.path.join(trace_dir, "profile")
+    args = [trace_file, "--profile", profile]
+    if as_json:
+        args.append("--json")
+    assert main(args) == 0
+    assert os.path.isfile(profile)
+
+    out, err = capsys.readouterr()
+    if as_json:
+        results = json.loads(out)
+        assert results["records"] == 11
+        assert results["commands"] == 3
+        assert results["failed_commands"] == 1
+    else:
+        assert "11 records" in out
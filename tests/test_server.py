@@ -10,15 +10,23 @@ import os.path
 import logging
 import time
 import socket
+import struct
 import json
 
+from collections import OrderedDict
+
 from six import itervalues
 
 from rig.links import Links
 
-from spalloc_server.controller import JobState
-from spalloc_server.server import Server, main
+from spalloc_server.controller import Controller, JobState
+from spalloc_server.server import \
+    Server, main, _COMMANDS, _CachedReply, _Watches, \
+    BUFFER_SIZE, MAX_BUFFER_SIZE
 from spalloc_server.configuration import Configuration
+from spalloc_server.protocol import DEFAULT_PROTOCOL
+from spalloc_server.replay import Replayer
+from spalloc_server.trace import RecordType, read_trace
 
 from spalloc_server import __version__
 
@@ -404,6 +412,7 @@ def test_handle_commands_bad_recv(simple_config, s, monkeypatch):
 
     client = Mock()
     client.recv.side_effect = OSError()
+    monkeypatch.setitem(s._client_recv_sizes, client, BUFFER_SIZE)
     s._handle_commands(client)
     s._disconnect_client.assert_called_once_with(client)
 
@@ -428,6 +437,10 @@ def test_bad_send_change_notifications(monkeypatch, simple_config, s):
     client1.send.side_effect = OSError()
 
     monkeypatch.setattr(s, "_disconnect_client", Mock())
+    monkeypatch.setitem(s._client_output_buffers, client0, bytearray())
+    monkeypatch.setitem(s._client_output_buffers, client1, bytearray())
+    monkeypatch.setitem(s._client_protocols, client0, DEFAULT_PROTOCOL)
+    monkeypatch.setitem(s._client_protocols, client1, DEFAULT_PROTOCOL)
 
     # Monkeypatch in a client which will fail to send notifications
     conn = s._controller
@@ -450,12 +463,223 @@ def test_bad_send_change_notifications(monkeypatch, simple_config, s):
     ]
 
 
+def slow_client(s, num_commands):
+    """Connect a client with small socket buffers and send it lots of
+    commands (from a background thread) without reading any replies.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(("127.0.0.1", 22244))
+
+    # Also shrink the server's send buffer for the client
+    while not s._client_sockets:
+        time.sleep(0.01)
+    for client in itervalues(s._client_sockets):
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    command = json.dumps({"command": "list_machines"}).encode("utf-8")
+
+    def send_commands():
+        try:
+            sock.sendall((command + b"\n") * num_commands)
+        except (OSError, IOError):
+            # Disconnected by the server
+            pass
+    thread = threading.Thread(target=send_commands)
+    thread.daemon = True
+    thread.start()
+
+    return sock, thread
+
+
+@pytest.mark.timeout(2.0)
+def test_throttle_slow_client(simple_config, s):
+    num_commands = 2000
+    sock, thread = slow_client(s, num_commands)
+
+    # Eventually, the server should stop reading commands from the client
+    while not s._throttled_clients:
+        time.sleep(0.01)
+
+    # Other clients should still be served
+    c = SimpleClient()
+    assert c.call("version") == __version__
+    c.close()
+
+    # Once the client starts reading, every reply should arrive intact
+    f = sock.makefile("rb")
+    for _ in range(num_commands):
+        reply = json.loads(f.readline().decode("utf-8"))
+        assert len(reply["return"]) == 1
+    thread.join()
+    assert not s._throttled_clients
+    f.close()
+    sock.close()
+
+
+@pytest.mark.timeout(2.0)
+def test_disconnect_slow_client(config_file, caplog):
+    with open(config_file, "w") as f:
+        f.write("configuration = Configuration(\n"
+                "    machines=[Machine.single_board(\n"
+                "        'm', bmp_ip='10.0.0.0', spinnaker_ip='11.0.0.0')],\n"
+                "    max_client_output_buffer=1024)\n")
+    s = Server(config_file)
+    try:
+        sock, thread = slow_client(s, 20000)
+
+        # The client should eventually be disconnected
+        while s._client_sockets:
+            time.sleep(0.01)
+
+        # Other clients should still be served
+        c = SimpleClient()
+        assert c.call("version") == __version__
+        c.close()
+        sock.close()
+    finally:
+        s.stop_and_join()
+
+    # The client should be reported as slow, not as sending a bad command
+    assert "is not reading its messages" in caplog.text
+    assert "sent bad command" not in caplog.text
+
+
 @pytest.mark.timeout(1.0)
 def test_version_command(simple_config, s, c):
     # First basic test of calling a remote method
     assert c.call("version") == __version__
 
 
+@pytest.mark.timeout(1.0)
+def test_batch_command(simple_config, s, c):
+    job_id = c.call("create_job", owner="me")
+    machine_info = c.call("get_job_machine_info", job_id)
+
+    # Several commands should be executed in one go
+    version, info, destroyed, state = c.call("batch", [
+        {"command": "version"},
+        {"command": "get_job_machine_info", "args": [job_id]},
+        {"command": "destroy_job", "args": [job_id],
+         "kwargs": {"reason": "Done."}},
+        {"command": "get_job_state", "kwargs": {"job_id": job_id}},
+    ])
+    assert version == __version__
+    assert info == machine_info
+    assert destroyed is None
+    assert state["state"] == JobState.destroyed
+    assert state["reason"] == "Done."
+
+    # Empty batches should work
+    assert c.call("batch", []) == []
+
+
+@pytest.mark.timeout(1.0)
+def test_batch_command_holds_lock(simple_config, s, c, monkeypatch):
+    # The controller should be locked while the batch runs
+    locked = []
+
+    def version(self, client):
+        locked.append(s._controller._lock._is_owned())
+        return __version__
+    monkeypatch.setitem(_COMMANDS, "version", version)
+
+    assert c.call("batch", [{"command": "version"}] * 2) == [__version__] * 2
+    assert locked == [True, True]
+
+
+@pytest.mark.timeout(1.0)
+def test_pipelined_replies_coalesced(simple_config, s, c, monkeypatch):
+    flush_client = Mock(side_effect=s._flush_client)
+    monkeypatch.setattr(s, "_flush_client", flush_client)
+
+    # Replies to commands arriving together should be sent together
+    command = json.dumps({"command": "version"}).encode("utf-8") + b"\n"
+    c.sock.send(command * 3)
+    for _ in range(3):
+        assert c.get_return() == __version__
+    assert len(flush_client.mock_calls) == 1
+
+
+@pytest.mark.timeout(1.0)
+def test_large_pipelined_commands(simple_config, s, c):
+    # Large numbers of commands arriving in one go should all be handled
+    command = json.dumps({"command": "version"}).encode("utf-8") + b"\n"
+    c.sock.sendall(command * 2000)
+    for _ in range(2000):
+        assert c.get_return() == __version__
+
+    # The recv size should have grown to cope with the large volume of data
+    client, = itervalues(s._client_sockets)
+    assert BUFFER_SIZE < s._client_recv_sizes[client] <= MAX_BUFFER_SIZE
+    assert len(s._client_buffers[client]) == 0
+
+    # And shrink again when the client goes quiet
+    for _ in range(10):
+        assert c.call("version") == __version__
+    assert s._client_recv_sizes[client] == BUFFER_SIZE
+
+
+@pytest.mark.timeout(1.0)
+def test_command_split_across_recvs(simple_config, s, c):
+    command = json.dumps({"command": "version"}).encode("utf-8") + b"\n"
+    c.sock.send(command[:5])
+    time.sleep(0.05)
+    c.sock.send(command[5:] + command)
+    assert c.get_return() == __version__
+    assert c.get_return() == __version__
+
+
+@pytest.mark.timeout(1.0)
+def test_command_too_long(simple_config, s, c, monkeypatch):
+    monkeypatch.setattr(s, "_configuration",
+                        s._configuration._replace(max_command_length=64))
+    assert c.call("version") == __version__
+
+    # Clients sending over-long commands should be disconnected, even before
+    # the command is complete
+    c.sock.send(b"[" * 100)
+    assert c.sock.recv(1024) == b""
+
+
+@pytest.mark.timeout(1.0)
+def test_set_protocol(simple_config, s, c):
+    # Switching to the current protocol should change nothing
+    assert c.call("set_protocol", "json") is None
+    assert c.call("version") == __version__
+
+    # Unknown protocols should be rejected
+    with pytest.raises(ValueError):
+        s.set_protocol(Mock(), "carrier pigeon")
+
+
+@pytest.mark.timeout(1.0)
+def test_set_protocol_msgpack(simple_config, s, c):
+    msgpack = pytest.importorskip("msgpack")
+
+    def frame(obj):
+        data = msgpack.packb(obj, use_bin_type=True)
+        return struct.pack(">I", len(data)) + data
+
+    # Commands following the set_protocol command in the same buffer should
+    # be read using the new protocol
+    c.sock.send(json.dumps({"command": "set_protocol",
+                            "args": ["msgpack"]}).encode("utf-8") + b"\n" +
+                frame({"command": "version"}))
+
+    buf = b""
+    replies = []
+    while len(replies) < 2:
+        buf += c.sock.recv(1024)
+        while len(buf) >= 4:
+            length, = struct.unpack_from(">I", buf)
+            if len(buf) < 4 + length:
+                break
+            replies.append(msgpack.unpackb(buf[4:4 + length], raw=False))
+            buf = buf[4 + length:]
+    assert replies == [{"return": None}, {"return": __version__}]
+
+
 @pytest.mark.timeout(1.0)
 def test_job_management(simple_config, s, c):
     # First more complete test of calling a remote method with complex
@@ -463,11 +687,15 @@ def test_job_management(simple_config, s, c):
 
     # Should get allocated
     job_id0 = c.call("create_job", tags=["default"], owner="me")
-    s._controller._jobs[job_id0].start_time = 1234.5
+    with s._controller:
+        s._controller._jobs[job_id0].start_time = 1234.5
+        s._controller._mark_jobs_changed([job_id0])
 
     # Should be queued
     job_id1 = c.call("create_job", 1, 2, owner="me", require_torus=True)
-    s._controller._jobs[job_id1].start_time = 5432.0
+    with s._controller:
+        s._controller._jobs[job_id1].start_time = 5432.0
+        s._controller._mark_jobs_changed([job_id1])
 
     # Should be impossible
     job_id2 = c.call("create_job", 2, 2, owner="me")
@@ -540,6 +768,9 @@ def test_job_management(simple_config, s, c):
     assert jobs[0]["kwargs"] == {"tags": ["default"]}
     assert jobs[1]["kwargs"] == {"require_torus": True}
 
+    # Listing jobs must not modify the controller's record of the jobs
+    assert s._controller.list_jobs()[0].kwargs == {"tags": set(["default"])}
+
     assert jobs[0]["allocated_machine_name"] == "m"
     assert jobs[1]["allocated_machine_name"] is None
 
@@ -572,6 +803,48 @@ def test_keepalive_expiration(fast_keepalive_config, s, c):
     assert s._controller.get_job_state(job_id).state == JobState.destroyed
 
 
+@pytest.mark.timeout(1.0)
+def test_keepalive_expiration_deadline(simple_config, s, c):
+    # Jobs should be timed out as soon as their keepalive expires rather than
+    # at the next timeout_check_interval
+    assert s._configuration.timeout_check_interval == 5.0
+    assert s._get_timeout() == 5.0
+
+    job_id = c.call("create_job", keepalive=0.1, owner="me")
+    assert 0.0 < s._get_timeout() <= 0.1
+
+    time.sleep(0.2)
+    assert s._controller.get_job_state(job_id).state == JobState.destroyed
+    assert s._get_timeout() == 5.0
+
+
+@pytest.mark.timeout(1.0)
+def test_timed_out_jobs_only_checked_when_due(simple_config, s, c,
+                                              monkeypatch):
+    # Count the calls made to the controller (patched on the class since the
+    # controller is pickled when the server shuts down)
+    calls = []
+    destroy_timed_out_jobs = Controller.destroy_timed_out_jobs
+
+    def counted(self):
+        calls.append(time.time())
+        return destroy_timed_out_jobs(self)
+    monkeypatch.setattr(Controller, "destroy_timed_out_jobs", counted)
+
+    # Handling commands should not check for timed out jobs when none may
+    # have timed out
+    c.call("create_job", keepalive=None, owner="me")
+    job_id = c.call("create_job", keepalive=0.1, owner="me")
+    for _ in range(10):
+        c.call("version")
+    assert calls == []
+
+    # Once the job's keepalive expires, the check is made
+    time.sleep(0.2)
+    assert s._controller.get_job_state(job_id).state == JobState.destroyed
+    assert len(calls) == 1
+
+
 @pytest.mark.timeout(1.0)
 def test_list_machines(double_config, s, c):
     machines = c.call("list_machines")
@@ -597,6 +870,76 @@ def test_list_machines(double_config, s, c):
     assert machines[1]["dead_links"] == [[1, 1, 1, Links.north]]
 
 
+def test_cached_reply():
+    protocol = Mock()
+    protocol.encode.return_value = b"encoded"
+    reply = _CachedReply([1, 2, 3])
+
+    # Should only be encoded once per protocol
+    assert reply.encode(protocol) == b"encoded"
+    assert reply.encode(protocol) == b"encoded"
+    protocol.encode.assert_called_once_with({"return": [1, 2, 3]})
+    assert reply.encode(DEFAULT_PROTOCOL) == b'{"return": [1, 2, 3]}\n'
+
+
+@pytest.mark.timeout(1.0)
+def test_list_replies_cached(simple_config, s, c, monkeypatch):
+    # Count the calls made to the controller (patched on the class since the
+    # controller is pickled when the server shuts down)
+    calls = []
+
+    def counted(f):
+        def wrapper(self):
+            calls.append(f.__name__)
+            return f(self)
+        return wrapper
+    monkeypatch.setattr(Controller, "list_jobs",
+                        counted(Controller.list_jobs))
+    monkeypatch.setattr(Controller, "list_machines",
+                        counted(Controller.list_machines))
+
+    # Repeated calls should only query the controller once
+    assert c.call("list_jobs") == []
+    assert c.call("list_jobs") == []
+    machines = c.call("list_machines")
+    assert c.call("list_machines") == machines
+    assert calls == ["list_jobs", "list_machines"]
+
+    # Changes to jobs should invalidate the list_jobs cache (the list of
+    # machines does not depend on them)
+    job_id = c.call("create_job", owner="me")
+    jobs = c.call("list_jobs")
+    assert [job["job_id"] for job in jobs] == [job_id]
+    assert c.call("list_machines") == machines
+    assert calls.count("list_jobs") == 2
+    assert calls.count("list_machines") == 1
+
+    # Cached replies should work in batches
+    assert c.call("batch", [{"command": "list_jobs"},
+                            {"command": "list_machines"}]) == [jobs, machines]
+    c.call("destroy_job", job_id)
+    assert c.call("batch", [{"command": "list_jobs"}]) == [[]]
+    assert calls.count("list_jobs") == 3
+    assert calls.count("list_machines") == 1
+
+
+@pytest.mark.timeout(1.0)
+def test_list_machines_cached_until_reordered(double_config, s, c):
+    # The cached reply should be kept while jobs come and go...
+    machines = c.call("list_machines")
+    assert [m["name"] for m in machines] == ["m0", "m1"]
+    reply = s._list_machines_reply
+    job_id = c.call("create_job", owner="me")
+    c.call("destroy_job", job_id)
+    assert c.call("list_machines") == machines
+    assert s._list_machines_reply is reply
+
+    # ...but not once the machines are re-ordered
+    s._controller.machines = OrderedDict(
+        reversed(list(s._controller.machines.items())))
+    assert [m["name"] for m in c.call("list_machines")] == ["m1", "m0"]
+
+
 @pytest.mark.timeout(1.0)
 def test_where_is(double_config, s, c):
     assert c.call("create_job", 1, 1, owner="me") == 1
@@ -624,6 +967,35 @@ def test_where_is(double_config, s, c):
     }
 
 
+@pytest.mark.timeout(1.0)
+def test_where_is_many(double_config, s, c):
+    assert c.call("create_job", 1, 1, owner="me") == 1
+
+    assert c.call("where_is_many", machine="bad", x=[0], y=[0], z=[0]) is None
+
+    assert c.call("where_is_many", job_id=1,
+                  chip_x=[5, 0], chip_y=[9, 12]) == {
+        "machine": "m0",
+        "logical": [[0, 0, 2], None],
+        "physical": [[0, 0, 20], None],
+        "chip": [[5, 9], None],
+        "board_chip": [[1, 1], None],
+        "job_id": [1, None],
+        "job_chip": [[5, 9], None],
+    }
+
+    assert c.call("where_is_many", machine="m1", cabinet=[20, 99],
+                  frame=[10, 99], board=[10, 99]) == {
+        "machine": "m1",
+        "logical": [[2, 1, 1], None],
+        "physical": [[20, 10, 10], None],
+        "chip": [[32, 16], None],
+        "board_chip": [[0, 0], None],
+        "job_id": [None, None],
+        "job_chip": [None, None],
+    }
+
+
 @pytest.mark.timeout(1.0)
 def test_get_board_position(simple_config, s, c):
     assert c.call("get_board_position", "bad", 0, 0, 0) is None
@@ -639,6 +1011,123 @@ def test_get_board_at_position(simple_config, s, c):
 
 
 @pytest.mark.timeout(1.0)
+@pytest.mark.timeout(2.0)
+def test_trace(MockABC, simple_config, config_dir):
+    trace_filename = os.path.join(config_dir, "trace")
+    s = Server(simple_config, trace_filename=trace_filename)
+    try:
+        c = SimpleClient()
+        job_id = c.call("create_job", owner="me", keepalive=None)
+        time.sleep(0.05)
+        c.close()
+    finally:
+        s.stop_and_join()
+
+    with open(trace_filename, "rb") as f:
+        records = list(read_trace(f))
+    with open(simple_config, "r") as f:
+        config_script = f.read()
+
+    # The config file, command and BMP completions (one power command and six
+    # link commands) should have been recorded
+    assert [r.type for r in records] == \
+        [RecordType.config, RecordType.command] + \
+        [RecordType.bmp_request_complete] * 7
+    assert records[0].payload == config_script
+    assert json.loads(records[1].payload.decode("utf-8"))["command"] == \
+        "create_job"
+    assert [r.payload for r in records[2:]] == \
+        [(job_id, seq, True) for seq in range(7)]
+
+
+@pytest.mark.timeout(2.0)
+def test_trace_timeout(MockABC, fast_keepalive_config, config_dir):
+    trace_filename = os.path.join(config_dir, "trace")
+    s = Server(fast_keepalive_config, trace_filename=trace_filename)
+    try:
+        c = SimpleClient()
+        job_id = c.call("create_job", owner="me", keepalive=0.1)
+        time.sleep(0.5)
+        c.close()
+    finally:
+        s.stop_and_join()
+
+    with open(trace_filename, "rb") as f:
+        records = list(read_trace(f))
+    timeouts = [r for r in records if r.type == RecordType.jobs_timed_out]
+    assert len(timeouts) == 1
+    assert timeouts[0].payload == [job_id]
+
+
+class SyncBMPController(object):
+    """A stand-in for an AsyncBMPController which completes every request
+    immediately, in the thread which made it."""
+
+    def __init__(self, hostname, on_thread_start=None, engine=None):
+        if on_thread_start is not None:
+            on_thread_start()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        pass
+
+    def set_power(self, board, state, on_done):
+        on_done(True)
+
+    def set_link_enable(self, board, link, enable, on_done):
+        on_done(True)
+
+    def stop(self):
+        pass
+
+    def join(self):
+        pass
+
+
+@pytest.mark.timeout(2.0)
+def test_trace_sync_bmp(monkeypatch, fast_keepalive_config, config_dir):
+    # Even when BMP requests complete before the call which made them
+    # returns, the trace must record what caused a request before its
+    # completion so that the trace can be replayed.
+    import spalloc_server.controller
+    monkeypatch.setattr(spalloc_server.controller, "AsyncBMPController",
+                        SyncBMPController)
+
+    trace_filename = os.path.join(config_dir, "trace")
+    s = Server(fast_keepalive_config, trace_filename=trace_filename)
+    try:
+        c = SimpleClient()
+        job_id = c.call("create_job", owner="me", keepalive=0.1)
+        time.sleep(0.5)
+        c.close()
+    finally:
+        s.stop_and_join()
+
+    with open(trace_filename, "rb") as f:
+        records = list(read_trace(f))
+
+    # The command comes before the completions of the requests it made and
+    # the timeout before the completion of the power-off it caused
+    assert [r.type for r in records] == \
+        [RecordType.config, RecordType.command] + \
+        [RecordType.bmp_request_complete] * 7 + \
+        [RecordType.jobs_timed_out, RecordType.bmp_request_complete]
+    assert records[-2].payload == [job_id]
+    assert records[-1].payload == (job_id, 7, True)
+
+    # The trace replays without any unexpected completions
+    r = Replayer()
+    try:
+        for record in records:
+            r.replay(record)
+        assert r.unexpected_completions == 0
+        assert r.controller.get_job_state(job_id).reason == "Job timed out."
+    finally:
+        r.stop()
+
+
 def test_job_notifications(simple_config, s):
     c0 = SimpleClient()
     c1 = SimpleClient()
@@ -670,6 +1159,60 @@ def test_job_notifications(simple_config, s):
     assert c1.get_notification() == {"jobs_changed": [job_id1]}
 
 
+@pytest.mark.timeout(1.0)
+def test_job_state_notifications(simple_config, s):
+    c0 = SimpleClient()
+    c1 = SimpleClient()
+
+    # Listen for the new state of all jobs
+    c1.call("notify_job", states=True)
+
+    with s._controller._bmp_controllers["m"][(0, 0)].handler_lock:
+        job_id = c0.call("create_job", owner="me")
+        states, = c1.get_notification()["job_states"]
+        assert states["job_id"] == job_id
+        assert states["state"] == JobState.power
+        assert states["power"] is True
+        assert states["allocated_machine_name"] == "m"
+        assert states["boards"] == [[0, 0, 0]]
+        assert states["reason"] is None
+    assert c1.get_notification() == {"job_states": [{
+        "job_id": job_id, "state": JobState.ready, "power": True,
+        "reason": None, "allocated_machine_name": "m",
+        "boards": [[0, 0, 0]]}]}
+
+    # Both forms of notification should be available at once
+    c1.call("notify_job", job_id)
+    c0.call("destroy_job", job_id, "Done.")
+    notifications = [c1.get_notification(), c1.get_notification()]
+    assert {"jobs_changed": [job_id]} in notifications
+    assert {"job_states": [{
+        "job_id": job_id, "state": JobState.destroyed, "power": None,
+        "reason": "Done.", "allocated_machine_name": None,
+        "boards": None}]} in notifications
+
+    # Unsubscribing should remove both
+    c1.call("no_notify_job")
+    assert s._client_job_watches == {}
+    assert s._client_job_state_watches == {}
+
+    c0.close()
+    c1.close()
+
+
+@pytest.mark.timeout(1.0)
+def test_job_state_notifications_keepalive(fast_keepalive_config, s, c):
+    # Notifications should not keep a job alive
+    c.call("notify_job", states=True)
+    job_id = c.call("create_job", keepalive=0.2, owner="me")
+    while True:
+        states = c.get_notification()["job_states"]
+        if states[-1]["state"] == JobState.destroyed:
+            break
+    assert states[-1]["job_id"] == job_id
+    assert states[-1]["reason"] == "Job timed out."
+
+
 @pytest.mark.timeout(1.0)
 def test_machine_notifications(double_config, s):
     c0 = SimpleClient()
@@ -709,6 +1252,43 @@ def test_machine_notifications(double_config, s):
                                      {"machines_changed": ["m1", "m0"]})
 
 
+def test_watches():
+    w = _Watches()
+    assert w == {}
+    assert w.recipients(set([1, 2])) == {}
+
+    w.register("a", None)
+    w.register("b", 1)
+    w.register("b", 2)
+    w.register("c", 2)
+    w["d"] = set([3])
+    assert w == {"a": None, "b": set([1, 2]), "c": set([2]), "d": set([3])}
+
+    assert w.recipients(set()) == {}
+    assert w.recipients(set([1])) == {"a": set([1]), "b": set([1])}
+    assert w.recipients(set([2, 4])) == {"a": set([2, 4]),
+                                         "b": set([2]),
+                                         "c": set([2])}
+
+    # Removal should be reflected in the index
+    w.unregister("b", 2)
+    w.unregister("c", 2)
+    w.unregister("c", 2)
+    del w["a"]
+    assert w.pop("d") == set([3])
+    assert w.pop("d", None) is None
+    assert w == {"b": set([1])}
+    assert w.recipients(set([1, 2, 3])) == {"b": set([1])}
+
+    # Replacing a client's watches should replace them in the index
+    w["b"] = set([2])
+    assert w.recipients(set([1, 2])) == {"b": set([2])}
+    w.unregister("b", None)
+    assert w == {}
+    assert w._by_id == {}
+    assert w._wildcard == set()
+
+
 @pytest.mark.timeout(1.0)
 def test_job_notify_register_unregister(simple_config, s):
     # Make sure the registration/unregistration commands for job notifications
@@ -845,12 +1425,13 @@ def test_machine_notify_register_unregister(simple_config, s):
     assert s._client_machine_watches == {}
 
 
-@pytest.mark.parametrize("args,cold_start",
-                         [("{}", False),
-                          ("{} -q", False),
-                          ("{} --cold-start", True),
-                          ("{} -q --cold-start", True)])
-def test_commandline(monkeypatch, config_file, args, cold_start):
+@pytest.mark.parametrize("args,cold_start,trace",
+                         [("{}", False, None),
+                          ("{} -q", False, None),
+                          ("{} --cold-start", True, None),
+                          ("{} -q --cold-start", True, None),
+                          ("{} --trace foo.trace", False, "foo.trace")])
+def test_commandline(monkeypatch, config_file, args, cold_start, trace):
     server = Mock()
     Server = Mock(return_value=server)
     server.is_alive.return_value = False
@@ -861,7 +1442,8 @@ def test_commandline(monkeypatch, config_file, args, cold_start):
     main(args.format(config_file).split())
 
     Server.assert_called_once_with(config_filename=config_file,
-                                   cold_start=cold_start)
+                                   cold_start=cold_start,
+                                   trace_filename=trace)
 
 
 def test_keyboard_interrupt(monkeypatch, config_file):
@@ -875,11 +1457,27 @@ def test_keyboard_interrupt(monkeypatch, config_file):
     main([config_file])
 
     Server.assert_called_once_with(config_filename=config_file,
-                                   cold_start=False)
+                                   cold_start=False,
+                                   trace_filename=None)
     s.is_alive.assert_called_once_with()
     s.stop_and_join.assert_called_once_with()
 
 
+def test_asyncio_unsupported(monkeypatch, config_file, capsys):
+    # Using the asyncio server on an unsupported version of Python should
+    # fail with a clear error
+    Server = Mock()
+    import spalloc_server.server
+    monkeypatch.setattr(spalloc_server.server, "Server", Server)
+    monkeypatch.setattr(spalloc_server.server.sys, "version_info", (3, 6, 0))
+
+    with pytest.raises(SystemExit):
+        main([config_file, "--asyncio"])
+
+    assert "--asyncio requires Python 3.7 or later" in capsys.readouterr()[1]
+    assert len(Server.mock_calls) == 0
+
+
 @pytest.mark.parametrize("args", ["", "--cold-start" "-c"])
 def test_bad_args(monkeypatch, args):
     server = Mock()
@@ -0,0 +1,86 @@
+import pytest
+
+import struct
+
+from io import BytesIO
+
+from spalloc_server.trace import \
+    TraceWriter, TraceFormatError, RecordType, read_trace, MAGIC, VERSION
+
+
+class UnclosedBytesIO(BytesIO):
+    """A BytesIO whose contents remain accessible once closed."""
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def f():
+    return UnclosedBytesIO()
+
+
+def test_empty(f):
+    w = TraceWriter(f)
+    w.close()
+    assert f.getvalue() == struct.pack("<4sH", MAGIC, VERSION)
+
+    f.seek(0)
+    assert list(read_trace(f)) == []
+
+
+def test_round_trip(f):
+    w = TraceWriter(f)
+    w.config(u"configuration = Configuration()\n")
+    w.command(3, b'{"command": "version"}')
+    w.bmp_request_complete(1, 0, True)
+    w.bmp_request_complete(2, 1, False)
+    w.jobs_timed_out([1, 2])
+    w.close()
+
+    f.seek(0)
+    records = list(read_trace(f))
+    assert [(r.type, r.client, r.payload) for r in records] == [
+        (RecordType.config, None, u"configuration = Configuration()\n"),
+        (RecordType.command, 3, b'{"command": "version"}'),
+        (RecordType.bmp_request_complete, None, (1, 0, True)),
+        (RecordType.bmp_request_complete, None, (2, 1, False)),
+        (RecordType.jobs_timed_out, None, [1, 2]),
+    ]
+
+    # Timestamps should be in order
+    timestamps = [r.timestamp for r in records]
+    assert timestamps == sorted(timestamps)
+
+
+@pytest.mark.parametrize("data", [b"",
+                                  b"SPT",
+                                  struct.pack("<4sH", b"NOPE", VERSION),
+                                  struct.pack("<4sH", MAGIC, VERSION + 1)])
+def test_bad_header(data):
+    with pytest.raises(TraceFormatError):
+        list(read_trace(BytesIO(data)))
+
+
+@pytest.mark.parametrize("truncate", [1, 5])
+def test_truncated(f, truncate):
+    w = TraceWriter(f)
+    w.command(0, b'{"command": "version"}')
+    w.command(0, b'{"command": "list_jobs"}')
+    w.close()
+
+    # Records before the truncated one should still be produced
+    records = []
+    with pytest.raises(TraceFormatError):
+        for record in read_trace(BytesIO(f.getvalue()[:-truncate])):
+            records.append(record)
+    assert [r.payload for r in records] == [b'{"command": "version"}']
+
+
+def test_unknown_record_type(f):
+    TraceWriter(f).close()
+    f.write(struct.pack("<BdiI", 255, 0.0, -1, 0))
+
+    f.seek(0)
+    with pytest.raises(TraceFormatError):
+        list(read_trace(f))